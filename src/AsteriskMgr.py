@@ -1,16 +1,193 @@
+import asyncio
 import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import psycopg2
+import psycopg2.pool
 
 import utils
 
+# dialplan contexts of the endpoints hexidian creates, endpoints in other contexts are not hexidian's to touch
+CALL_ROUTER = 'call-router'
+CALL_ROUTER_TEMP = 'call-router-temp'
+OWN_CONTEXTS = (CALL_ROUTER, CALL_ROUTER_TEMP)
+
+
+class TempNumberPool:
+    """ Free/used bookkeeping for the temporary numbers (prefix followed by `length` digits)
+
+    Every possible number is one byte in a bitmap, so allocating and releasing never touches the database. Numbers are
+    handed out at random, falling back to a linear search once random probes keep hitting used numbers.
+    """
+    PROBES = 8
+
+    def __init__(self, prefix: str, length: int):
+        self.prefix = prefix
+        self.length = length
+        self._used = bytearray(10 ** length)
+        self.in_use = 0
+
+    def _index(self, number: str):
+        # index of a number in the bitmap, None for numbers outside of the pool
+        if len(number) != len(self.prefix) + self.length or not number.startswith(self.prefix):
+            return None
+        digits = number[len(self.prefix):]
+        return int(digits) if digits.isdigit() else None
+
+    def load(self, numbers):
+        self._used = bytearray(len(self._used))
+        self.in_use = 0
+        for number in numbers:
+            self.mark_used(number)
+
+    def allocate(self):
+        """ Reserves a free number and returns it
+
+        Raises:
+            RuntimeError: if all numbers are in use
+        """
+        size = len(self._used)
+        index = None
+        for _ in range(self.PROBES):
+            probe = random.randrange(size)
+            if not self._used[probe]:
+                index = probe
+                break
+        else:
+            start = random.randrange(size)
+            index = self._used.find(0, start)
+            if index < 0:
+                index = self._used.find(0, 0, start)
+            if index < 0:
+                raise RuntimeError(f'All {size} temporary numbers are in use.')
+        self._used[index] = 1
+        self.in_use += 1
+        return f'{self.prefix}{index:0{self.length}d}'
+
+    def mark_used(self, number: str):
+        index = self._index(number)
+        if index is not None and not self._used[index]:
+            self._used[index] = 1
+            self.in_use += 1
+
+    def release(self, number: str):
+        index = self._index(number)
+        if index is not None and self._used[index]:
+            self._used[index] = 0
+            self.in_use -= 1
+
+
+class AsteriskTransaction:
+    """ The Asterisk DB writes of one unit of work, typically one event
+
+    The methods only collect parameterized statements. When the `async with` block of
+    :meth:`AsteriskManager.transaction` is left without an exception, all of them are sent to the database as one
+    query, which PostgreSQL runs as a single transaction: one round trip, no matter how many statements. Statements
+    that don't match any row are harmless, so callers can write without checking first.
+    """
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.statements = []
+        # temporary number bookkeeping, done once the statements are committed
+        self.used = []
+        self.released = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        if exc_type is None and self.statements:
+            await self.manager.commit(self)
+
+    def add(self, sql, *params):
+        self.statements.append((sql, params))
+
+    def create_user(self, number, sip_password, name, temporary=False):
+        self.manager.logger.info(f'Creating Asterisk user with number: {number}')
+        call_router = CALL_ROUTER_TEMP if temporary else CALL_ROUTER
+        self.add("insert into ps_aors (id, max_contacts, remove_existing) values (%s, 1, 'yes')", number)
+        self.add("insert into ps_auths (id, auth_type, password, username) values (%s, 'userpass', %s, %s)",
+                 number, sip_password, number)
+        self.add("insert into ps_endpoints (id, aors, auth, context, callerid, allow, direct_media) "
+                 "values (%s, %s, %s, %s, %s, '!all,g722,alaw,ulaw,gsm', 'no')",
+                 number, number, number, call_router, name[:39])
+        self.used.append(number)
+
+    def create_or_update_user(self, number, sip_password, name):
+        """ Creates the user, or sets password and caller id of the existing one """
+        self.manager.logger.info(f'Creating or updating Asterisk user {number}.')
+        self.add("insert into ps_aors (id, max_contacts, remove_existing) values (%s, 1, 'yes') "
+                 "on conflict (id) do nothing", number)
+        self.add("insert into ps_auths (id, auth_type, password, username) values (%s, 'userpass', %s, %s) "
+                 "on conflict (id) do update set password = excluded.password", number, sip_password, number)
+        self.add("insert into ps_endpoints (id, aors, auth, context, callerid, allow, direct_media) "
+                 "values (%s, %s, %s, %s, %s, '!all,g722,alaw,ulaw,gsm', 'no') "
+                 "on conflict (id) do update set callerid = excluded.callerid",
+                 number, number, number, CALL_ROUTER, name[:39])
+        self.used.append(number)
+
+    def delete_user(self, number):
+        self.manager.logger.info(f'Deleting Asterisk user {number}.')
+        self.add("delete from ps_aors where id = %s", number)
+        self.add("delete from ps_auths where id = %s", number)
+        self.add("delete from ps_endpoints where id = %s", number)
+        self.released.append(number)
+
+    def move_user(self, old_number, new_number):
+        self.manager.logger.info(f'Moving Asterisk user {old_number} to {new_number}.')
+        self.add("update ps_aors set id = %s where id = %s", new_number, old_number)
+        self.add("update ps_auths set id = %s, username = %s where id = %s", new_number, new_number, old_number)
+        self.add("update ps_endpoints set id = %s, aors = %s, auth = %s where id = %s",
+                 new_number, new_number, new_number, old_number)
+        self.released.append(old_number)
+        self.used.append(new_number)
+
+    def update_user(self, number, password, name):
+        self.manager.logger.info(f'Updating password for Asterisk user {number}.')
+        self.add("update ps_auths set password = %s where id = %s", password, number)
+        self.add("update ps_endpoints set callerid = %s where id = %s", name[:39], number)
+
+    def create_callgroup(self, number, name):
+        self.add("insert into callgroups (extension, name) values (%s, %s)", number, name)
+
+    def update_callgroup(self, number, name):
+        self.add("update callgroups set name = %s where extension = %s", name, number)
+
+    def delete_callgroup(self, number):
+        self.add("delete from callgroups where extension = %s", number)
+        self.add("delete from callgroup_members where extension = %s", number)
+
+    def move_callgroup(self, old_number, new_number):
+        self.add("update callgroups set extension = %s where extension = %s", new_number, old_number)
+        self.add("update callgroup_members set callgroup = %s where callgroup = %s", new_number, old_number)
+
+    def add_user_to_callgroup(self, extension, callgroup):
+        self.add("insert into callgroup_members (extension, callgroup) values (%s, %s)", extension, callgroup)
+
+    def remove_user_from_callgroup(self, extension, callgroup):
+        self.add("delete from callgroup_members where extension = %s and callgroup = %s", extension, callgroup)
+
 
 class AsteriskManager:
+    """ Asterisk realtime database access that does not block the event loop
+
+    psycopg2 is synchronous, so every query runs on a small thread pool of `db_workers` threads, each with its own
+    connection from a ThreadedConnectionPool. The connections are in autocommit mode: a read is a single round trip,
+    and writes are collected in an :class:`AsteriskTransaction` and sent as one multi-statement query, which
+    PostgreSQL runs as one implicit transaction, saving the separate BEGIN and COMMIT round trips.
+    """
+
     def __init__(self, config):
         self.config = config['asterisk']
         self.logger = logging.getLogger(__name__)
+        self.db_workers = max(self.config.get('db_workers', 4), 1)
 
         try:
-            self.connection = psycopg2.connect(
+            self.pool = psycopg2.pool.ThreadedConnectionPool(
+                1, self.db_workers,
                 database='asterisk',
                 host=self.config['host'],
                 port=self.config['port'],
@@ -18,93 +195,124 @@ class AsteriskManager:
                 password=utils.read_password_env(self.config['password_env']),
 
             )
-            self.logger.info(f'PostgreSQL server version: {self.connection.server_version}')
         except psycopg2.OperationalError as exc:
             raise exc
+        self.executor = ThreadPoolExecutor(max_workers=self.db_workers, thread_name_prefix='asterisk-db')
+        self.queries = 0
+        self.statements = 0
+        self.query_time = 0.0
+        self.slowest_query = 0.0
+
+        connection = self.pool.getconn()
+        try:
+            self.logger.info(f'PostgreSQL server version: {connection.server_version}')
+        finally:
+            self.pool.putconn(connection)
+
+        self.temp_numbers = TempNumberPool(prefix='010', length=self.config['temp_num_length'])
+        self.load_temp_numbers()
+
+    def load_temp_numbers(self):
+        # only called on startup, before the event loop runs
+        rows = self._run([("select id from ps_aors where id like %s", (f'{self.temp_numbers.prefix}%',))], fetch=True)
+        self.temp_numbers.load(row[0] for row in rows)
+        self.logger.info(f'{self.temp_numbers.in_use} temporary numbers in use.')
 
     def close(self):
-        self.connection.close()
+        if self.pool.closed:
+            return
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.pool.closeall()
 
-    def create_user(self, number, sip_password, name, temporary=False):
-        self.logger.info(f'Creating Asterisk user with number: {number}')
-        call_router = 'call-router-temp' if temporary else 'call-router'
-        with self.connection.cursor() as cursor:
-            cursor.execute(
-                f"insert into ps_aors (id, max_contacts, remove_existing) values ('{number}', 1, 'yes');")
-            cursor.execute(
-                f"insert into ps_auths (id, auth_type, password, username) values ('{number}', 'userpass', '{sip_password}', '{number}');")
-            cursor.execute(
-                f"insert into ps_endpoints (id, aors, auth, context, callerid, allow, direct_media) values ('{number}', '{number}', '{number}', '{call_router}', '{name[:39]}', '!all,g722,alaw,ulaw,gsm', 'no');")
-        self.connection.commit()
+    def transaction(self):
+        """ Starts a unit of work, use as `async with asterisk_mgr.transaction() as transaction:`
+        """
+        return AsteriskTransaction(self)
 
-    def delete_user(self, number):
-        self.logger.info(f'Deleting Asterisk user {number}.')
-        with self.connection.cursor() as cursor:
-            cursor.execute(f"delete from ps_aors where id='{number}';")
-            cursor.execute(f"delete from ps_auths where id='{number}';")
-            cursor.execute(f"delete from ps_endpoints where id='{number}';")
-        self.connection.commit()
-
-    def check_for_user(self, number):
-        with self.connection.cursor() as cursor:
-            cursor.execute(f"select id from ps_aors where id='{number}'")
-            return cursor.fetchone() is not None
+    async def commit(self, transaction: AsteriskTransaction):
+        await self._in_executor(self._run, transaction.statements, False)
+        for number in transaction.released:
+            self.temp_numbers.release(number)
+        for number in transaction.used:
+            self.temp_numbers.mark_used(number)
 
-    def move_user(self, old_number, new_number):
-        self.logger.info(f'Moving Asterisk user {old_number} to {new_number}.')
-        with self.connection.cursor() as cursor:
-            cursor.execute(f"update ps_aors set id='{new_number}' where id='{old_number}'")
-            cursor.execute(f"update ps_auths set id='{new_number}', username='{new_number}' where id='{old_number}'")
-            cursor.execute(
-                f"update ps_endpoints set id='{new_number}', aors='{new_number}', auth='{new_number}' where id='{old_number}'")
-        self.connection.commit()
+    async def _query(self, sql, *params):
+        """ Runs one read on the DB thread pool and returns its rows
+        """
+        return await self._in_executor(self._run, [(sql, params)], True)
 
-    def update_user(self, number, password, name):
-        self.logger.info(f'Updating password for Asterisk user {number}.')
-        with self.connection.cursor() as cursor:
-            cursor.execute(f"update ps_auths set password='{password}' where id='{number}'")
-            cursor.execute(f"update ps_endpoints set callerid='{name[:39]}' where id='{number}'")
-        self.connection.commit()
+    async def _in_executor(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
 
-    def check_for_callgroup(self, number):
-        with self.connection.cursor() as cursor:
-            cursor.execute(f"select extension from callgroups where extension='{number}'")
-            return cursor.fetchone() is not None
+    def _run(self, statements, fetch):
+        started = time.perf_counter()
+        connection = self.pool.getconn()
+        try:
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                if len(statements) == 1:
+                    cursor.execute(*statements[0])
+                else:
+                    # the parameters are merged in client side, so the whole batch goes out as one query
+                    cursor.execute(b';'.join(cursor.mogrify(sql, params) for sql, params in statements))
+                return cursor.fetchall() if fetch else None
+        finally:
+            self.pool.putconn(connection, close=bool(connection.closed))
+            duration = time.perf_counter() - started
+            self.queries += 1
+            self.statements += len(statements)
+            self.query_time += duration
+            self.slowest_query = max(self.slowest_query, duration)
 
-    def update_callgroup(self, number, name):
-        with self.connection.cursor() as cursor:
-            cursor.execute(f"update callgroups set name='{name}' where extension='{number}'")
-        self.connection.commit()
+    def stats(self):
+        return {'workers': self.db_workers, 'round_trips': self.queries, 'statements': self.statements,
+                'avg_ms': round(self.query_time / self.queries * 1000, 2) if self.queries else 0,
+                'max_ms': round(self.slowest_query * 1000, 2)}
 
-    def create_callgroup(self, number, name):
-        with self.connection.cursor() as cursor:
-            cursor.execute(f"insert into callgroups (extension, name) values ('{number}', '{name}')")
-        self.connection.commit()
+    # single operations, each one its own transaction
 
-    def delete_callgroup(self, number):
-        with self.connection.cursor() as cursor:
-            cursor.execute(f"delete from callgroups where extension='{number}'")
-            cursor.execute(f"delete from callgroup_members where extension='{number}'")
-        self.connection.commit()
+    async def create_user(self, number, sip_password, name, temporary=False):
+        async with self.transaction() as transaction:
+            transaction.create_user(number, sip_password, name, temporary)
 
-    def move_callgroup(self, old_number, new_number):
-        with self.connection.cursor() as cursor:
-            cursor.execute(f"update callgroups set extension='{new_number}' where extension='{old_number}'")
-            cursor.execute(f"update callgroup_members set callgroup='{new_number}' where callgroup='{old_number}'")
-        self.connection.commit()
+    async def delete_user(self, number):
+        async with self.transaction() as transaction:
+            transaction.delete_user(number)
 
-    def fetch_callgroup_members(self, number):
-        with self.connection.cursor() as cursor:
-            cursor.execute(f"select extension from callgroup_members where callgroup='{number}'")
-            return [ext[0] for ext in cursor.fetchall()]
+    async def delete_callgroup(self, number):
+        async with self.transaction() as transaction:
+            transaction.delete_callgroup(number)
 
-    def add_user_to_callgroup(self, extension, callgroup):
-        with self.connection.cursor() as cursor:
-            cursor.execute(
-                f"insert into callgroup_members (extension, callgroup) values ('{extension}', '{callgroup}')")
-        self.connection.commit()
+    # reads
 
-    def remove_user_from_callgroup(self, extension, callgroup):
-        with self.connection.cursor() as cursor:
-            cursor.execute(f"delete from callgroup_members where extension='{extension}' AND callgroup='{callgroup}'")
-        self.connection.commit()
+    async def check_for_user(self, number):
+        return bool(await self._query("select id from ps_aors where id = %s", number))
+
+    async def check_for_callgroup(self, number):
+        return bool(await self._query("select extension from callgroups where extension = %s", number))
+
+    async def fetch_callgroup_members(self, number):
+        rows = await self._query("select extension from callgroup_members where callgroup = %s", number)
+        return [ext[0] for ext in rows]
+
+    async def fetch_endpoints(self):
+        """ Returns (callerid, password, context) of every endpoint by number
+        """
+        rows = await self._query(
+            "select e.id, e.callerid, a.password, e.context from ps_endpoints e left join ps_auths a on a.id = e.id")
+        return {number: (callerid, password, context) for number, callerid, password, context in rows}
+
+    async def fetch_callgroups(self):
+        """ Returns the name of every callgroup by number
+        """
+        rows = await self._query("select extension, name from callgroups")
+        return dict(rows)
+
+    async def fetch_all_callgroup_members(self):
+        """ Returns the set of member extensions of every callgroup by callgroup number
+        """
+        rows = await self._query("select callgroup, extension from callgroup_members")
+        members = {}
+        for callgroup, extension in rows:
+            members.setdefault(callgroup, set()).add(extension)
+        return members
@@ -1,13 +1,23 @@
 import asyncio
 import logging
 import signal
+import zlib
 from datetime import datetime
 
+import psycopg2
+from aiohttp import web
+
 import utils
 from Guru3Mgr import Guru3Mgr
 from OMMMgr import OMMMgr
 from AsteriskMgr import AsteriskManager
+from LoopMonitor import LoopMonitor
+from ReconcileMgr import ReconcileMgr
 from RegistrationMgr import RegistrationMgr
+from SnapshotMgr import SnapshotMgr
+
+# failures that go away by themselves: the event is retried until it succeeds
+TRANSIENT_ERRORS = (ConnectionError, asyncio.TimeoutError, psycopg2.OperationalError, psycopg2.InterfaceError)
 
 
 class EventHandler:
@@ -15,15 +25,42 @@ class EventHandler:
         self.all_config = config
         self.own_config = config['event_handler']
         self.event_queue = asyncio.Queue()
+        self.shards = [asyncio.Queue() for _ in range(max(self.own_config.get('workers', 8), 1))]
+        self.shard_max_depth = [0] * len(self.shards)
+        self.shard_processed = [0] * len(self.shards)
+        # events that were dropped because a later event superseded them
+        self.events_coalesced = 0
+        # failing events are retried in place, so later events for the same number can't overtake them
+        self.retry_delay = self.own_config.get('retry_delay', 1)
+        self.retry_max_delay = self.own_config.get('retry_max_delay', 60)
+        self.max_retries = self.own_config.get('max_retries', 5)
+        self.events_retried = 0
+        self.events_failed = 0
 
         self.guru3_mgr = Guru3Mgr(config, event_queue=self.event_queue)
         self.omm_mgr = OMMMgr(config)
         self.asterisk_mgr = AsteriskManager(config)
         self.registration_mgr = RegistrationMgr(config, self.try_device_registration)
+        self.snapshot_mgr = SnapshotMgr(config, self.omm_mgr)
+        self.loop_monitor = LoopMonitor(config)
+        # held while events are dispatched, a reconciliation takes it to pause the dispatching
+        self.dispatch_lock = asyncio.Lock()
+        self.reconcile_mgr = ReconcileMgr(config, self)
+        self.registration_mgr.app.add_routes(self.snapshot_mgr.routes())
+        self.registration_mgr.app.add_routes(self.reconcile_mgr.routes())
+        self.registration_mgr.app.add_routes([web.get('/stats', self.handle_stats)])
 
         self.logger = logging.getLogger(__name__)
         self.tasks = []
 
+        # unbound PPs are handled as soon as the OMM reports them, the periodic sweep is only a safety net
+        self._binding_ppns = set()
+        self._binding_tasks = set()
+        self._sweep_requested = asyncio.Event()
+        self._subscription_mode = None
+        self.omm_mgr.directory.on_device_changed += self._on_device_changed
+        self.omm_mgr.pool.primary.on_DECTSubscriptionMode += self._on_subscription_mode
+
     def start(self):
         try:
             asyncio.run(self.run_tasks())
@@ -52,6 +89,15 @@ class EventHandler:
         # Collect unbound PPNs task, collects unbound devices in OMM and assigns them temp accounts
         self.tasks.append(asyncio.create_task(self.find_unbound_pps()))
 
+        # PP snapshot task, keeps the last action of every PP current for the /snapshot routes
+        self.tasks.append(asyncio.create_task(self.snapshot_mgr.run()))
+
+        # Reconcile task, repairs whatever differs between Guru3 and the OMM/Asterisk on startup and on a schedule
+        self.tasks.append(asyncio.create_task(self.reconcile_mgr.run()))
+
+        # Loop monitor task, measures how long the event loop is blocked at a time
+        self.tasks.append(asyncio.create_task(self.loop_monitor.run()))
+
         # SIGTERM handler
         try:
             asyncio.get_event_loop().add_signal_handler(signal.SIGTERM, self.handle_sigterm)
@@ -67,53 +113,190 @@ class EventHandler:
             self.asterisk_mgr.close()
 
     async def distribute_guru3_messages(self):
+        # events are spread over worker shards by the numbers they affect: events for the same number stay in order,
+        # events for unrelated numbers are processed concurrently
+        workers = [asyncio.create_task(self._process_shard(shard)) for shard in range(len(self.shards))]
         try:
-            self.logger.info('Listening for inbound Guru3 messages.')
+            self.logger.info(f'Listening for inbound Guru3 messages, processing them with {len(workers)} workers.')
             while True:
-                # wait for new event in queue
-                event = await self.event_queue.get()
-                event_id = event['id']
-                event_type = event['type']
-                event_data = event['data']
-                event_time = int(event['timestamp'])
-
-                self.logger.info(f'//== Now processing event {event_id} ({event_type}).')
-
-                # some events can be safely ignored and reported back to Guru3 as done
-                if event_type in self.own_config['ignored_msgtypes']:
-                    self.logger.info(f'Ignoring event of type {event_type} as per config.')
-                    self.guru3_mgr.mark_event_complete(event_id)
-                    continue
-
-                # =====> CALL EVENT PROCESSORS
-                if event_type == 'UPDATE_EXTENSION':
-                    self.do_update_extension(event_data)
-                elif event_type == 'DELETE_EXTENSION':
-                    self.do_delete_extension(event_data)
-                elif event_type == 'RENAME_EXTENSION':
-                    self.do_rename_extension(event_data)
-                elif event_type == 'UNSUBSCRIBE_DEVICE':
-                    self.do_unsubscribe_device(event_data)
-                elif event_type == 'UPDATE_CALLGROUP':
-                    self.do_update_callgroup(event_data)
-                else:
-                    raise RuntimeError(
-                        f'Unknown event type occurred while EventHandler was processing event {event_id}.')
-                delta_time = datetime.now() - datetime.fromtimestamp(event_time)
-                delta_time = delta_time.seconds + delta_time.microseconds / 1000000
-                # mark event done in Guru3
-                self.guru3_mgr.mark_event_complete(event_id)
-                self.logger.info(f'\\\\== Event processed {round(delta_time, 2)} seconds after creation in Guru3.')
+                # wait for new event in queue, then take everything else that is already waiting as well
+                events = [await self.event_queue.get()]
+                while not self.event_queue.empty():
+                    events.append(self.event_queue.get_nowait())
+
+                async with self.dispatch_lock:
+                    batch = []
+                    for event in events:
+                        # every event, even an ignored one, tells what Guru3 wants the end result to be
+                        self.reconcile_mgr.desired.observe(event)
+                        # some events can be safely ignored and reported back to Guru3 as done
+                        if event['type'] in self.own_config['ignored_msgtypes']:
+                            self.logger.info(f'Ignoring event {event["id"]} of type {event["type"]} as per config.')
+                            await self.guru3_mgr.mark_event_complete(event['id'])
+                        else:
+                            batch.append(event)
+
+                    for event in self.coalesce(batch):
+                        await self._dispatch(event)
+                self.logger.debug(f'Event shard depths: {self.shard_depths()}')
 
         except asyncio.CancelledError:
             pass
-
-    def try_device_registration(self, temp_number, token):
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+    async def _dispatch(self, event):
+        shards = sorted({self._shard_of(number) for number in self._affected_numbers(event)})
+        if len(shards) == 1:
+            queue = self.shards[shards[0]]
+            await queue.put(event)
+            self.shard_max_depth[shards[0]] = max(self.shard_max_depth[shards[0]], queue.qsize())
+        else:
+            # touches numbers of several shards: let those drain, then process it on its own
+            await asyncio.gather(*(self.shards[shard].join() for shard in shards))
+            await self._process_with_retry(event)
+
+    def coalesce(self, events):
+        """ Drops the events of a batch that a later event for the same number makes pointless
+
+        Only directly consecutive events for a number are folded, and only if the later one fully determines the
+        outcome: an extension update or deletion supersedes an earlier extension update, a callgroup update an earlier
+        callgroup update. An update to a GROUP extension is only superseded by another GROUP update or a deletion,
+        since the other types leave the callgroup in place. Renames and unsubscribes are never folded and separate the
+        events before them from the ones after them. The ids of dropped events are acknowledged together with the
+        event that superseded them.
+        """
+        result = []
+        # index in result of the last event per number
+        last = {}
+        for event in events:
+            numbers = self._affected_numbers(event)
+            previous = result[last[numbers[0]]] if len(numbers) == 1 and numbers[0] in last else None
+            if previous is not None and self._supersedes(event, previous):
+                event['folded'] = previous.get('folded', []) + [previous['id']]
+                result[last[numbers[0]]] = None
+                self.events_coalesced += 1
+                self.logger.info(f'Event {previous["id"]} ({previous["type"]}) is superseded by event {event["id"]}.')
+            for number in numbers:
+                last[number] = len(result)
+            result.append(event)
+        return [event for event in result if event is not None]
+
+    @staticmethod
+    def _supersedes(event, previous):
+        if previous['type'] == 'UPDATE_EXTENSION':
+            if event['type'] == 'DELETE_EXTENSION':
+                return True
+            if event['type'] == 'UPDATE_EXTENSION':
+                return previous['data']['type'] != 'GROUP' or event['data']['type'] == 'GROUP'
+        return previous['type'] == event['type'] == 'UPDATE_CALLGROUP'
+
+    @staticmethod
+    def _affected_numbers(event):
+        event_type = event['type']
+        event_data = event['data']
+        if event_type in ('UPDATE_EXTENSION', 'DELETE_EXTENSION', 'UPDATE_CALLGROUP'):
+            return [event_data['number']]
+        if event_type == 'RENAME_EXTENSION':
+            return [event_data['old_extension'], event_data['new_extension']]
+        if event_type == 'UNSUBSCRIBE_DEVICE':
+            return [event_data['extension']]
+        raise RuntimeError(f'Unknown event type occurred while EventHandler was processing event {event["id"]}.')
+
+    def _shard_of(self, number):
+        return zlib.crc32(str(number).encode()) % len(self.shards)
+
+    def shard_depths(self):
+        return [queue.qsize() for queue in self.shards]
+
+    def shard_stats(self):
+        return {'depths': self.shard_depths(), 'max_depths': list(self.shard_max_depth),
+                'processed': list(self.shard_processed), 'coalesced': self.events_coalesced,
+                'retried': self.events_retried, 'failed': self.events_failed}
+
+    async def handle_stats(self, _):
+        return web.json_response({'loop': self.loop_monitor.stats(), 'events': self.shard_stats(),
+                                  'asterisk': self.asterisk_mgr.stats(), 'guru3_acks': self.guru3_mgr.acks.stats(),
+                                  'guru3_fetches': self.guru3_mgr.fetch_stats(),
+                                  'omm_sessions': self.omm_mgr.session_stats()})
+
+    async def _process_shard(self, shard):
+        queue = self.shards[shard]
+        while True:
+            event = await queue.get()
+            try:
+                await self._process_with_retry(event)
+                self.shard_processed[shard] += 1
+            finally:
+                queue.task_done()
+
+    async def _process_with_retry(self, event):
+        """ Processes an event, retrying it in place while it fails
+
+        The shard waits meanwhile, so no later event for the same number can be applied before it. Transient errors
+        (lost connections, timeouts, database outages) are retried until the event succeeds. Any other error is
+        retried `max_retries` times; after that the event is acknowledged as failed and logged, because replaying it
+        after newer events (e.g. when Guru3 sends it again after a restart) would revert the extension.
+        """
+        failures = 0
+        while True:
+            try:
+                await self.process_event(event)
+                return
+            except Exception as exc:
+                failures += 1
+                if not isinstance(exc, TRANSIENT_ERRORS) and failures > self.max_retries:
+                    self.events_failed += 1
+                    self.logger.exception(f'Processing event {event["id"]} ({event["type"]}) failed {failures} '
+                                          f'times, giving up and acknowledging it as failed: {event["data"]}')
+                    await self._mark_complete(event)
+                    return
+                delay = min(self.retry_max_delay, self.retry_delay * 2 ** (failures - 1))
+                self.events_retried += 1
+                self.logger.warning(f'Processing event {event["id"]} ({event["type"]}) failed: {exc!r}, '
+                                    f'retrying in {delay} s.')
+                await asyncio.sleep(delay)
+
+    async def _mark_complete(self, event):
+        # mark event done in Guru3, together with the events it superseded
+        for folded_id in event.get('folded', []):
+            await self.guru3_mgr.mark_event_complete(folded_id)
+        await self.guru3_mgr.mark_event_complete(event['id'])
+
+    async def process_event(self, event):
+        event_id = event['id']
+        event_type = event['type']
+        event_data = event['data']
+        event_time = int(event['timestamp'])
+
+        self.logger.info(f'//== Now processing event {event_id} ({event_type}).')
+
+        # =====> CALL EVENT PROCESSORS
+        if event_type == 'UPDATE_EXTENSION':
+            await self.do_update_extension(event_data)
+        elif event_type == 'DELETE_EXTENSION':
+            await self.do_delete_extension(event_data)
+        elif event_type == 'RENAME_EXTENSION':
+            await self.do_rename_extension(event_data)
+        elif event_type == 'UNSUBSCRIBE_DEVICE':
+            await self.do_unsubscribe_device(event_data)
+        elif event_type == 'UPDATE_CALLGROUP':
+            await self.do_update_callgroup(event_data)
+        else:
+            raise RuntimeError(
+                f'Unknown event type occurred while EventHandler was processing event {event_id}.')
+        delta_time = datetime.now() - datetime.fromtimestamp(event_time)
+        delta_time = delta_time.seconds + delta_time.microseconds / 1000000
+        await self._mark_complete(event)
+        self.logger.info(f'\\\\== Event {event_id} processed {round(delta_time, 2)} seconds after creation in Guru3.')
+
+    async def try_device_registration(self, temp_number, token):
         token = token[4:]
         # find OMM user with the temporary number
-        from_user = self.omm_mgr.omm.find_user({'num': temp_number})
+        from_user = self.omm_mgr.directory.user_by_num(temp_number)
         # find OMM user with the corresponding token
-        to_user = self.omm_mgr.omm.find_user({'hierarchy2': token})
+        to_user = self.omm_mgr.directory.user_by_token(token)
         if not from_user:
             self.logger.warning(
                 f'Failed to fetch temp user (temp_num:{temp_number}) on registration! Can\'t transfer PP!')
@@ -124,13 +307,15 @@ class EventHandler:
         self.logger.info(
             f'Transferring PP (ppn:{from_user.ppn}) to OMM user (uid: {to_user.uid}, number: {to_user.num}).')
         # transfer PP to real user
-        self.omm_mgr.transfer_pp(int(from_user.uid), int(to_user.uid), int(from_user.ppn))
+        if not await self.omm_mgr.transfer_pp(int(from_user.uid), int(to_user.uid), int(from_user.ppn)):
+            self.logger.warning(f'Failed to transfer PP (ppn:{from_user.ppn}) on registration, keeping temp user.')
+            return False
         # delete temporary user, both in OMM and Asterisk
-        self.omm_mgr.delete_user(temp_number)
-        self.asterisk_mgr.delete_user(temp_number)
+        await self.omm_mgr.delete_user(temp_number)
+        await self.asterisk_mgr.delete_user(temp_number)
         return True
 
-    def do_update_extension(self, event_data):
+    async def do_update_extension(self, event_data):
         # extract event info
         ext_type = event_data['type']
         number = event_data['number']
@@ -140,24 +325,23 @@ class EventHandler:
             self.logger.warning(
                 f'Non-SIP/DECT extension update (type:{ext_type}), ignoring event and deleting old SIP and DECT entries for this number.')
             if number in self.omm_mgr.users:
-                self.omm_mgr.delete_user(number)
-            if self.asterisk_mgr.check_for_user(number):
-                self.asterisk_mgr.delete_user(number)
+                await self.omm_mgr.delete_user(number)
+            await self.asterisk_mgr.delete_user(number)
             return
 
         # handle SIP extension update
         if ext_type == 'SIP':
-            self.do_sip_extension_update(event_data)
+            await self.do_sip_extension_update(event_data)
 
         # handle DECT extension update
         elif ext_type == 'DECT':
-            self.do_dect_extension_update(event_data)
+            await self.do_dect_extension_update(event_data)
 
         # handle GROUP (callgroup) extension update
         elif ext_type == 'GROUP':
-            self.do_group_extension_update(event_data)
+            await self.do_group_extension_update(event_data)
 
-    def do_sip_extension_update(self, event_data):
+    async def do_sip_extension_update(self, event_data):
         number = event_data['number']
         sip_password = event_data['password']
         name = utils.normalize_name(event_data['name'])
@@ -165,17 +349,13 @@ class EventHandler:
 
         # delete DECT extension, if present
         if number in self.omm_mgr.users:
-            self.omm_mgr.delete_user(number=number)
-
-        # SIP extension already exists, only a password update is required
-        if self.asterisk_mgr.check_for_user(number=number):
-            self.asterisk_mgr.update_user(number=number, password=sip_password, name=name)
+            await self.omm_mgr.delete_user(number=number)
 
-        # new SIP extension
-        else:
-            self.asterisk_mgr.create_user(number=number, sip_password=sip_password, name=name)
+        # new SIP extension, or only a password update if it already exists
+        async with self.asterisk_mgr.transaction() as transaction:
+            transaction.create_or_update_user(number=number, sip_password=sip_password, name=name)
 
-    def do_dect_extension_update(self, event_data):
+    async def do_dect_extension_update(self, event_data):
         # trim name to length acceptable by OMM
         name = utils.normalize_name(event_data['name'])
         number = event_data['number']
@@ -185,61 +365,65 @@ class EventHandler:
         # if user already exists, update user entry
         if number in self.omm_mgr.users:
             self.logger.info(f'Updating existing OMM user {number}.')
-            self.omm_mgr.update_user_info(number=number, name=name, token=token)
+            await self.omm_mgr.update_user_info(number=number, name=name, token=token)
+            # the Asterisk user may have gone missing, e.g. after an event failed halfway
+            if not await self.asterisk_mgr.check_for_user(number=number):
+                self.logger.info(f'Recreating missing Asterisk user {number} with a new SIP password.')
+                sip_password = utils.create_password('alphanum', self.all_config['asterisk']['password_length'])
+                await self.asterisk_mgr.create_user(number=number, name=name, sip_password=sip_password)
+                await self.omm_mgr.update_sip_password(number=number, sip_password=sip_password)
 
         # else, create a new user
         else:
             self.logger.info(f'Creating new Asterisk and OMM user for number {number}.')
-            # make sure that any existing SIP user is being deleted beforehand
-            if self.asterisk_mgr.check_for_user(number=number):
-                self.logger.info('Deleting existing Asterisk user that would clash with the newly created one.')
-                self.asterisk_mgr.delete_user(number=number)
-
             sip_password = utils.create_password('alphanum', self.all_config['asterisk']['password_length'])
-            self.asterisk_mgr.create_user(number=number, name=name, sip_password=sip_password)
-            self.omm_mgr.create_user(name=name, number=number, token=token, sip_user=number, sip_password=sip_password)
-
-    def do_group_extension_update(self, event_data):
+            async with self.asterisk_mgr.transaction() as transaction:
+                # make sure that any existing SIP user is being deleted beforehand
+                transaction.delete_user(number=number)
+                transaction.create_user(number=number, name=name, sip_password=sip_password)
+            await self.omm_mgr.create_user(name=name, number=number, token=token, sip_user=number,
+                                           sip_password=sip_password)
+
+    async def do_group_extension_update(self, event_data):
         number = event_data['number']
         name = event_data['name']
 
         # delete DECT extension, if present
         if number in self.omm_mgr.users:
-            self.omm_mgr.delete_user(number=number)
+            await self.omm_mgr.delete_user(number=number)
 
-        # delete Asterisk user, if present
-        if self.asterisk_mgr.check_for_user(number):
-            self.asterisk_mgr.delete_user(number)
+        callgroup_exists = await self.asterisk_mgr.check_for_callgroup(number)
+        async with self.asterisk_mgr.transaction() as transaction:
+            # delete Asterisk user, if present
+            transaction.delete_user(number)
 
-        # if callgroup already exists, update entry
-        if self.asterisk_mgr.check_for_callgroup(number):
-            self.asterisk_mgr.update_callgroup(number, name)
-        # else, create new callgroup
-        else:
-            self.asterisk_mgr.create_callgroup(number=number, name=name)
+            # if callgroup already exists, update entry
+            if callgroup_exists:
+                transaction.update_callgroup(number, name)
+            # else, create new callgroup
+            else:
+                transaction.create_callgroup(number=number, name=name)
 
-    def do_delete_extension(self, event_data):
+    async def do_delete_extension(self, event_data):
         number = event_data['number']
-        if self.asterisk_mgr.check_for_user(number):
-            self.asterisk_mgr.delete_user(number=number)
+        async with self.asterisk_mgr.transaction() as transaction:
+            transaction.delete_user(number=number)
+            transaction.delete_callgroup(number)
         if number in self.omm_mgr.users:
-            self.omm_mgr.delete_user(number=number)
-        if self.asterisk_mgr.check_for_callgroup(number=number):
-            self.asterisk_mgr.delete_callgroup(number)
+            await self.omm_mgr.delete_user(number=number)
 
-    def do_rename_extension(self, event_data):
+    async def do_rename_extension(self, event_data):
         old_number = event_data['old_extension']
         new_number = event_data['new_extension']
-        if self.asterisk_mgr.check_for_user(number=old_number):
-            self.asterisk_mgr.move_user(old_number=old_number, new_number=new_number)
+        # moving a user or callgroup that doesn't exist changes nothing
+        async with self.asterisk_mgr.transaction() as transaction:
+            transaction.move_user(old_number=old_number, new_number=new_number)
+            transaction.move_callgroup(old_number, new_number)
 
         if old_number in self.omm_mgr.users:
-            self.omm_mgr.move_user(old_number, new_number)
-
-        if self.asterisk_mgr.check_for_callgroup(old_number):
-            self.asterisk_mgr.move_callgroup(old_number, new_number)
+            await self.omm_mgr.move_user(old_number, new_number)
 
-    def do_unsubscribe_device(self, event_data):
+    async def do_unsubscribe_device(self, event_data):
         number = event_data['extension']
         user = self.omm_mgr.users[number]
         ppn = int(user.ppn)
@@ -248,30 +432,106 @@ class EventHandler:
                 'Discarding UNSUBSCRIBE_DEVICE since the user has no PP. (Get your mind out of the gutter!)')
             return
         self.logger.info(f'Unsubscribing PP (PPN:{ppn}) from user {user.num}.')
-        self.omm_mgr.omm.delete_device(ppn)
+        await self.omm_mgr.delete_device(ppn)
 
     async def find_unbound_pps(self):
         try:
+            await self.omm_mgr.ready.wait()
+            # temporary users left in the OMM keep their numbers, whether or not Asterisk still knows them
+            for number in list(self.omm_mgr.directory.users_by_num):
+                self.asterisk_mgr.temp_numbers.mark_used(number)
             self.logger.info('Now looking for unbound PPs.')
             while True:
-                for device in self.omm_mgr.omm.get_devices():
-                    if device.relType != 'Unbound':
-                        continue
-                    temp_number = f'010' + utils.create_password('num', self.all_config['asterisk']['temp_num_length'])
-                    temp_password = utils.create_password('alphanum', self.all_config['asterisk']['password_length'])
-                    while self.asterisk_mgr.check_for_user(temp_number):
-                        temp_number = f'010' + utils.create_password('num',
-                                                                     self.all_config['asterisk']['temp_num_length'])
-                    self.logger.info(f'Assigning unbound device ({device.ppn}) to a temporary user ({temp_number})')
-                    omm_user = self.omm_mgr.create_user(name='Unbound Handset', number=temp_number,
-                                                        sip_user=temp_number,
-                                                        sip_password=temp_password)
-                    self.omm_mgr.omm.attach_user_device(uid=int(omm_user.uid), ppn=int(device.ppn))
-                    self.asterisk_mgr.create_user(number=temp_number, name='Unbound Handset', sip_password=temp_password, temporary=True)
-
-                await asyncio.sleep(self.own_config['collect_ppns_interval'])
+                for device in self.omm_mgr.directory.devices_with_reltype('Unbound'):
+                    self._bind_later(device)
+                # sleep until the next sweep is due, or the OMM reports a change of the subscription mode
+                try:
+                    await asyncio.wait_for(self._sweep_requested.wait(), self.own_config['collect_ppns_interval'])
+                except asyncio.TimeoutError:
+                    pass
+                self._sweep_requested.clear()
+                await self._refresh_devices()
         except asyncio.CancelledError:
-            pass
+            for task in self._binding_tasks:
+                task.cancel()
+
+    async def _refresh_devices(self):
+        # the cache only knows what the OMM events told it, ask the OMM in case a PPDevCnf was missed
+        try:
+            changed, removed = await self.omm_mgr.directory.resync_devices()
+        except (ConnectionError, asyncio.TimeoutError) as exc:
+            # the cache is swept as it is, the next sweep tries again
+            self.logger.warning(f'Re-reading the devices for the unbound PP sweep failed: {exc!r}')
+            return
+        if changed or removed:
+            self.logger.info(f'Unbound PP sweep: {changed} devices changed, {removed} removed since the last events.')
+
+    def _on_device_changed(self, device):
+        if device.relType == 'Unbound' and self.omm_mgr.ready.is_set() \
+                and int(device.ppn) not in self.omm_mgr.transferring_ppns:
+            self._bind_later(device)
+
+    def _on_subscription_mode(self, message, attributes, children):
+        mode = (children or {}).get('mode')
+        mode = mode.get('mode') if isinstance(mode, dict) else attributes.get('mode')
+        # the keepalive sets the mode every few seconds and the OMM reports each of these, changed or not
+        if mode == self._subscription_mode:
+            return
+        self.logger.info(f'DECT subscription mode changed: {self._subscription_mode} -> {mode}')
+        self._subscription_mode = mode
+        self._sweep_requested.set()
+
+    def _bind_later(self, device):
+        ppn = int(device.ppn)
+        # the sweep and the OMM events may both report the same PP, bind it only once
+        if ppn in self._binding_ppns:
+            return
+        self._binding_ppns.add(ppn)
+        task = asyncio.create_task(self.bind_unbound_pp(ppn))
+        self._binding_tasks.add(task)
+        task.add_done_callback(self._binding_tasks.discard)
+
+    async def bind_unbound_pp(self, ppn):
+        temp_number = None
+        omm_user = None
+        try:
+            # the cached state may be outdated by now, only bind what the OMM still reports as unbound
+            device = await self.omm_mgr.directory.refresh_device(ppn)
+            if device is None or device.relType != 'Unbound' or ppn in self.omm_mgr.transferring_ppns:
+                return
+            temp_number = self._allocate_temp_number()
+            temp_password = utils.create_password('alphanum', self.all_config['asterisk']['password_length'])
+            self.logger.info(f'Assigning unbound device ({ppn}) to a temporary user ({temp_number})')
+            omm_user = await self.omm_mgr.create_user(name='Unbound Handset', number=temp_number,
+                                                      sip_user=temp_number,
+                                                      sip_password=temp_password)
+            await self.omm_mgr.attach_device(uid=int(omm_user.uid), ppn=ppn)
+            await self.asterisk_mgr.create_user(number=temp_number, name='Unbound Handset', sip_password=temp_password,
+                                                temporary=True)
+        except Exception as exc:
+            # the next sweep tries again
+            self.logger.error(f'Failed to assign unbound device ({ppn}) to a temporary user: {exc!r}')
+            if temp_number is not None:
+                await self._discard_temp_user(temp_number, omm_user)
+        finally:
+            self._binding_ppns.discard(ppn)
+
+    def _allocate_temp_number(self):
+        # a temporary number is also taken while an OMM user has it, even without an Asterisk user
+        while True:
+            number = self.asterisk_mgr.temp_numbers.allocate()
+            if self.omm_mgr.directory.user_by_num(number) is None:
+                return number
+
+    async def _discard_temp_user(self, temp_number, omm_user):
+        # undoes a failed binding; the number only goes back into the pool once neither system has a user for it
+        try:
+            if omm_user is not None:
+                await self.omm_mgr.delete_user(temp_number)
+            if not await self.asterisk_mgr.check_for_user(temp_number):
+                self.asterisk_mgr.temp_numbers.release(temp_number)
+        except Exception as exc:
+            self.logger.error(f'Failed to remove the temporary user {temp_number}, its number stays reserved: {exc!r}')
 
     def handle_sigterm(self):
         self.logger.info('Received SIGTERM, trying graceful shutdown...')
@@ -280,17 +540,18 @@ class EventHandler:
         self.asterisk_mgr.close()
         self.logger.info('Shutdown complete, goodbye.')
 
-    def do_update_callgroup(self, event_data):
+    async def do_update_callgroup(self, event_data):
         callgroup_number = event_data['number']
         self.logger.info('Updating callgroup in Asterisk\'s DB to reflect list of active members from Guru3.')
         active_extensions = [ext['extension'] for ext in event_data['extensions'] if ext['active']]
-        current_extensions = self.asterisk_mgr.fetch_callgroup_members(callgroup_number)
-        for ext in set(active_extensions + current_extensions):
-            if ext in active_extensions and ext in current_extensions:
-                continue
-            if ext in active_extensions and ext not in current_extensions:
-                self.logger.info(f'Add member {ext} to callgroup {callgroup_number} in Asterisk DB.')
-                self.asterisk_mgr.add_user_to_callgroup(extension=ext, callgroup=callgroup_number)
-            else:
-                self.logger.info(f'Remove member {ext} from callgroup {callgroup_number} in Asterisk DB.')
-                self.asterisk_mgr.remove_user_from_callgroup(extension=ext, callgroup=callgroup_number)
+        current_extensions = await self.asterisk_mgr.fetch_callgroup_members(callgroup_number)
+        async with self.asterisk_mgr.transaction() as transaction:
+            for ext in set(active_extensions + current_extensions):
+                if ext in active_extensions and ext in current_extensions:
+                    continue
+                if ext in active_extensions and ext not in current_extensions:
+                    self.logger.info(f'Add member {ext} to callgroup {callgroup_number} in Asterisk DB.')
+                    transaction.add_user_to_callgroup(extension=ext, callgroup=callgroup_number)
+                else:
+                    self.logger.info(f'Remove member {ext} from callgroup {callgroup_number} in Asterisk DB.')
+                    transaction.remove_user_from_callgroup(extension=ext, callgroup=callgroup_number)
@@ -1,13 +1,105 @@
 import asyncio
 import logging
+import random
 
-import requests
+import aiohttp
 import websockets
 import json
+from websockets.exceptions import ConnectionClosed, InvalidHandshake
 
 import utils
 
 
+class AckBatcher:
+    """ Collects the ids of completed events and acknowledges them to Guru3 in batches
+
+    A batch is sent once `max_batch` ids are pending or `max_delay` seconds after the first id of the batch arrived,
+    whatever comes first. `send` is a coroutine taking the list of ids and returning whether Guru3 accepted it; ids of
+    a rejected batch stay pending and are sent again after `retry_delay` seconds.
+    """
+
+    def __init__(self, send, max_batch=100, max_delay=0.5, retry_delay=5.0):
+        self.logger = logging.getLogger(__name__)
+        self._send = send
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.retry_delay = retry_delay
+        self.pending = []
+        self._pending_ids = set()
+        self._wakeup = asyncio.Event()
+        self._full = asyncio.Event()
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.acked = 0
+        self.largest_flush = 0
+
+    def add(self, event_id):
+        if event_id in self._pending_ids:
+            return
+        self._pending_ids.add(event_id)
+        self.pending.append(event_id)
+        self._wakeup.set()
+        if len(self.pending) >= self.max_batch:
+            self._full.set()
+
+    async def run(self):
+        while True:
+            await self._wakeup.wait()
+            # give more events the chance to complete and join this batch
+            try:
+                await asyncio.wait_for(self._full.wait(), self.max_delay)
+            except asyncio.TimeoutError:
+                pass
+            if not await self.flush():
+                await asyncio.sleep(self.retry_delay)
+
+    async def flush(self):
+        """ Sends one batch of pending ids, returns False if Guru3 did not accept it
+        """
+        batch = self.pending[:self.max_batch]
+        del self.pending[:self.max_batch]
+        if not self.pending:
+            self._wakeup.clear()
+        if len(self.pending) < self.max_batch:
+            self._full.clear()
+        if not batch:
+            return True
+        try:
+            ok = await self._send(batch)
+        except BaseException:
+            self._requeue(batch)
+            raise
+        if not ok:
+            self.failed_flushes += 1
+            self._requeue(batch)
+            return False
+        self._pending_ids.difference_update(batch)
+        self.flushes += 1
+        self.acked += len(batch)
+        self.largest_flush = max(self.largest_flush, len(batch))
+        return True
+
+    def _requeue(self, batch):
+        # keep the order, these ids have been waiting the longest
+        self.pending[:0] = batch
+        self._wakeup.set()
+        if len(self.pending) >= self.max_batch:
+            self._full.set()
+
+    async def close(self):
+        """ Sends everything still pending, e.g. on shutdown
+        """
+        while self.pending:
+            if not await self.flush():
+                self.logger.error(f'Could not acknowledge {len(self.pending)} events to Guru3 on shutdown.')
+                return
+
+    def stats(self):
+        return {'flushes': self.flushes, 'acked': self.acked, 'failed_flushes': self.failed_flushes,
+                'acks_per_flush': round(self.acked / self.flushes, 1) if self.flushes else 0,
+                'largest_flush': self.largest_flush, 'pending': len(self.pending)}
+
+
 class Guru3Mgr:
     def __init__(self, config: dict, event_queue: asyncio.Queue):
         self.config = config['guru3']
@@ -23,54 +115,173 @@ class Guru3Mgr:
         self.rest_url = f'http{tls}://{self.config["host"]}{port}/api/event/1/messages'
         self.ws_url = f'ws{tls}://{self.config["host"]}{port}/status/stream/'
         self.ws = None
+        self.ws_connected = False
+        self.reconnect_max_delay = self.config.get('reconnect_max_delay', 60)
+        self.poll_interval = self.config.get('poll_interval', 10)
+        self._poll_task = None
+
+        # one pooled HTTP session for all REST calls, created on first use inside the running event loop
+        self.http = None
+        self.timeout = aiohttp.ClientTimeout(total=self.config.get('request_timeout', 10))
+        self.max_connections = self.config.get('max_connections', 4)
+
+        # completed events are acknowledged in batches, see AckBatcher
+        self.acks = AckBatcher(self._send_acks,
+                               max_batch=self.config.get('ack_batch_size', 100),
+                               max_delay=self.config.get('ack_max_delay', 0.5),
+                               retry_delay=self.config.get('ack_retry_delay', 5))
+        self._ack_task = None
+
+        # websocket notifications only request a fetch; bursts of them are collapsed into one download
+        self.fetch_debounce = self.config.get('fetch_debounce', 0.2)
+        self._fetch_requested = asyncio.Event()
+        self._fetch_task = None
+        self.fetch_triggers = 0
+        self.fetches = 0
+        self.avoided_fetches = 0
+
+    def _session(self) -> aiohttp.ClientSession:
+        if self.http is None or self.http.closed:
+            self.http = aiohttp.ClientSession(headers=self.api_header, timeout=self.timeout,
+                                              connector=aiohttp.TCPConnector(limit=self.max_connections))
+        return self.http
+
+    async def close(self):
+        if self.http is not None:
+            await self.http.close()
+            self.http = None
 
     async def run(self, request_lock: asyncio.Lock):
         # wait for other relevant managers to start
         await request_lock.acquire()
+        self._ack_task = asyncio.create_task(self.acks.run())
         self.logger.info('Requesting Guru3 events now.')
-        # get events waiting in queue BEFORE websocket is live, so as not to trigger tons of requests
-        await self.request_events()
-
-        # start websocket
-        try:
-            self.ws = await websockets.connect(uri=self.ws_url, extra_headers=self.api_header)
-            self.logger.info('Websocket connection established.')
-        except asyncio.TimeoutError as exc:
-            raise exc
+        # the events already waiting in the queue are fetched once the websocket is up (see _listen), so that none
+        # queued in between go unnoticed; notifications arriving during that download are collapsed by trigger_fetch
+        self._fetch_task = asyncio.create_task(self._fetch_events())
+        self._poll_task = asyncio.create_task(self._poll_while_disconnected())
 
-        # start listening for events on websocket
         try:
-            while True:
-                # wait for new message and decode the JSON object
-                message = await self.ws.recv()
-                payload = json.loads(message)
-                action = payload['action']
-                if action != 'messagecount':
-                    raise KeyError(f"UNKNOWN ACTION! '{action}'")
-
-                # get message_count, and initiate get request if count > 0
-                queue_length = payload['queuelength']
-                if queue_length:
-                    await self.request_events()
+            await self._listen()
         except asyncio.CancelledError:
             pass
         finally:
-            await self.ws.close()
+            if self.ws is not None:
+                await self.ws.close()
+            self._poll_task.cancel()
+            self._fetch_task.cancel()
+            self.logger.info(f'Guru3 fetch stats: {self.fetch_stats()}')
+            self._ack_task.cancel()
+            await asyncio.gather(self._ack_task, return_exceptions=True)
+            await self.acks.close()
+            self.logger.info(f'Guru3 ack stats: {self.acks.stats()}')
+            await self.close()
+
+    async def _listen(self):
+        # keeps the websocket connected, reconnecting with backoff whenever it is lost
+        attempt = 0
+        while True:
+            try:
+                self.ws = await websockets.connect(uri=self.ws_url, extra_headers=self.api_header)
+            except (OSError, asyncio.TimeoutError, InvalidHandshake) as exc:
+                attempt += 1
+                delay = min(self.reconnect_max_delay, 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+                self.logger.warning(f'Websocket connection failed ({exc!r}), next attempt in {delay:.1f} seconds.')
+                if not self.fetch_triggers:
+                    # don't leave the events waiting since startup to the poll interval
+                    self.trigger_fetch()
+                await asyncio.sleep(delay)
+                continue
+            attempt = 0
+            self.ws_connected = True
+            self.logger.info('Websocket connection established.')
+            # events may have been queued while the socket was down, or before it came up: on the first connect this
+            # is the initial download of the queue
+            self.trigger_fetch()
+
+            # start listening for events on websocket
+            try:
+                async for message in self.ws:
+                    # decode the JSON object
+                    payload = json.loads(message)
+                    action = payload['action']
+                    if action != 'messagecount':
+                        raise KeyError(f"UNKNOWN ACTION! '{action}'")
+
+                    # get message_count, and initiate get request if count > 0
+                    queue_length = payload['queuelength']
+                    if queue_length:
+                        self.trigger_fetch()
+            except ConnectionClosed:
+                pass
+            finally:
+                self.ws_connected = False
+            self.logger.warning('Websocket connection lost, reconnecting.')
+
+    async def _poll_while_disconnected(self):
+        # without the websocket there are no notifications, fall back to polling the event queue
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            if not self.ws_connected:
+                self.trigger_fetch()
+
+    def trigger_fetch(self):
+        """ Requests a download of the Guru3 event queue
+
+        At most one download runs at a time and at most one more is pending; triggers arriving while one is pending
+        are served by it and counted as avoided fetches.
+        """
+        self.fetch_triggers += 1
+        if self._fetch_requested.is_set():
+            self.avoided_fetches += 1
+        self._fetch_requested.set()
+
+    async def _fetch_events(self):
+        while True:
+            await self._fetch_requested.wait()
+            # let the rest of a burst of notifications arrive
+            await asyncio.sleep(self.fetch_debounce)
+            self._fetch_requested.clear()
+            self.fetches += 1
+            try:
+                await self.request_events()
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as exc:
+                self.logger.error(f'Fetching Guru3 events failed: {exc!r}')
+            self.logger.debug(f'Guru3 fetch stats: {self.fetch_stats()}')
+
+    def fetch_stats(self):
+        return {'triggers': self.fetch_triggers, 'fetches': self.fetches, 'avoided_fetches': self.avoided_fetches}
 
     async def request_events(self):
         # GET request events from guru an decode them
-        events = json.loads(requests.get(self.rest_url, headers=self.api_header).content)
+        async with self._session().get(self.rest_url) as response:
+            response.raise_for_status()
+            events = json.loads(await response.read())
         for event in events:
             if event['id'] in self.event_queue_ids:
                 continue
             await self.event_queue.put(event)
             self.event_queue_ids.add(event['id'])
 
-    def mark_event_complete(self, event_id: int):
-        id_string = f'[{event_id}]'
-        response = requests.post(self.rest_url,
-                                 headers={**self.api_header, 'Content-Type': 'multipart/form-data; boundary=-'},
-                                 data=f'Content-Disposition: form-data; name="acklist"\r\n\r\n{id_string}\r\n---')
-        if response.status_code == 200:
-            self.logger.info(f'Successfully marked event {event_id} as done in Guru3.')
-            self.event_queue_ids.remove(event_id)
+    async def mark_event_complete(self, event_id: int):
+        # the ack itself is sent by the batcher, together with the ones of other events completed around the same time
+        self.acks.add(event_id)
+
+    async def _send_acks(self, event_ids: list):
+        id_string = json.dumps(event_ids, separators=(',', ':'))
+        try:
+            async with self._session().post(
+                    self.rest_url,
+                    headers={'Content-Type': 'multipart/form-data; boundary=-'},
+                    data=f'Content-Disposition: form-data; name="acklist"\r\n\r\n{id_string}\r\n---') as response:
+                status = response.status
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+            self.logger.error(f'Failed to mark {len(event_ids)} events as done in Guru3: {exc!r}')
+            return False
+        if status != 200:
+            self.logger.error(f'Guru3 answered {status} when marking {len(event_ids)} events as done.')
+            return False
+        self.logger.info(f'Successfully marked {len(event_ids)} events as done in Guru3: {id_string}')
+        self.event_queue_ids.difference_update(event_ids)
+        self.logger.debug(f'Guru3 ack stats: {self.acks.stats()}')
+        return True
@@ -0,0 +1,55 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+
+class LoopMonitor:
+    """ Measures how late the event loop wakes up a task that sleeps for `interval` seconds
+
+    The lag of every wakeup is kept for the last `window` samples. A lag above `warning` seconds means something ran on
+    the loop for that long without yielding and is logged right away; a summary is logged every `report_interval`
+    seconds.
+    """
+
+    def __init__(self, config: dict):
+        self.config = config['event_handler']
+        self.logger = logging.getLogger(__name__)
+        self.interval = self.config.get('loop_lag_interval', 0.1)
+        self.warning = self.config.get('loop_lag_warning', 0.1)
+        self.report_interval = self.config.get('loop_lag_report_interval', 300)
+        self.samples = deque(maxlen=self.config.get('loop_lag_window', 600))
+        self.max_lag = 0.0
+        self.warnings = 0
+
+    async def run(self):
+        try:
+            last_report = time.perf_counter()
+            while True:
+                started = time.perf_counter()
+                await asyncio.sleep(self.interval)
+                now = time.perf_counter()
+                lag = max(now - started - self.interval, 0.0)
+                self.samples.append(lag)
+                self.max_lag = max(self.max_lag, lag)
+                if lag > self.warning:
+                    self.warnings += 1
+                    self.logger.warning(f'Event loop was blocked for {lag * 1000:.0f} ms.')
+                if now - last_report >= self.report_interval:
+                    last_report = now
+                    self.logger.info(f'Event loop lag: {self.stats()}')
+        except asyncio.CancelledError:
+            pass
+
+    def stats(self):
+        """ Lag in milliseconds over the recent samples, plus the maximum and number of warnings since startup
+        """
+        if not self.samples:
+            return {'samples': 0}
+        ordered = sorted(self.samples)
+        return {'samples': len(ordered),
+                'avg_ms': round(sum(ordered) / len(ordered) * 1000, 2),
+                'p99_ms': round(ordered[min(int(len(ordered) * 0.99), len(ordered) - 1)] * 1000, 2),
+                'window_max_ms': round(ordered[-1] * 1000, 2),
+                'max_ms': round(self.max_lag * 1000, 2),
+                'warnings': self.warnings}
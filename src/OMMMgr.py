@@ -1,83 +1,482 @@
 import asyncio
+import contextlib
 import logging
+import time
 
-from python_mitel.OMMClient import OMMClient
-from python_mitel.types import PPUser
+from events import Events
+
+from python_mitel.AsyncOMMClient import AsyncOMMClient
+from python_mitel.OMMSessionPool import OMMSessionPool
+from python_mitel.types import PPDev, PPUser
 
 import utils
 
 
+def _version(record):
+    # the OMM bumps these whenever a record or its relations change
+    return record.timeStamp, record.timeStampAdmin, record.timeStampRelation
+
+
+class DirectoryCache(Events):
+    """ Local mirror of all OMM users and devices
+
+    Loaded once by a full scan (on the pool's scan session) and kept current through the OMM's PPUserCnf/PPDevCnf
+    events on the primary session, which trigger a re-fetch of the changed record. Users are indexed by uid, num and
+    hierarchy2 (token), devices by ppn and relType; users whose hierarchy1 carries the manager tag are additionally
+    indexed as managed users by num.
+
+    Refreshes of the same record share one fetch, and records hexidian writes are refreshed once by the writer instead
+    of again for every event the write causes, see :meth:`refresh_user` and :meth:`writing`.
+
+    `on_device_changed(device)` fires whenever a device is added or its relType changes, except during a full load.
+    """
+    __events__ = ('on_device_changed',)
+
+    def __init__(self, pool: OMMSessionPool, managed_tag: str, scan_concurrency: int):
+        Events.__init__(self)
+        self.pool = pool
+        self.logger = logging.getLogger(__name__)
+        self.managed_tag = managed_tag
+        self.scan_concurrency = scan_concurrency
+        self.users_by_uid: dict[str, PPUser] = {}
+        self.users_by_num: dict[str, PPUser] = {}
+        self.users_by_token: dict[str, PPUser] = {}
+        self.managed_users: dict[str, PPUser] = {}
+        self.devices_by_ppn: dict[str, PPDev] = {}
+        self.devices_by_reltype: dict[str, dict[str, PPDev]] = {}
+        # index keys each record was filed under, so a changed record can be removed from its old buckets
+        self._user_keys: dict[str, tuple] = {}
+        self._device_keys: dict[str, str] = {}
+        self._refreshes = set()
+        # per uid / ppn: (monotonic time it was sent, task) of the last fetch, see _fetch
+        self._user_fetches: dict[str, tuple] = {}
+        self._device_fetches: dict[str, tuple] = {}
+        # records hexidian is writing right now, they are refreshed once the write is done
+        self._writing_users: dict[str, int] = {}
+        self._writing_devices: dict[str, int] = {}
+        self._loading = False
+        self.pool.primary.on_PPUserCnf += self._on_user_event
+        self.pool.primary.on_PPDevCnf += self._on_device_event
+
+    async def load(self):
+        # subscribe first, so changes made while scanning are not missed
+        await self.pool.primary.subscribe_event('PPUserCnf')
+        await self.pool.primary.subscribe_event('PPDevCnf')
+        for index in (self.users_by_uid, self.users_by_num, self.users_by_token, self.managed_users,
+                      self.devices_by_ppn, self.devices_by_reltype, self._user_keys, self._device_keys,
+                      self._user_fetches, self._device_fetches):
+            index.clear()
+        self._loading = True
+        try:
+            await asyncio.gather(self._load_users(), self._load_devices())
+        finally:
+            self._loading = False
+        self.logger.info(f'Directory loaded: {len(self.users_by_uid)} users ({len(self.managed_users)} managed), '
+                         f'{len(self.devices_by_ppn)} devices.')
+
+    async def resync(self):
+        """ Brings the directory up to date after events may have been missed (e.g. while reconnecting)
+
+        This is still a full scan: every user and device is paged from the OMM again, as GetPPUser/GetPPDev cannot
+        be filtered by timestamp. The timestamps only save the local work, records whose OMM timestamps did not
+        change are kept as they are, so only changed, new and removed ones touch the indexes.
+        """
+        # the event subscriptions are restored by the reconnect itself
+        user_counts, device_counts = await asyncio.gather(
+            self._resync(self.pool.scan_session.scan_users(concurrency=self.scan_concurrency), self.users_by_uid,
+                         'uid', self.put_user, self.drop_user),
+            self.resync_devices())
+        self.logger.info('Directory resynced: users {} changed, {} removed; devices {} changed, {} removed.'.format(
+            *user_counts, *device_counts))
+
+    async def resync_devices(self):
+        """ Like :meth:`resync`, for the devices only
+
+        Returns:
+            A tuple of the number of changed or new and of removed devices.
+        """
+        return await self._resync(self.pool.scan_session.scan_devices(concurrency=self.scan_concurrency),
+                                  self.devices_by_ppn, 'ppn', self.put_device, self.drop_device)
+
+    @staticmethod
+    async def _resync(records, index, key, put, drop):
+        seen = set()
+        changed = 0
+        async for record in records:
+            record_key = str(getattr(record, key))
+            seen.add(record_key)
+            known = index.get(record_key)
+            if known is None or _version(known) != _version(record):
+                put(record)
+                changed += 1
+        removed = [record_key for record_key in index if record_key not in seen]
+        for record_key in removed:
+            drop(record_key)
+        return changed, len(removed)
+
+    async def _load_users(self):
+        async for user in self.pool.scan_session.scan_users(concurrency=self.scan_concurrency):
+            self.put_user(user)
+
+    async def _load_devices(self):
+        async for device in self.pool.scan_session.scan_devices(concurrency=self.scan_concurrency):
+            self.put_device(device)
+
+    def put_user(self, user: PPUser):
+        uid = str(user.uid)
+        self.drop_user(uid)
+        self.users_by_uid[uid] = user
+        keys = (user.num, user.hierarchy2, user.hierarchy1 == self.managed_tag)
+        num, token, managed = keys
+        if num:
+            self.users_by_num[num] = user
+            if managed:
+                self.managed_users[num] = user
+        if token:
+            self.users_by_token[token] = user
+        self._user_keys[uid] = keys
+
+    def drop_user(self, uid):
+        uid = str(uid)
+        user = self.users_by_uid.pop(uid, None)
+        if user is None:
+            return None
+        num, token, managed = self._user_keys.pop(uid)
+        # only remove index entries that still point to this very user
+        if self.users_by_num.get(num) is user:
+            del self.users_by_num[num]
+        if managed and self.managed_users.get(num) is user:
+            del self.managed_users[num]
+        if self.users_by_token.get(token) is user:
+            del self.users_by_token[token]
+        return user
+
+    def put_device(self, device: PPDev):
+        ppn = str(device.ppn)
+        changed = self._device_keys.get(ppn) != device.relType
+        self.drop_device(ppn)
+        self.devices_by_ppn[ppn] = device
+        self.devices_by_reltype.setdefault(device.relType, {})[ppn] = device
+        self._device_keys[ppn] = device.relType
+        if changed and not self._loading:
+            self.on_device_changed(device)
+
+    def drop_device(self, ppn):
+        ppn = str(ppn)
+        device = self.devices_by_ppn.pop(ppn, None)
+        if device is None:
+            return None
+        self.devices_by_reltype[self._device_keys.pop(ppn)].pop(ppn, None)
+        return device
+
+    def user(self, uid):
+        return self.users_by_uid.get(str(uid))
+
+    def user_by_num(self, num):
+        return self.users_by_num.get(num)
+
+    def user_by_token(self, token):
+        return self.users_by_token.get(token)
+
+    def device(self, ppn):
+        return self.devices_by_ppn.get(str(ppn))
+
+    def devices_with_reltype(self, rel_type):
+        return list(self.devices_by_reltype.get(rel_type, {}).values())
+
+    async def refresh_user(self, uid, since=None):
+        """ Re-reads a user from the OMM into the directory
+
+        Args:
+            uid: the user's uid
+            since (float): time.monotonic() of the change the result has to include, defaults to now. A fetch of the
+                same user that was sent after it and is still running or done is shared instead of sending another.
+
+        Returns:
+            The user, or None if the OMM does not know it (anymore).
+        """
+        return await self._fetch(self._user_fetches, str(uid), since, self._get_user)
+
+    async def refresh_device(self, ppn, since=None):
+        """ Re-reads a device from the OMM into the directory, see :meth:`refresh_user`
+        """
+        return await self._fetch(self._device_fetches, str(ppn), since, self._get_device)
+
+    async def _get_user(self, uid):
+        user = await self.pool.session().get_user(uid)
+        if user is None:
+            self.drop_user(uid)
+        else:
+            self.put_user(user)
+        return user
+
+    async def _get_device(self, ppn):
+        device = await self.pool.session().get_device(ppn)
+        if device is None:
+            self.drop_device(ppn)
+        else:
+            self.put_device(device)
+        return device
+
+    @staticmethod
+    async def _fetch(fetches, key, since, get):
+        # single flight: callers that need the record as of `since` share one GetPPUser/GetPPDev
+        now = time.monotonic()
+        entry = fetches.get(key)
+        if entry is None or entry[0] < (now if since is None else since):
+            task = asyncio.ensure_future(get(key))
+            entry = fetches[key] = (now, task)
+            # a failed fetch is not shared with later callers
+            task.add_done_callback(lambda done: fetches.pop(key, None)
+                                   if fetches.get(key) == entry and not done.cancelled() and done.exception()
+                                   else None)
+        return await asyncio.shield(entry[1])
+
+    @contextlib.contextmanager
+    def writing(self, uids=(), ppns=()):
+        """ Marks users and devices that hexidian is writing, use as `with directory.writing(...):`
+
+        The OMM reports hexidian's own changes with PPUserCnf/PPDevCnf events, usually before the response to the
+        write. Events for a marked record are not refreshed on their own, the writer refreshes it once the write is
+        done, which includes whatever the events reported.
+        """
+        marks = [(self._writing_users, str(uid)) for uid in uids] + [(self._writing_devices, str(ppn)) for ppn in ppns]
+        for writing, key in marks:
+            writing[key] = writing.get(key, 0) + 1
+        try:
+            yield
+        finally:
+            for writing, key in marks:
+                writing[key] -= 1
+                if not writing[key]:
+                    del writing[key]
+
+    def _on_user_event(self, message, attributes, children):
+        for record in self._event_records(children.get('user'), attributes):
+            if record.get('uid') is not None and record['uid'] not in self._writing_users:
+                self._schedule(self.refresh_user(record['uid']))
+
+    def _on_device_event(self, message, attributes, children):
+        for record in self._event_records(children.get('pp'), attributes):
+            if record.get('ppn') is not None and record['ppn'] not in self._writing_devices:
+                self._schedule(self.refresh_device(record['ppn']))
+
+    @staticmethod
+    def _event_records(child, attributes):
+        # an event may carry one record, several (a list) or only attributes on the message itself
+        if not child:
+            return [attributes]
+        return child if isinstance(child, list) else [child]
+
+    def _schedule(self, coro):
+        # event handlers are called synchronously by the client, keep a reference until the refresh is done
+        task = asyncio.create_task(coro)
+        self._refreshes.add(task)
+        task.add_done_callback(self._refresh_done)
+
+    def _refresh_done(self, task):
+        self._refreshes.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            # a lost connection is followed by a resync, which catches up on the missed change
+            self.logger.warning(f'Refreshing the directory after an OMM event failed: {task.exception()!r}')
+
+
 class OMMMgr:
     def __init__(self, config: dict):
         self.config = config['omm']
         self.logger = logging.getLogger(__name__)
-        self.omm = OMMClient(host=self.config['host'], port=self.config['port'])
+        self.pool = OMMSessionPool(host=self.config['host'], port=self.config['port'],
+                                   size=self.config.get('pool_size', 1))
         self.username = self.config['username']
         self.password = utils.read_password_env(self.config['password_env'])
-        self.users: dict[str, PPUser] = {}
+        self.scan_concurrency = self.config.get('scan_concurrency', 8)
+        self.directory = DirectoryCache(self.pool, managed_tag='GURU_MGR', scan_concurrency=self.scan_concurrency)
+        self.reconnect_max_delay = self.config.get('reconnect_max_delay', 60)
+        # set once the login and the initial user scan are done
+        self.ready = asyncio.Event()
+        self._supervisors = []
+        # PPs that are briefly unbound while being moved between users, not to be mistaken for new handsets
+        self.transferring_ppns = set()
+
+    @property
+    def omm(self) -> AsyncOMMClient:
+        # least busy session, pick it per request
+        return self.pool.session()
+
+    @property
+    def users(self) -> dict[str, PPUser]:
+        # OMM users managed by hexidian, by number
+        return self.directory.managed_users
 
     async def start_communication(self, request_lock: asyncio.Lock):
         try:
-            self.omm.login(user=self.username, password=self.password, ommsync=True)
-            self.read_users()
+            await self.pool.login(user=self.username, password=self.password, ommsync=True)
+            await self.read_users()
+            # lets the unbound PP handling react as soon as handsets may subscribe
+            await self.pool.primary.subscribe_event('DECTSubscriptionMode')
             request_lock.release()
+            self.ready.set()
             self.logger.info('OMM Login complete.')
+            self._supervisors = [asyncio.create_task(self._supervise(session)) for session in self.pool.sessions]
 
             while True:
-                self.omm.set_subscription("configured")
+                try:
+                    if self.pool.primary.connected:
+                        await self.pool.primary.set_subscription("configured")
+                    await self.pool.ping()
+                except (ConnectionError, asyncio.TimeoutError) as exc:
+                    # the session supervisors take care of reconnecting
+                    self.logger.warning(f'OMM keepalive failed: {exc!r}')
+                self.logger.debug(f'OMM session stats: {self.session_stats()}')
                 await asyncio.sleep(15)
         except asyncio.CancelledError:
             pass
         finally:
-            self.omm.logout()
-
-    def read_users(self):
-        self.logger.info(f'Fetching all OMM users managed by hexidian.')
-        self.users = {}
-        for user in self.omm.get_users():
-            # check if user is managed by guru-manager
-            if user.hierarchy1 != 'GURU_MGR':
-                continue
-            self.users[user.num] = user
-
-    def delete_user(self, number):
+            for task in self._supervisors:
+                task.cancel()
+            await asyncio.gather(*self._supervisors, return_exceptions=True)
+            await self.pool.logout()
+
+    async def _supervise(self, session: AsyncOMMClient):
+        # re-establishes a lost session; missed events are made up for by resyncing the directory
+        while True:
+            await session.wait_disconnected()
+            self.logger.warning('OMM session lost, reconnecting.')
+            attempts = await session.reconnect(max_delay=self.reconnect_max_delay)
+            self.logger.info(f'OMM session re-established after {attempts} attempt(s).')
+            if session is self.pool.primary:
+                await self._resync_directory(session)
+
+    async def _resync_directory(self, session: AsyncOMMClient):
+        # the cache stays stale until a resync succeeds, so keep trying with backoff while the session is up
+        delay = 1.0
+        while session.connected:
+            try:
+                await self.directory.resync()
+                return
+            except (ConnectionError, asyncio.TimeoutError) as exc:
+                self.logger.error(f'Directory resync failed: {exc!r}, retrying in {delay:.0f} s.')
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.reconnect_max_delay)
+
+    def session_stats(self):
+        return self.pool.stats()
+
+    async def read_users(self):
+        self.logger.info(f'Fetching all OMM users and devices.')
+        await self.directory.load()
+
+    async def delete_user(self, number):
         self.logger.info(f'Deleting OMM user {number}.')
         user = self.users[number]
-        del self.users[number]
-        self.omm.delete_user(user.uid)
+        self.directory.drop_user(user.uid)
+        await self.omm.delete_user(user.uid)
         return user
 
-    def update_user_info(self, number, name, token):
+    async def update_user_info(self, number, name, token):
         self.logger.info(f'Updating user info (name: {name}, token: {token}) for OMM user {number}.')
         user = self.users[number]
         user.name = name[:19]
         user.hierarchy2 = token
-        self.users[number] = user
-        self.omm.update_user(user)
+        self.directory.put_user(user)
+        await self.omm.update_user(user)
+        return user
+
+    async def update_sip_password(self, number, sip_password):
+        self.logger.info(f'Updating SIP password for OMM user {number}.')
+        user = self.users[number]
+        # the secret is encrypted with the key of the session it is sent on
+        session = self.omm
+        user.sipPw = session.encrypt_secret(sip_password)
+        await session.update_user(user)
         return user
 
-    def create_user(self, name, number, sip_user, sip_password, token=None):
+    async def create_user(self, name, number, sip_user, sip_password, token=None):
         self.logger.info(f'Creating OMM user "{name[:19]}" with number: {number}')
-        user_data = self.omm.create_user(name=name[:19],
-                                         number=number,
-                                         desc1='GURU_MGR',
-                                         desc2=token,
-                                         sip_user=sip_user,
-                                         sip_password=sip_password)
-        self.users[number] = self.omm.get_user(user_data['uid'])
-        return self.users[number]
-
-    def move_user(self, old_number, new_number):
+        # the uid is not known before, but the fetch triggered by the creation event can be shared
+        sent = time.monotonic()
+        user_data = await self.omm.create_user(name=name[:19],
+                                               number=number,
+                                               desc1='GURU_MGR',
+                                               desc2=token,
+                                               sip_user=sip_user,
+                                               sip_password=sip_password)
+        return await self.directory.refresh_user(user_data['uid'], since=sent)
+
+    async def create_users_bulk(self, users: list[dict]):
+        """ Creates many OMM users in one pipelined burst
+
+        Args:
+            users: dicts with the keyword arguments of :meth:`create_user`
+
+        Returns:
+            A dict mapping each number to its new PPUser, or to the exception (or None) if creating it failed.
+        """
+        self.logger.info(f'Creating {len(users)} OMM users.')
+        results = await self.omm.create_users([{'name': user['name'][:19],
+                                                'number': user['number'],
+                                                'desc1': 'GURU_MGR',
+                                                'desc2': user.get('token'),
+                                                'sip_user': user['sip_user'],
+                                                'sip_password': user['sip_password']} for user in users])
+        report = {}
+        for user, result in zip(users, results):
+            if isinstance(result, PPUser):
+                self.directory.put_user(result)
+            else:
+                self.logger.error(f'Failed to create OMM user {user["number"]}: {result!r}')
+            report[user['number']] = result
+        return report
+
+    async def move_user(self, old_number, new_number):
         self.logger.info(f'Moving OMM user from {old_number} to {new_number}.')
         user = self.users[old_number]
-        del self.users[old_number]
         user.num = new_number
         user.sipAuthId = new_number
-        self.users[new_number] = user
-        self.omm.update_user(user)
+        self.directory.put_user(user)
+        await self.omm.update_user(user)
         return user
 
-    def transfer_pp(self, from_uid: int, to_uid: int, ppn: int):
-        # transfer pp from one user to the other
-        self.omm.detach_user_device(uid=from_uid, ppn=ppn)
-        self.omm.attach_user_device(uid=to_uid, ppn=ppn)
+    async def attach_device(self, uid: int, ppn: int):
+        with self.directory.writing(uids=[uid], ppns=[ppn]):
+            attached = await self.omm.attach_user_device(uid=uid, ppn=ppn)
+        await asyncio.gather(self.directory.refresh_user(uid), self.directory.refresh_device(ppn))
+        if not attached:
+            raise RuntimeError(f'OMM did not attach PP {ppn} to user {uid}.')
+
+    async def delete_device(self, ppn: int):
+        device = self.directory.drop_device(ppn)
+        uids = [device.uid] if device is not None and int(device.uid or 0) else []
+        with self.directory.writing(uids=uids, ppns=[ppn]):
+            await self.omm.delete_device(ppn)
+        if uids:
+            await self.directory.refresh_user(uids[0])
+
+    async def transfer_pp(self, from_uid: int, to_uid: int, ppn: int):
+        """ Moves a PP from one user to the other
+
+        Returns:
+            True if the PP is attached to `to_uid` now, False if the OMM refused the detach or the attach.
+        """
+        self.transferring_ppns.add(ppn)
+        try:
+            with self.directory.writing(uids=[from_uid, to_uid], ppns=[ppn]):
+                return await self._transfer_pp(from_uid, to_uid, ppn)
+        finally:
+            try:
+                await asyncio.gather(self.directory.refresh_user(from_uid), self.directory.refresh_user(to_uid),
+                                     self.directory.refresh_device(ppn))
+            finally:
+                self.transferring_ppns.discard(ppn)
+
+    async def _transfer_pp(self, from_uid: int, to_uid: int, ppn: int):
+        if not await self.omm.detach_user_device(uid=from_uid, ppn=ppn):
+            self.logger.error(f'OMM did not detach PP {ppn} from user {from_uid}.')
+            return False
+        if not await self.omm.attach_user_device(uid=to_uid, ppn=ppn):
+            self.logger.error(f'OMM did not attach PP {ppn} to user {to_uid}, giving it back to user {from_uid}.')
+            # keep the handset reachable on its old user, so the registration can be tried again
+            if not await self.omm.attach_user_device(uid=from_uid, ppn=ppn):
+                self.logger.error(f'OMM did not attach PP {ppn} back to user {from_uid}, it is unbound now.')
+            return False
+        return True
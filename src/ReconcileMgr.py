@@ -0,0 +1,356 @@
+import asyncio
+import json
+import logging
+import os
+import time
+
+from aiohttp import web
+
+import utils
+from AsteriskMgr import OWN_CONTEXTS
+from python_mitel.types import PPUser
+
+
+class DesiredState:
+    """ What Guru3 wants the OMM and Asterisk to look like, built from the events it sends
+
+    Extensions and callgroups are kept by number as the data of their last UPDATE_EXTENSION and UPDATE_CALLGROUP
+    event. Everything Guru3 sends between SYNC_STARTED and SYNC_ENDED is the complete set of extensions, so at
+    SYNC_ENDED it replaces the state and the state becomes `complete`. Only a complete state is trusted to tell which
+    OMM users and Asterisk entries have to go. The state is kept in a JSON file, so it survives restarts.
+    """
+
+    def __init__(self, path):
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.extensions = {}
+        self.callgroups = {}
+        self.complete = False
+        self.synced_at = None
+        self.dirty = False
+        self._sync = None
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf8') as state_file:
+            state = json.load(state_file)
+        self.extensions = state['extensions']
+        self.callgroups = state['callgroups']
+        self.complete = state['complete']
+        self.synced_at = state['synced_at']
+        self.logger.info(f'Loaded the desired state of {len(self.extensions)} extensions '
+                         f'({"complete" if self.complete else "incomplete"}).')
+
+    async def save(self):
+        if not self.path or not self.dirty:
+            return
+        self.dirty = False
+        # serialize on the loop, where the state is changed, and only write the file in a thread
+        data = json.dumps({'complete': self.complete, 'synced_at': self.synced_at,
+                           'extensions': self.extensions, 'callgroups': self.callgroups})
+        await asyncio.to_thread(self._write, data)
+
+    def _write(self, data):
+        # the state holds SIP passwords, keep it private; write a new file and swap it in, so a crash never
+        # leaves a truncated state behind
+        temp_path = f'{self.path}.tmp'
+        with open(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w', encoding='utf8') as state_file:
+            state_file.write(data)
+        os.replace(temp_path, self.path)
+
+    def observe(self, event):
+        event_type = event['type']
+        event_data = event['data']
+        if event_type == 'SYNC_STARTED':
+            self._sync = ({}, {})
+            self.logger.info('Guru3 started a sync, collecting the complete set of extensions.')
+        elif event_type == 'SYNC_ENDED':
+            if self._sync is None:
+                self.logger.warning('Guru3 ended a sync that was not seen starting, keeping the current state.')
+                return
+            self.extensions, self.callgroups = self._sync
+            self._sync = None
+            self.complete = True
+            self.synced_at = time.time()
+            self.logger.info(f'Guru3 sync complete, {len(self.extensions)} extensions.')
+        else:
+            self._apply(self.extensions, self.callgroups, event_type, event_data)
+            if self._sync is not None:
+                self._apply(*self._sync, event_type, event_data)
+        self.dirty = True
+
+    @staticmethod
+    def _apply(extensions, callgroups, event_type, event_data):
+        if event_type == 'UPDATE_EXTENSION':
+            extensions[event_data['number']] = event_data
+        elif event_type == 'DELETE_EXTENSION':
+            extensions.pop(event_data['number'], None)
+            callgroups.pop(event_data['number'], None)
+        elif event_type == 'RENAME_EXTENSION':
+            old_number, new_number = event_data['old_extension'], event_data['new_extension']
+            if old_number in extensions:
+                extensions[new_number] = {**extensions.pop(old_number), 'number': new_number}
+            if old_number in callgroups:
+                callgroups[new_number] = {**callgroups.pop(old_number), 'number': new_number}
+        elif event_type == 'UPDATE_CALLGROUP':
+            callgroups[event_data['number']] = event_data
+
+
+class ReconcileMgr:
+    """ Brings the OMM and Asterisk in line with the desired state, independent of which events were missed
+
+    The current state is loaded in bulk: the OMM users managed by hexidian from the (resynced) directory cache,
+    endpoints, callgroups and callgroup members from Asterisk with one query each. Both are diffed against the
+    desired state in memory. DECT extensions without an OMM user are created in one batch: their Asterisk users in
+    one transaction, their OMM users with pipelined CreatePPUser requests. Every other number that differs is
+    repaired through the regular event handlers, at most `concurrency` numbers at a time. While a reconciliation
+    runs, the dispatching of Guru3 events is paused.
+    """
+
+    def __init__(self, config: dict, event_handler):
+        self.config = config.get('reconcile', {})
+        self.logger = logging.getLogger(__name__)
+        self.event_handler = event_handler
+        self.omm_mgr = event_handler.omm_mgr
+        self.asterisk_mgr = event_handler.asterisk_mgr
+        self.password_length = config['asterisk']['password_length']
+        self.interval = self.config.get('interval', 0)
+        self.on_startup = self.config.get('on_startup', True)
+        self.dry_run = self.config.get('dry_run', True)
+        self.concurrency = self.config.get('concurrency', 16)
+        self.save_interval = self.config.get('save_interval', 5)
+        self.ignore_prefixes = (self.asterisk_mgr.temp_numbers.prefix, *self.config.get('ignore_prefixes', []))
+        # callgroups carry no mark of who created them, so unknown ones are only deleted if allowed explicitly
+        self.delete_callgroups = self.config.get('delete_callgroups', False)
+        self.desired = DesiredState(self.config.get('state_file'))
+        self.desired.load()
+        self.preview_interval = self.config.get('preview_interval', 60)
+        self.last_report = {}
+        self._last_preview = float('-inf')
+        self._lock = asyncio.Lock()
+
+    def routes(self):
+        return [web.get('/reconcile', self.handle_report)]
+
+    async def run(self):
+        try:
+            await self.omm_mgr.ready.wait()
+            saver = asyncio.create_task(self._save_periodically())
+            try:
+                if self.on_startup:
+                    await self._reconcile_logged(self.dry_run)
+                while self.interval:
+                    await asyncio.sleep(self.interval)
+                    await self._reconcile_logged(self.dry_run)
+                await saver
+            finally:
+                saver.cancel()
+                await self.desired.save()
+        except asyncio.CancelledError:
+            pass
+
+    async def _save_periodically(self):
+        while True:
+            await asyncio.sleep(self.save_interval)
+            try:
+                await self.desired.save()
+            except OSError as exc:
+                self.desired.dirty = True
+                self.logger.error(f'Saving the desired state failed: {exc!r}')
+
+    async def _reconcile_logged(self, dry_run):
+        try:
+            await self.reconcile(dry_run)
+        except Exception:
+            self.logger.exception('Reconciliation failed.')
+
+    async def reconcile(self, dry_run=False):
+        """ Diffs the current against the desired state and, unless `dry_run`, repairs the differences
+
+        Returns:
+            The report, also kept as `last_report`: the numbers per kind of difference, how many of them were
+            repaired and failed, and how long loading, diffing and applying took.
+        """
+        async with self._lock, self.event_handler.dispatch_lock:
+            # let the events that were already dispatched finish, so nothing changes while we look
+            await asyncio.gather(*(shard.join() for shard in self.event_handler.shards))
+            started = time.perf_counter()
+            await self.omm_mgr.directory.resync()
+            current = await self._load_current()
+            loaded = time.perf_counter()
+            actions = self.diff(*current)
+            diffed = time.perf_counter()
+            failed = [] if dry_run else await self._apply(actions)
+            report = self._report(actions, dry_run, failed, started, loaded, diffed)
+        self.last_report = report
+        self.logger.info(f'Reconciliation{" (dry run)" if dry_run else ""}: {report["counts"]}, '
+                         f'{len(failed)} failed, load {report["load_s"]} s, diff {report["diff_s"]} s, '
+                         f'apply {report["apply_s"]} s.')
+        return report
+
+    async def preview(self):
+        """ A cheap dry run: diffs against the directory cache as it is, without rescanning the OMM and without
+        pausing the event dispatching, so numbers with events in flight may show up as differences
+        """
+        started = time.perf_counter()
+        current = await self._load_current()
+        loaded = time.perf_counter()
+        actions = self.diff(*current)
+        report = self._report(actions, True, [], started, loaded, time.perf_counter())
+        report['preview'] = True
+        self.last_report = report
+        return report
+
+    def _report(self, actions, dry_run, failed, started, loaded, diffed):
+        return {
+            'time': time.time(),
+            'dry_run': dry_run,
+            'complete': self.desired.complete,
+            'synced_at': self.desired.synced_at,
+            'extensions': len(self.desired.extensions),
+            'differences': {kind: sorted(numbers) for kind, numbers in actions.items()},
+            'counts': {kind: len(numbers) for kind, numbers in actions.items()},
+            'failed': sorted(failed),
+            'load_s': round(loaded - started, 3),
+            'diff_s': round(diffed - loaded, 3),
+            'apply_s': round(time.perf_counter() - diffed, 3),
+        }
+
+    async def _load_current(self):
+        endpoints, callgroups, members = await asyncio.gather(self.asterisk_mgr.fetch_endpoints(),
+                                                              self.asterisk_mgr.fetch_callgroups(),
+                                                              self.asterisk_mgr.fetch_all_callgroup_members())
+        return dict(self.omm_mgr.users), endpoints, callgroups, members
+
+    def _ignored(self, number):
+        return number.startswith(self.ignore_prefixes)
+
+    def diff(self, omm_users, endpoints, callgroups, members):
+        """ Sorts every number that differs from the desired state into one kind of repair
+
+        Args:
+            omm_users: managed OMM users by number
+            endpoints: (callerid, password, context) of every Asterisk endpoint by number
+            callgroups: name of every callgroup by number
+            members: set of member extensions of every callgroup by number
+
+        Returns:
+            A dict with the sets of numbers to `update` (their extension is replayed), to `delete` (everything under
+            that number is removed), whose leftover callgroup has to go (`stale_callgroup`) and whose callgroup members
+            have to be synced (`callgroup_members`). Only managed OMM users, endpoints in hexidian's own dialplan
+            contexts and, with `delete_callgroups`, callgroups are ever deleted; a number that also has an endpoint in
+            another context is left alone entirely.
+        """
+        desired = self.desired.extensions
+        actions = {'update': set(), 'delete': set(), 'stale_callgroup': set(), 'callgroup_members': set()}
+
+        for number, data in desired.items():
+            if self._ignored(number):
+                continue
+            ext_type = data['type']
+            user = omm_users.get(number)
+            endpoint = endpoints.get(number)
+            if ext_type == 'DECT':
+                name = utils.normalize_name(data['name'])
+                outdated = (user is None or endpoint is None or user.name != name[:19]
+                            or user.hierarchy2 != data['token'])
+            elif ext_type == 'SIP':
+                name = utils.normalize_name(data['name'])
+                outdated = user is not None or endpoint is None or endpoint[:2] != (name[:39], data['password'])
+            elif ext_type == 'GROUP':
+                outdated = user is not None or endpoint is not None or callgroups.get(number) != data['name']
+            else:
+                outdated = user is not None or endpoint is not None
+            if outdated:
+                actions['update'].add(number)
+            if ext_type != 'GROUP' and number in callgroups:
+                actions['stale_callgroup'].add(number)
+
+        for number, data in self.desired.callgroups.items():
+            active = {ext['extension'] for ext in data['extensions'] if ext['active']}
+            if number in desired and not self._ignored(number) and active != members.get(number, set()):
+                actions['callgroup_members'].add(number)
+
+        # without a complete state, a number we don't know may just be one whose events we never saw
+        if self.desired.complete:
+            own_endpoints = {number for number, endpoint in endpoints.items() if endpoint[2] in OWN_CONTEXTS}
+            foreign_endpoints = endpoints.keys() - own_endpoints
+            present = omm_users.keys() | own_endpoints | (callgroups.keys() if self.delete_callgroups else set())
+            actions['delete'] = {number for number in present - desired.keys() - foreign_endpoints
+                                 if not self._ignored(number)}
+        return actions
+
+    async def _apply(self, actions):
+        created = await self._create_dect_users([number for number in actions['update']
+                                                 if self.desired.extensions[number]['type'] == 'DECT'
+                                                 and number not in self.omm_mgr.users])
+        # all repairs of a number run in order, different numbers run concurrently
+        steps = {}
+        for number in actions['delete']:
+            steps.setdefault(number, []).append(
+                lambda number=number: self.event_handler.do_delete_extension({'number': number}))
+        for number in actions['stale_callgroup']:
+            steps.setdefault(number, []).append(
+                lambda number=number: self.asterisk_mgr.delete_callgroup(number))
+        for number in actions['update'] - created:
+            steps.setdefault(number, []).append(
+                lambda number=number: self.event_handler.do_update_extension(self.desired.extensions[number]))
+        for number in actions['callgroup_members']:
+            steps.setdefault(number, []).append(
+                lambda number=number: self.event_handler.do_update_callgroup(self.desired.callgroups[number]))
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def repair(number):
+            async with semaphore:
+                for step in steps[number]:
+                    await step()
+
+        numbers = list(steps)
+        results = await asyncio.gather(*(repair(number) for number in numbers), return_exceptions=True)
+        failed = []
+        for number, result in zip(numbers, results):
+            if isinstance(result, Exception):
+                failed.append(number)
+                self.logger.error(f'Reconciling number {number} failed: {result!r}')
+        return failed
+
+    async def _create_dect_users(self, numbers):
+        """ Creates new DECT extensions in bulk, like do_dect_extension_update would one by one
+
+        Returns:
+            The set of numbers that were created. The others are left to the regular repair, which also replaces an
+            Asterisk user whose OMM user could not be created.
+        """
+        if not numbers:
+            return set()
+        users = []
+        for number in numbers:
+            data = self.desired.extensions[number]
+            users.append({'name': utils.normalize_name(data['name']), 'number': number, 'token': data['token'],
+                          'sip_user': number,
+                          'sip_password': utils.create_password('alphanum', self.password_length)})
+        try:
+            async with self.asterisk_mgr.transaction() as transaction:
+                for user in users:
+                    # make sure that any existing SIP user is being deleted beforehand
+                    transaction.delete_user(number=user['number'])
+                    transaction.create_user(number=user['number'], name=user['name'],
+                                            sip_password=user['sip_password'])
+            results = await self.omm_mgr.create_users_bulk(users)
+        except Exception as exc:
+            self.logger.error(f'Creating {len(users)} DECT extensions in bulk failed: {exc!r}')
+            return set()
+        return {number for number, result in results.items() if isinstance(result, PPUser)}
+
+    async def handle_report(self, request):
+        # the route is unauthenticated: serve the last report, a fresh preview at most every preview_interval seconds
+        if 'refresh' in request.query:
+            wait = self._last_preview + self.preview_interval - time.monotonic()
+            if wait > 0:
+                return web.json_response({'error': 'too many refreshes', 'retry_after': round(wait)}, status=429,
+                                         headers={'Retry-After': str(int(wait) + 1)})
+            self._last_preview = time.monotonic()
+            return web.json_response(await self.preview())
+        return web.json_response(self.last_report)
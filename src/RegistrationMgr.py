@@ -36,7 +36,7 @@ class RegistrationMgr:
             return web.Response(text='NAK', status=417)
 
         # put json into queue and return 200 (OK)
-        ok = self.registration_callback(json_payload['callerid'], json_payload['token'])
+        ok = await self.registration_callback(json_payload['callerid'], json_payload['token'])
         if ok:
             return web.Response(text='extension added', status=200)
         else:
@@ -0,0 +1,140 @@
+import asyncio
+import csv
+import io
+import logging
+import time
+from array import array
+
+from aiohttp import web
+
+from OMMMgr import OMMMgr
+
+
+class SnapshotMgr:
+    """ Keeps the last action of every known PP in a columnar table and serves it over HTTP
+
+    Each column is a typed array indexed by row, `_rows` maps a ppn to its row. trType is stored as a small code into
+    `_tr_types`. Rows older than `max_age` seconds (or never fetched) are re-queried every `interval` seconds with
+    GetLastPPDevAction, at most `concurrency` of them at a time, on the pool's scan session.
+    """
+
+    def __init__(self, config: dict, omm_mgr: OMMMgr):
+        self.config = config.get('snapshot', {})
+        self.logger = logging.getLogger(__name__)
+        self.omm_mgr = omm_mgr
+        self.interval = self.config.get('interval', 60)
+        self.max_age = self.config.get('max_age', 300)
+        self.concurrency = self.config.get('concurrency', 16)
+
+        self._rows: dict[int, int] = {}
+        self.ppn = array('q')
+        self.tr_type = array('B')
+        self.rfp_id = array('q')
+        self.rel_time = array('q')
+        self.local_timestamp = array('d')
+        self._tr_types = ['']
+        self._tr_codes = {'': 0}
+        self.last_refresh = {}
+
+    def routes(self):
+        return [web.get('/snapshot', self.handle_json), web.get('/snapshot.csv', self.handle_csv)]
+
+    async def run(self):
+        try:
+            await self.omm_mgr.ready.wait()
+            while True:
+                try:
+                    await self.refresh()
+                except (ConnectionError, asyncio.TimeoutError) as exc:
+                    self.logger.warning(f'PP snapshot refresh failed: {exc!r}')
+                await asyncio.sleep(self.interval)
+        except asyncio.CancelledError:
+            pass
+
+    async def refresh(self):
+        started = time.time()
+        self._sync_rows()
+        stale = [self.ppn[row] for row in range(len(self.ppn))
+                 if started - self.local_timestamp[row] >= self.max_age]
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def fetch(ppn):
+            async with semaphore:
+                action = await self.omm_mgr.pool.scan_session.get_last_pp_dev_action(ppn)
+            self._store(ppn, action)
+
+        results = await asyncio.gather(*(fetch(ppn) for ppn in stale), return_exceptions=True)
+        failed = [result for result in results if isinstance(result, Exception)]
+        self.last_refresh = {'time': started, 'duration': round(time.time() - started, 3),
+                             'pps': len(self.ppn), 'queried': len(stale), 'failed': len(failed)}
+        self.logger.info(f'PP snapshot refreshed: {self.last_refresh}')
+        if failed:
+            self.logger.warning(f'First failed GetLastPPDevAction: {failed[0]!r}')
+
+    def _sync_rows(self):
+        # adds rows for new devices and removes the rows of devices the OMM no longer knows
+        known = {int(ppn) for ppn in self.omm_mgr.directory.devices_by_ppn}
+        for ppn in [ppn for ppn in self._rows if ppn not in known]:
+            self._remove(ppn)
+        for ppn in known:
+            if ppn not in self._rows:
+                self._rows[ppn] = len(self.ppn)
+                self.ppn.append(ppn)
+                self.tr_type.append(0)
+                self.rfp_id.append(-1)
+                self.rel_time.append(-1)
+                self.local_timestamp.append(0.0)
+
+    def _remove(self, ppn):
+        # move the last row into the gap, so the columns stay dense
+        row = self._rows.pop(ppn)
+        last = len(self.ppn) - 1
+        if row != last:
+            for column in self._columns():
+                column[row] = column[last]
+            self._rows[self.ppn[row]] = row
+        for column in self._columns():
+            column.pop()
+
+    def _columns(self):
+        return self.ppn, self.tr_type, self.rfp_id, self.rel_time, self.local_timestamp
+
+    def _store(self, ppn, action):
+        row = self._rows.get(ppn)
+        if row is None:
+            return
+        if action is None:
+            self.tr_type[row] = 0
+            self.rfp_id[row] = -1
+            self.rel_time[row] = -1
+            self.local_timestamp[row] = time.time()
+            return
+        tr_type = action.trType or ''
+        code = self._tr_codes.get(tr_type)
+        if code is None:
+            code = self._tr_codes[tr_type] = len(self._tr_types)
+            self._tr_types.append(tr_type)
+        self.tr_type[row] = code
+        self.rfp_id[row] = int(action.rfpId) if action.rfpId is not None else -1
+        self.rel_time[row] = int(action.relTime) if action.relTime is not None else -1
+        self.local_timestamp[row] = action.localTimeStamp
+
+    def records(self):
+        """ Yields one dict per PP, -1 (or an empty trType) marks values the OMM did not report
+        """
+        for row in range(len(self.ppn)):
+            yield {'ppn': self.ppn[row],
+                   'trType': self._tr_types[self.tr_type[row]],
+                   'rfpId': self.rfp_id[row],
+                   'relTime': self.rel_time[row],
+                   'localTimeStamp': self.local_timestamp[row]}
+
+    async def handle_json(self, _):
+        return web.json_response({'refresh': self.last_refresh, 'pps': list(self.records())})
+
+    async def handle_csv(self, _):
+        output = io.StringIO()
+        writer = csv.DictWriter(output, fieldnames=['ppn', 'trType', 'rfpId', 'relTime', 'localTimeStamp'])
+        writer.writeheader()
+        writer.writerows(self.records())
+        return web.Response(text=output.getvalue(), content_type='text/csv')
@@ -0,0 +1,871 @@
+import asyncio
+import logging
+import random
+import ssl
+from collections import deque
+from xml.parsers.expat import ExpatError
+
+from events import Events
+
+from .types import LastPPAction, PPDev, PPUser
+from .utils import encrypt_pin
+from .messagehelper import FrameBuffer, construct_frame, parse_message
+
+
+class AsyncOMMClient(Events):
+    """ asyncio counterpart of :class:`OMMClient`
+
+    All requests share one TLS connection and may be in flight at the same time. Responses are matched to the
+    awaiting request by their name and ``seq`` attribute, requests without ``seq`` are matched in FIFO order.
+    The public methods mirror :class:`OMMClient`, but are coroutines (or async generators for the scans).
+
+    If the connection drops, all requests in flight fail with ConnectionError and :meth:`wait_disconnected` returns;
+    :meth:`reconnect` then logs in again with backoff and restores the event subscriptions.
+    """
+    __events__ = ('on_RFPState', 'on_HealthState', 'on_DECTSubscriptionMode', 'on_PPDevCnf', 'on_PPUserCnf')
+
+    def __init__(self, host, port=12622, timeout=30):
+        """ Initializes a new asyncio OMM Client using destination address and port
+
+        Args:
+            host (str): address of the server running OMM
+            port (int): port the OMM service is listening
+            timeout (float): seconds to wait for a response before the connection is considered dead
+        """
+        Events.__init__(self)
+        self.logger = logging.getLogger(__name__)
+        self._host = host
+        self._port = port
+        self._timeout = timeout
+        self._ssl_context = ssl.SSLContext(protocol=ssl.PROTOCOL_TLSv1_2)
+        self._ssl_context.set_ciphers('DEFAULT')
+        self._reader = None
+        self._writer = None
+        self._write_lock = asyncio.Lock()
+        self._receiver = None
+        self._frames = FrameBuffer()
+        self._pending = {}
+        self._sequence = 0
+        self._modulus = None
+        self._exponent = None
+        self._logged_in = False
+        self._credentials = None
+        self._subscriptions = []
+        self._disconnected = asyncio.Event()
+        self.omm_status = {}
+        self.omm_versions = {}
+        self.in_flight = 0
+        self.requests = 0
+        self.latency = 0.0  # moving average of the request round trip time in seconds
+
+    def _get_sequence(self):
+        sequence = self._sequence
+        self._sequence += 1
+        return sequence
+
+    async def _sendrequest(self, message, messagedata=None, children=None):
+        msg = construct_frame(message, messagedata, children)
+        responsemessage = message + "Resp"
+        if messagedata is not None and "seq" in messagedata:
+            responsemessage += str(messagedata["seq"])
+        if self._writer is None or self._writer.is_closing():
+            raise ConnectionError("OMMClient is not connected")
+        loop = asyncio.get_running_loop()
+        response = loop.create_future()
+        self._pending.setdefault(responsemessage, deque()).append(response)
+        started = loop.time()
+        self.in_flight += 1
+        try:
+            async with self._write_lock:
+                self._writer.write(msg)
+                await self._writer.drain()
+            return await asyncio.wait_for(response, self._timeout)
+        except asyncio.TimeoutError:
+            # a response that never comes means the session is stuck, drop it so it gets re-established
+            self.logger.error(f'No response to {message} within {self._timeout} seconds, aborting connection.')
+            self._abort()
+            raise
+        finally:
+            self.in_flight -= 1
+            self.requests += 1
+            self.latency += (loop.time() - started - self.latency) * 0.1
+
+    def stats(self):
+        """ Returns the number of requests in flight and completed, and the average round trip time in ms
+        """
+        return {
+            "connected": self._logged_in,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "latency_ms": round(self.latency * 1000, 2)
+        }
+
+    async def _receive(self):
+        try:
+            while True:
+                data = await self._reader.read(65536)
+                if not data:
+                    raise ConnectionError("OMM closed the connection")
+                for frame in self._frames.feed(data):
+                    try:
+                        self._dispatch(frame)
+                    except ExpatError as exc:
+                        self.logger.error(f'Discarding malformed OMM message: {exc}')
+        except OSError as exc:
+            self.logger.error(f'Connection to OMM lost: {exc!r}')
+        finally:
+            self._logged_in = False
+            self._abort()
+            self._fail_pending(ConnectionError("connection to OMM lost"))
+            self._disconnected.set()
+
+    def _abort(self):
+        if self._writer is not None and not self._writer.is_closing():
+            self._writer.transport.abort()
+
+    def _dispatch(self, frame):
+        message, attributes, children = parse_message(frame)
+        if message.startswith("Event"):
+            self._emit(message, attributes, children)
+            return
+        if "seq" in attributes:
+            message += attributes["seq"]
+        waiters = self._pending.get(message)
+        if not waiters:
+            self.logger.warning(f'Discarding unexpected OMM message {message}.')
+            return
+        response = waiters.popleft()
+        if not waiters:
+            del self._pending[message]
+        if not response.done():
+            response.set_result((message, attributes, children))
+
+    def _emit(self, message, attributes, children):
+        handler = "on_" + message[len("Event"):]
+        if handler not in self.__events__:
+            return
+        # a failing subscriber must not end the receiver, which would abort the session and every pending request
+        for target in getattr(self, handler):
+            try:
+                target(message, attributes, children)
+            except Exception:
+                self.logger.exception(f'Handler {target!r} failed on {message}.')
+
+    def _fail_pending(self, exc):
+        pending, self._pending = self._pending, {}
+        for waiters in pending.values():
+            for response in waiters:
+                if not response.done():
+                    response.set_exception(exc)
+
+    async def login(self, user, password, ommsync=False):
+        """ login to OMM with given credentials
+
+        See :meth:`OMMClient.login` for the difference between the OMP and the OMM-Sync login.
+
+        Args:
+            user (str): Username to be used to login
+            password (str): Password to be used to login
+            ommsync (bool): If True login as OMM-Sync client
+        """
+        messagedata = {
+            "protocolVersion": "45",
+            "username": user,
+            "password": password
+        }
+        if ommsync is True:
+            messagedata["UserDeviceSyncClient"] = "true"
+        else:
+            messagedata["OMPClient"] = "1"
+        self._credentials = (user, password, ommsync)
+        self._reader, self._writer = await asyncio.wait_for(asyncio.open_connection(
+            self._host, self._port, ssl=self._ssl_context, server_hostname=self._host), self._timeout)
+        self._frames.clear()
+        self._disconnected.clear()
+        self._receiver = asyncio.create_task(self._receive())
+        message, attributes, children = await self._sendrequest("Open", messagedata)
+        self._modulus = children["publicKey"]["modulus"]
+        self._exponent = children["publicKey"]["exponent"]
+        self.omm_status = attributes
+        self.omm_versions = await self.get_versions()
+        self._logged_in = True
+
+    @property
+    def connected(self):
+        return self._logged_in
+
+    async def wait_disconnected(self):
+        """ Returns once the connection to the OMM is lost (immediately, if it is not established)
+        """
+        await self._disconnected.wait()
+
+    async def reconnect(self, initial_delay=1.0, max_delay=60.0):
+        """ Logs in again with the credentials of the last login, retrying with exponential backoff
+
+        Event subscriptions made before are restored. The asyncio TLS transport has no way to resume the previous TLS
+        session, so every attempt does a full handshake.
+
+        Args:
+            initial_delay (float): seconds to wait after the first failed attempt
+            max_delay (float): upper limit for the wait between attempts
+
+        Returns:
+            The number of attempts it took.
+        """
+        if self._credentials is None:
+            raise Exception("OMMClient was never logged in")
+        attempt = 0
+        while True:
+            attempt += 1
+            await self.logout()
+            try:
+                await self.login(*self._credentials)
+                for event in self._subscriptions:
+                    await self._sendrequest("Subscribe", {}, {"e": {"cmd": "On", "eventType": event}})
+                return attempt
+            except Exception as exc:
+                # also covers the OMM rejecting the login while it is still starting up
+                delay = min(max_delay, initial_delay * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+                self.logger.warning(f'Reconnecting to OMM failed ({exc!r}), next attempt in {delay:.1f} seconds.')
+                await asyncio.sleep(delay)
+
+    def _ensure_login(self):
+        if not self._logged_in:
+            raise Exception("OMMClient not logged in")
+
+    async def get_account(self, uid):
+        """ Get System Account
+
+        Args:
+            uid:
+        """
+        self._ensure_login()
+        message, attributes, children = await self._sendrequest("GetAccount", {"id": uid})
+        return attributes
+
+    async def subscribe_event(self, event):
+        """ Subscribes to any event specified
+
+        Unlike :class:`OMMClient`, accessing an ``on_*`` handler does not subscribe implicitly.
+
+        Args:
+            event:
+        """
+        self._ensure_login()
+        await self._sendrequest("Subscribe", {}, {"e": {"cmd": "On", "eventType": event}})
+        if event not in self._subscriptions:
+            self._subscriptions.append(event)
+
+    async def get_sari(self):
+        """ Fetches the configured SARI
+
+        Returns:
+            Configured SARI for the OMM system
+        """
+        self._ensure_login()
+        message, attributes, children = await self._sendrequest("GetSARI")
+        return attributes.get("sari")
+
+    async def get_systemname(self):
+        """ Fetches the OMM system name
+
+        Returns:
+            The OMMs configured system name.
+        """
+        self._ensure_login()
+        message, attributes, children = await self._sendrequest("GetSystemName")
+        return attributes.get("name")
+
+    async def get_limits(self):
+        """ Fetches maximum Numbers for RFPs, users ect.
+
+        Returns:
+            A dict containing all limitations for the different types.
+        """
+        self._ensure_login()
+        message, attributes, children = await self._sendrequest("Limits")
+        return attributes
+
+    async def get_versions(self):
+        """ Fetches the OMM supported protocol versions for all calls.
+
+        Returns:
+            A dict containing protocol versions for all available calls.
+        """
+        message, attributes, children = await self._sendrequest("GetVersions")
+        return attributes
+
+    async def set_subscription(self, mode, timeout=None):
+        """ Set DECT Subscription Mode (Modes are: off, configured, wildcard)
+
+        Args:
+            mode (str): one of off, configured, wildcard
+            timeout (int): The time after that the wildcard mode disables, required for wildcard mode.
+
+        Returns:
+            True if parameters are ok, False if the parameters are faulty
+        """
+        modes = {
+            "OFF": "Off",
+            "WILDCARD": "Wildcard",
+            "CONFIGURED": "Configured"
+        }
+        messagedata = {}
+
+        if mode is None or mode.upper() not in modes:
+            return False
+
+        messagedata["mode"] = modes[mode.upper()]
+
+        if mode.upper() == "WILDCARD":
+            if timeout is None:
+                return False
+            else:
+                messagedata["timeout"] = timeout
+
+        await self._sendrequest("SetDECTSubscriptionMode", messagedata)
+        return True
+
+    async def set_user_pin(self, uid, pin):
+        """ reset a user profiles PIN
+
+        Args:
+            uid (int): user profile id
+            pin (str): PIN to set
+
+        Returns:
+            True if successful, False if the request failed
+        """
+        messagedata = {
+            "user": {
+                "uid": uid,
+                "pin": encrypt_pin(pin, self._modulus, self._exponent)
+            }
+        }
+        message, attributes, children = await self._sendrequest(
+            "SetPPUser", {"seq": str(self._get_sequence())}, messagedata)
+        return len(children) > 0 and children["user"] is not None
+
+    async def get_device(self, ppn):
+        """ get device configuration data
+
+        Args:
+            ppn (int): device id inside OMM
+
+        Returns:
+            Device object if successful, None if not
+        """
+        message, attributes, children = await self._sendrequest("GetPPDev", {"seq": self._get_sequence(), "ppn": ppn})
+        if children is not None and "pp" in children and children["pp"] is not None \
+                and children["pp"]["ppn"] == str(ppn):
+            return PPDev(self, children["pp"])
+        else:
+            return None
+
+    async def get_devices(self, start_ppn=0):
+        """ get all device data records
+
+        Args:
+            start_ppn (int): the lowest PP (handheld device) id to fetch
+
+        Returns:
+            An async generator that yields device records, one at a time.
+        """
+        MAX_RECORDS = 20  # maximum possible request size, according to the AXI documentation
+        while True:
+            message, attributes, children = await self._sendrequest(
+                "GetPPDev",
+                {"seq": self._get_sequence(), "ppn": start_ppn, "maxRecords": MAX_RECORDS})
+            if children is None or "pp" not in children or not children["pp"]:
+                break
+
+            if not isinstance(children['pp'], list):
+                children['pp'] = [children['pp']]
+
+            for child in children['pp']:
+                yield PPDev(self, child)
+
+            if len(children['pp']) == MAX_RECORDS:
+                # response was as large as it could be, so maybe there are more records
+                start_ppn = int(children['pp'][-1]['ppn']) + 1
+            else:
+                break
+
+    async def scan_devices(self, span=1024, concurrency=8):
+        """ get all device data records, fetching several ppn ranges concurrently
+
+        The ppn space is split into ranges of `span` ids which are paged through by up to `concurrency` pipelined
+        requests at a time. Records are yielded as soon as they arrive, so they are NOT ordered by ppn.
+
+        Args:
+            span (int): number of ppns per range
+            concurrency (int): maximum number of ranges fetched at the same time
+
+        Returns:
+            An async generator that yields device records, one at a time.
+        """
+        async for device in self._scan("GetPPDev", "ppn", "pp", 20, PPDev, span, concurrency):
+            yield device
+
+    async def find_devices(self, search_attrs, start_ppn=0):
+        """ get device data records that match a given set of attributes
+
+        Args:
+            search_attrs (dict): one or multiple attributes that the device records need to match
+            start_ppn (int): (optional) the lowest PP (handheld device) id to fetch
+
+        Returns:
+            An async generator that yields device records, one at a time.
+        """
+        async for device in self.get_devices(start_ppn):
+            if all(getattr(device, attr) == value for attr, value in search_attrs.items()):
+                yield device
+
+    async def find_device(self, search_attrs, start_ppn=0):
+        """ get the first device data record that matches a given set of attributes
+
+        Args:
+            search_attrs (dict): one or multiple attributes that the device record needs to match
+            start_ppn (int): (optional) the lowest PP (handheld device) id to fetch
+
+        Returns:
+            A device record if a match was found, None otherwise.
+        """
+        async for device in self.find_devices(search_attrs, start_ppn):
+            return device
+        return None
+
+    async def get_users(self, start_uid=0):
+        """ get all user data records
+
+        Args:
+            start_uid (int): the lowest user profile id to fetch
+
+        Returns:
+            An async generator that yields user records, one at a time.
+        """
+        MAX_RECORDS = 3  # maximum possible request size, according to the AXI documentation
+        while True:
+            message, attributes, children = await self._sendrequest(
+                "GetPPUser",
+                {"seq": self._get_sequence(), "uid": start_uid, "maxRecords": MAX_RECORDS})
+            if children is None or "user" not in children or not children["user"]:
+                break
+
+            if not isinstance(children['user'], list):
+                children['user'] = [children['user']]
+
+            for child in children['user']:
+                yield PPUser(self, child)
+
+            if len(children['user']) == MAX_RECORDS:
+                # response was as large as it could be, so maybe there are more records
+                start_uid = int(children['user'][-1]['uid']) + 1
+            else:
+                break
+
+    async def scan_users(self, span=256, concurrency=8):
+        """ get all user data records, fetching several uid ranges concurrently
+
+        The uid space is split into ranges of `span` ids which are paged through by up to `concurrency` pipelined
+        requests at a time. Records are yielded as soon as they arrive, so they are NOT ordered by uid.
+
+        Args:
+            span (int): number of uids per range
+            concurrency (int): maximum number of ranges fetched at the same time
+
+        Returns:
+            An async generator that yields user records, one at a time.
+        """
+        async for user in self._scan("GetPPUser", "uid", "user", 3, PPUser, span, concurrency):
+            yield user
+
+    async def _scan(self, message, key, child_name, max_records, record_type, span, concurrency):
+        records = asyncio.Queue(maxsize=concurrency * max_records * 4)
+        next_range = 0
+        end_of_space = None  # no records exist at or above this id
+
+        async def fetch_ranges():
+            nonlocal next_range, end_of_space
+            while end_of_space is None or next_range * span < end_of_space:
+                start = next_range * span
+                stop = start + span
+                next_range += 1
+                while True:
+                    _, _, children = await self._sendrequest(
+                        message, {"seq": self._get_sequence(), key: start, "maxRecords": max_records})
+                    page = children.get(child_name) if children else None
+                    if not page:
+                        end_of_space = start if end_of_space is None else min(start, end_of_space)
+                        break
+                    if not isinstance(page, list):
+                        page = [page]
+                    first, last = int(page[0][key]), int(page[-1][key])
+                    if first >= stop:
+                        # everything between start and the first record is empty, don't hand out those ranges
+                        next_range = max(next_range, first // span)
+                        break
+                    for child in page:
+                        if int(child[key]) >= stop:
+                            break
+                        await records.put(record_type(self, child))
+                    if len(page) < max_records:
+                        # a short page is the last one
+                        end_of_space = last + 1 if end_of_space is None else min(last + 1, end_of_space)
+                        break
+                    if last + 1 >= stop:
+                        break
+                    start = last + 1
+
+        async def supervise():
+            try:
+                await asyncio.gather(*fetchers)
+            finally:
+                await records.put(None)
+
+        fetchers = [asyncio.create_task(fetch_ranges()) for _ in range(concurrency)]
+        supervisor = asyncio.create_task(supervise())
+        try:
+            while (record := await records.get()) is not None:
+                yield record
+            # re-raise a failed request
+            await supervisor
+        finally:
+            for task in fetchers:
+                task.cancel()
+            supervisor.cancel()
+
+    async def find_users(self, search_attrs, start_uid=0):
+        """ get user data records that match a given set of attributes
+
+        Args:
+            search_attrs (dict): one or multiple attributes that the user records need to match
+            start_uid (int): (optional) the lowest user profile id to fetch
+
+        Returns:
+            An async generator that yields user records, one at a time.
+        """
+        async for user in self.get_users(start_uid):
+            if all(getattr(user, attr) == value for attr, value in search_attrs.items()):
+                yield user
+
+    async def find_user(self, search_attrs, start_uid=0):
+        """ get the first user data record that matches a given set of attributes
+
+        Args:
+            search_attrs (dict): one or multiple attributes that the user record needs to match
+            start_uid (int): (optional) the lowest user profile id to fetch
+
+        Returns:
+            A user record if a match was found, None otherwise.
+        """
+        async for user in self.find_users(search_attrs, start_uid):
+            return user
+        return None
+
+    async def get_user(self, uid):
+        """ get user configuration data
+
+        Args:
+            uid (int): user profile id
+
+        Returns:
+            The users profile if the request is successful, None otherwise.
+        """
+        message, attributes, children = await self._sendrequest("GetPPUser", {"seq": self._get_sequence(), "uid": uid})
+        if children is not None and "user" in children and children["user"] is not None \
+                and children["user"]["uid"] == str(uid):
+            return PPUser(self, children["user"])
+        else:
+            return None
+
+    async def get_last_pp_dev_action(self, ppn):
+        """ get last action of PP device
+
+        Args:
+            ppn (int): id of the PP
+
+        Returns:
+            A LastPPAction object if the AXI query was successful, None otherwise.
+        """
+        message, attributes, children = await self._sendrequest(
+            "GetLastPPDevAction", {"seq": self._get_sequence(), "ppn": ppn})
+        if children is not None and "pp" in children and children["pp"]:
+            return LastPPAction(self, children["pp"])
+        else:
+            return None
+
+    async def set_user_relation_dynamic(self, uid):
+        """ Convert a fixed device-user relation into a dynamic one
+
+        Args:
+            uid (int): user profile id
+
+        Returns:
+            The user profile's attributes if successful, False if the request failed.
+        """
+        messagedata = {
+            "seq": self._get_sequence(),
+            "uid": uid,
+            "relType": "Dynamic"
+        }
+        message, attributes, children = await self._sendrequest("SetPPUserDevRelation", messagedata)
+        if attributes is not None:
+            return attributes
+        else:
+            return False
+
+    async def set_user_relation_fixed(self, uid):
+        """ Convert a user-device relation into fixed type
+
+        Args:
+            uid (int): user profile id
+
+        Returns:
+            The user profile's attributes if successful, False if the request failed.
+        """
+        messagedata = {
+            "seq": self._get_sequence(),
+            "uid": uid,
+            "relType": "Fixed"
+        }
+        message, attributes, children = await self._sendrequest("SetPPUserDevRelation", messagedata)
+        if attributes is not None:
+            return attributes
+        else:
+            return False
+
+    async def detach_user_device(self, uid: int, ppn: int):
+        """ detaches an user profile from an existing device
+
+        Requires an OMM-Sync login.
+
+        Args:
+            uid (int): user profile id
+            ppn (int): registered device id
+
+        Returns:
+            True if the operation was successful. False if it failed.
+        """
+        if (type(uid) is not int or type(ppn) is not int) or (ppn <= 0 or uid <= 0):
+            return False
+        messagedata = {
+            "pp": {
+                "uid": 0,
+                "relType": "Unbound",
+                "ppn": ppn
+            },
+            "user": {
+                "uid": uid,
+                "relType": "Unbound",
+                "ppn": 0
+            }
+        }
+        message, attributes, children = await self._sendrequest("SetPP", {"seq": self._get_sequence()}, messagedata)
+        return children is not None and "pp" in children and children["pp"]["uid"] == str(uid)
+
+    async def attach_user_device(self, uid: int, ppn: int):
+        """ Connects an existing user profile to an existing subscribed device
+
+        Requires an OMM-Sync login.
+
+        Args:
+            uid (int): user profile id
+            ppn (int): registered device id
+
+        Returns:
+            True if the operation was successful. False if it failed.
+        """
+        if (type(uid) is not int or type(ppn) is not int) or (ppn <= 0 or uid <= 0):
+            return False
+        messagedata = {
+            "pp": {
+                "uid": uid,
+                "relType": "Dynamic",
+                "ppn": ppn
+            },
+            "user": {
+                "uid": uid,
+                "relType": "Dynamic",
+                "ppn": ppn
+            }
+        }
+        message, attributes, children = await self._sendrequest("SetPP", {"seq": self._get_sequence()}, messagedata)
+        return children is not None and "pp" in children and children["pp"]["uid"] == str(uid)
+
+    async def ping(self):
+        """ Pings OMM and awaits response
+
+        """
+        self._ensure_login()
+        await self._sendrequest("Ping", {})
+
+    async def create_user(self, name, number, desc1=None, desc2=None, login=None, pin="", sip_user=None,
+                          sip_password=None):
+        """ Creates new user
+
+        See :meth:`OMMClient.create_user` for the meaning of the parameters.
+
+        Returns:
+            A dict containing data of the new user object if successful, None if it failed.
+        """
+        user = self._new_user_attributes(name, number, desc1, desc2, login, pin, sip_user, sip_password)
+        message, attributes, children = await self._sendrequest(
+            "CreatePPUser", {"seq": self._get_sequence()}, {"user": user})
+        if children is not None and "user" in children:
+            return children["user"]
+        else:
+            return None
+
+    async def create_users(self, users):
+        """ Creates many users at once
+
+        All CreatePPUser requests are pipelined on the connection. The returned records are built from what was sent
+        and what the OMM answered, so no GetPPUser round trip is needed per user.
+
+        Args:
+            users (list[dict]): keyword arguments of :meth:`create_user`, one dict per user
+
+        Returns:
+            A list in the order of `users`, holding the new PPUser on success, None if the OMM refused the user or
+            the exception the request raised.
+        """
+        async def create(spec):
+            sent = self._new_user_attributes(**spec)
+            message, attributes, children = await self._sendrequest(
+                "CreatePPUser", {"seq": self._get_sequence()}, {"user": sent})
+            if children is None or "user" not in children:
+                return None
+            # don't keep the encrypted secrets around, the OMM never sends them back either
+            sent.pop("pin", None)
+            sent.pop("sipPw", None)
+            return PPUser(self, {**sent, **children["user"]})
+
+        return await asyncio.gather(*(create(spec) for spec in users), return_exceptions=True)
+
+    def encrypt_secret(self, secret):
+        """ Encrypts a PIN or SIP password with this session's public key, as the OMM expects it in SetPPUser
+        """
+        return encrypt_pin(secret, self._modulus, self._exponent)
+
+    def _new_user_attributes(self, name, number, desc1=None, desc2=None, login=None, pin="", sip_user=None,
+                             sip_password=None):
+        user = {
+            "name": name,
+            "num": number
+        }
+        if desc1:
+            user["hierarchy1"] = desc1
+        if desc2:
+            user["hierarchy2"] = desc2
+        if login:
+            user["addId"] = login
+        if pin:
+            user["pin"] = encrypt_pin(pin, self._modulus, self._exponent)
+        if sip_user:
+            user["sipAuthId"] = sip_user
+        if sip_password:
+            user["sipPw"] = encrypt_pin(sip_password, self._modulus, self._exponent)
+        return user
+
+    async def delete_user(self, uid):
+        """ Delete a configured user (uid)
+
+        .. note:: This operation cannot be undone!
+
+        Args:
+            uid (int): user id of the user to be deleted (>0)
+        """
+        self._ensure_login()
+        await self._sendrequest("DeletePPUser", {"uid": uid, "seq": str(self._get_sequence())})
+
+    async def update_user(self, user):
+        """ Updates a configured user by the changes done to the previously fetched PPUser object
+
+        Only attributes that changed are sent. They are cleared once the OMM acknowledged them, so a user without
+        pending changes costs no round trip.
+
+        Args:
+            user (PPUser): the changed user
+
+        Returns:
+            True if successful, False otherwise.
+        """
+        changes = dict(user.changes)
+        if not changes:
+            return True
+        messagedata = {
+            "user": {**changes, 'uid': user.uid}
+        }
+        message, attributes, children = await self._sendrequest(
+            "SetPPUser", {"seq": str(self._get_sequence())}, messagedata)
+        if len(children) > 0 and children["user"] is not None:
+            user.clear_changes(changes)
+            return True
+        return False
+
+    async def update_users(self, users):
+        """ Writes the pending changes of many users at once
+
+        All SetPPUser requests are pipelined on the connection instead of waiting for each response in turn.
+
+        Args:
+            users (Iterable[PPUser]): changed users, users without pending changes are skipped
+
+        Returns:
+            A dict mapping each written uid to True/False (see :meth:`update_user`) or the exception it raised.
+        """
+        dirty = [user for user in users if user.changes]
+        results = await asyncio.gather(*(self.update_user(user) for user in dirty), return_exceptions=True)
+        return {user.uid: result for user, result in zip(dirty, results)}
+
+    async def delete_device(self, ppid):
+        """ Delete a configured handset (pp)
+
+        .. note:: This operation can not be undone!
+
+        Args:
+            ppid (int): id of the PP to be deleted (>0)
+        """
+        self._ensure_login()
+        await self._sendrequest("DeletePPDev", {"ppn": str(ppid), "seq": str(self._get_sequence())})
+
+    async def get_device_state(self, ppn):
+        """ Fetches the current state of a PP
+
+        Args:
+            ppn (int): id of the PP to get the current state for
+
+        Returns:
+            A PPDev containing the devices state information, None if the request failed.
+        """
+        self._ensure_login()
+        message, attributes, children = await self._sendrequest(
+            "GetPPState", {"ppn": str(ppn), "seq": str(self._get_sequence())})
+        if children is not None and "pp" in children and children["pp"] is not None \
+                and children["pp"]["ppn"] == str(ppn):
+            return PPDev(self, children["pp"])
+        else:
+            return None
+
+    async def logout(self):
+        """ Logout from OMM
+
+        Closes the connection and fails all requests still waiting for a response.
+        Login can be called any time to reuse the client object for further calls.
+        """
+        self._logged_in = False
+        if self._receiver is not None:
+            self._receiver.cancel()
+            try:
+                await self._receiver
+            except asyncio.CancelledError:
+                pass
+            self._receiver = None
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except OSError:
+                pass
+            self._writer = None
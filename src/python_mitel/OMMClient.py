@@ -1,11 +1,11 @@
 import logging
 from threading import Thread, Event, Lock
-from time import sleep
 from events import Events
 
 from .types import LastPPAction, PPDev, PPUser
 from .utils import encrypt_pin
-from .messagehelper import construct_message, parse_message
+from .messagehelper import FrameBuffer, construct_frame, parse_message
+import selectors
 import socket
 import ssl
 import queue
@@ -23,6 +23,10 @@ class OMMClient(Events):
     _recv_q = None
     _worker = None
     _dispatcher = None
+    _selector = None
+    _frames = None
+    _wakeup_r = None
+    _wakeup_w = None
     _sequence = 0
     _sequencelock = Lock()
     _terminate = False
@@ -49,8 +53,14 @@ class OMMClient(Events):
         self._ssl_context = ssl.SSLContext(protocol=ssl.PROTOCOL_TLSv1_2)
         self._ssl_context.set_ciphers('DEFAULT')
         self._ssl_socket = self._ssl_context.wrap_socket(self._tcp_socket, server_hostname=self._host)
-        self._send_q = queue.Queue()  # should contains strings (not bytes)
-        self._recv_q = queue.Queue()  # should contains strings (not bytes)
+        self._send_q = queue.Queue()  # contains serialized, NUL-terminated messages (bytes)
+        self._recv_q = queue.Queue()  # contains complete frames (bytes)
+        # the worker sleeps in select() on the OMM socket and this pair, so queued requests can wake it up at once
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self._selector = selectors.DefaultSelector()
+        self._frames = FrameBuffer()
         self._worker = Thread(target=self._work)
         self._worker.daemon = True
         self._dispatcher = Thread(target=self._dispatch)
@@ -76,15 +86,17 @@ class OMMClient(Events):
             self._sequence += 1
         return sequence
 
-    def _awaitresponse(self, message):
-        if message in self._events:
-            raise Exception("Already waiting for "+message)
-        e = Event()
+    def _expectresponse(self, message):
+        # register the waiter before the request leaves, the response may be dispatched before we get to wait()
         with self._eventlock:
+            if message in self._events:
+                raise Exception("Already waiting for "+message)
             self._events[message] = {}
-            self._events[message]["event"] = e
+            self._events[message]["event"] = Event()
+
+    def _awaitresponse(self, message):
         self._events[message]["event"].wait()
-        data = parse_message(self._events[message]["response"])
+        data = self._events[message]["response"]
         with self._eventlock:
             self._events.pop(message)
         return data
@@ -100,11 +112,13 @@ class OMMClient(Events):
         Returns:
 
         """
-        msg = construct_message(message, messagedata, children)
-        self._send_q.put(msg)
+        msg = construct_frame(message, messagedata, children)
         responsemssage = message+"Resp"
         if messagedata is not None and "seq" in messagedata:
             responsemssage += str(messagedata["seq"])
+        self._expectresponse(responsemssage)
+        self._send_q.put(msg)
+        self._wakeup()
         return self._awaitresponse(responsemssage)
 
     def login(self, user, password, ommsync=False):
@@ -343,7 +357,7 @@ class OMMClient(Events):
         for device in self.get_devices(start_ppn):
             matched = True
             for attr in search_attrs:
-                if device.__getattr__(attr) != search_attrs[attr]:
+                if getattr(device, attr) != search_attrs[attr]:
                     matched = False
             if matched:
                 yield device
@@ -410,7 +424,7 @@ class OMMClient(Events):
         for user in self.get_users(start_uid):
             matched = True
             for attr in search_attrs:
-                if user.__getattr__(attr) != search_attrs[attr]:
+                if getattr(user, attr) != search_attrs[attr]:
                     matched = False
             if matched:
                 yield user
@@ -668,15 +682,22 @@ class OMMClient(Events):
 
     def update_user(self, user):
         """ Updates a configured user by the changes done to the previously fetched PPUser object
-        :param user: user id of the user to be deleted (>0)
+
+        Only attributes that changed are sent, they are cleared once the OMM acknowledged them.
+
+        :param user: the changed user
         :type user: PPUser
-        :return: None
+        :return: True if successful (or nothing to write), False otherwise
         """
+        changes = dict(user.changes)
+        if not changes:
+            return True
         messagedata = {
-            "user": {**user.changes, 'uid': user.uid}
+            "user": {**changes, 'uid': user.uid}
         }
         message, attributes, children = self._sendrequest("SetPPUser", {"seq": str(self._get_sequence())}, messagedata)
         if len(children) > 0 and children["user"] is not None:
+            user.clear_changes(changes)
             return True
         else:
             return False
@@ -714,36 +735,76 @@ class OMMClient(Events):
         else:
             return None
 
+    def _wakeup(self):
+        try:
+            self._wakeup_w.send(b'\0')
+        except (BlockingIOError, OSError):
+            # wakeup pipe is already full (worker will wake anyway) or closed during logout
+            pass
+
     def _work(self):
+        self._selector.register(self._ssl_socket, selectors.EVENT_READ)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ)
         while not self._terminate:
-            if not self._send_q.empty():
+            for key, _ in self._selector.select():
+                if key.fileobj is self._wakeup_r:
+                    try:
+                        while self._wakeup_r.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    self._flush_send_q()
+                elif not self._receive():
+                    self._terminate = True
+                    break
+            # requests may have been queued while we were busy receiving
+            self._flush_send_q()
+        self._recv_q.put(None)
+
+    def _flush_send_q(self):
+        while True:
+            try:
                 item = self._send_q.get(block=False)
-                self._ssl_socket.send(item.encode('utf8') + b'\0')
-                self._send_q.task_done()
-            self._ssl_socket.settimeout(0.1)
-            data = None
+            except queue.Empty:
+                return
+            self._ssl_socket.sendall(item)
+            self._send_q.task_done()
+
+    def _receive(self):
+        """ Reads everything currently available on the OMM socket into the receive queue
+
+        Returns:
+            False if the OMM closed the connection, True otherwise.
+        """
+        while True:
             try:
                 data = self._ssl_socket.recv(65536)
             except socket.timeout:
-                continue
-            if data:
-                self._recv_q.put(data.decode('utf8'))
+                return True
+            if not data:
+                return False
+            for frame in self._frames.feed(data):
+                self._recv_q.put(frame)
+            # select() only sees the raw socket, so drain records OpenSSL has already decrypted
+            if not self._ssl_socket.pending():
+                return True
 
     def _dispatch(self):
         while not self._terminate:
-            sleep(0.1)
-            if not self._recv_q.empty():
-                item = self._recv_q.get(block=False)
-                message, attributes, children = parse_message(item)
-                if message == "EventDECTSubscriptionMode":
-                    self.on_DECTSubscriptionMode(message, attributes, children)
-                    continue
-                if "seq" in attributes:
-                    message += attributes["seq"]
-                with self._eventlock:
-                    if message in self._events:
-                        self._events[message]["response"] = item
-                        self._events[message]["event"].set()
+            item = self._recv_q.get()
+            if item is None:
+                break
+            name, attributes, children = parse_message(item)
+            if name == "EventDECTSubscriptionMode":
+                self.on_DECTSubscriptionMode(name, attributes, children)
+                continue
+            message = name
+            if "seq" in attributes:
+                message += attributes["seq"]
+            with self._eventlock:
+                if message in self._events:
+                    self._events[message]["response"] = name, attributes, children
+                    self._events[message]["event"].set()
 
     def logout(self):
         """ Logout from OMM
@@ -754,8 +815,15 @@ class OMMClient(Events):
         """
         self._logged_in = False
         self._terminate = True
-        self._worker.join()
-        self._dispatcher.join()
+        self._wakeup()
+        self._recv_q.put(None)
+        if self._worker.is_alive():
+            self._worker.join()
+        if self._dispatcher.is_alive():
+            self._dispatcher.join()
+        self._selector.close()
+        self._wakeup_r.close()
+        self._wakeup_w.close()
         self._ssl_socket.close()
 
     def __del__(self):
@@ -0,0 +1,57 @@
+import asyncio
+
+from .AsyncOMMClient import AsyncOMMClient
+
+
+class OMMSessionPool:
+    """ A fixed number of AsyncOMMClient sessions to the same OMM, logged in with the same credentials
+
+    Requests are meant to go to the session returned by :meth:`session`, which is the one with the fewest requests in
+    flight. With more than one session, the last one is kept free for long scans (:attr:`scan_session`) so they don't
+    delay interactive requests. Event subscriptions belong on :attr:`primary`. While a session is disconnected, requests
+    are routed to the connected ones.
+    """
+
+    def __init__(self, host, port=12622, size=1):
+        """ Creates the (not yet connected) sessions
+
+        Args:
+            host (str): address of the server running OMM
+            port (int): port the OMM service is listening
+            size (int): number of sessions
+        """
+        self.sessions = [AsyncOMMClient(host=host, port=port) for _ in range(max(size, 1))]
+        self._interactive = self.sessions[:-1] if len(self.sessions) > 1 else self.sessions
+
+    @property
+    def primary(self) -> AsyncOMMClient:
+        return self.sessions[0]
+
+    @property
+    def scan_session(self) -> AsyncOMMClient:
+        if self.sessions[-1].connected:
+            return self.sessions[-1]
+        return self.session()
+
+    def session(self) -> AsyncOMMClient:
+        """ Returns the least busy connected session that is not reserved for scans
+        """
+        candidates = [session for session in self._interactive if session.connected]
+        if not candidates:
+            # fall back to the scan session, or to a disconnected one that raises a meaningful error
+            candidates = [session for session in self.sessions if session.connected] or self._interactive
+        return min(candidates, key=lambda session: session.in_flight)
+
+    async def login(self, user, password, ommsync=False):
+        await asyncio.gather(*(session.login(user, password, ommsync) for session in self.sessions))
+
+    async def logout(self):
+        await asyncio.gather(*(session.logout() for session in self.sessions))
+
+    async def ping(self):
+        await asyncio.gather(*(session.ping() for session in self.sessions if session.connected))
+
+    def stats(self):
+        """ Returns :meth:`AsyncOMMClient.stats` for every session, in pool order
+        """
+        return [session.stats() for session in self.sessions]
@@ -1,55 +1,151 @@
-from xml.dom.minidom import getDOMImplementation
-from xml.dom.minidom import parseString
+from functools import lru_cache
+from xml.parsers import expat
+
+MAX_CHILDREN = 5000
 
 
 def parse_message(messagedata):
-    xml_data = parseString(messagedata.rstrip('\0'))
-    root = xml_data.documentElement
-    name = root.tagName
-    attributes = {}
-    children = {}
-    for i in range(0, root.attributes.length):
-        item = root.attributes.item(i)
-        attributes[item.name] = item.value
+    """ Parses one AXI message into its name, its attributes and the attributes of its child elements
 
-    child = root.firstChild
+    Args:
+        messagedata (bytes | str): a single message, optionally NUL-terminated
+
+    Returns:
+        A tuple (name, attributes, children). Children are keyed by their tag name, tags that occur more than once
+        map to a list of attribute dicts. Grandchildren and text content are ignored.
+    """
+    if isinstance(messagedata, str):
+        messagedata = messagedata.encode('utf8')
+    root = []
+    children = {}
+    depth = 0
     child_num = 0
-    while child is not None and child_num < 5000:
-        child_num += 1
-
-        new_child = {}
-        for i in range(0, child.attributes.length):
-            item = child.attributes.item(i)
-            new_child[item.name] = item.value
-
-        childname = child.tagName
-        if childname in children:
-            # this is a multi-value attribute, i.e. a list
-            # if there is only one element at the moment, wrap it in a list so we can add more
-            if not isinstance(children[childname], list):
-                children[childname] = [children[childname]]
-            children[childname].append(new_child)
-        else:
-            children[childname] = new_child
-
-        child = child.nextSibling
 
+    def start_element(tag, attributes):
+        nonlocal depth, child_num
+        depth += 1
+        if depth == 1:
+            root.append(tag)
+            root.append(attributes)
+        elif depth == 2 and child_num < MAX_CHILDREN:
+            child_num += 1
+            if tag in children:
+                # this is a multi-value attribute, i.e. a list
+                # if there is only one element at the moment, wrap it in a list so we can add more
+                if not isinstance(children[tag], list):
+                    children[tag] = [children[tag]]
+                children[tag].append(attributes)
+            else:
+                children[tag] = attributes
+
+    def end_element(_):
+        nonlocal depth
+        depth -= 1
+
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.Parse(messagedata.rstrip(b'\0'), True)
+    name, attributes = root
     return name, attributes, children
 
 
+def _escape(value):
+    value = str(value)
+    if '&' in value:
+        value = value.replace('&', '&amp;')
+    if '<' in value:
+        value = value.replace('<', '&lt;')
+    if '>' in value:
+        value = value.replace('>', '&gt;')
+    if '"' in value:
+        value = value.replace('"', '&quot;')
+    if '\n' in value or '\r' in value or '\t' in value:
+        # keep whitespace from being normalized to spaces by the receiving XML parser
+        value = value.replace('\n', '&#10;').replace('\r', '&#13;').replace('\t', '&#9;')
+    return value
+
+
+@lru_cache(maxsize=256)
+def _element_template(name, keys, empty):
+    """ Returns a format string for the opening (or empty) tag of an element with the given attribute names
+    """
+    attrs = ''.join(f' {key}="{{}}"' for key in keys)
+    return f'<{name}{attrs}/>' if empty else f'<{name}{attrs}>'
+
+
+def _element(name, attributes, empty):
+    if not attributes:
+        return _element_template(name, (), empty)
+    return _element_template(name, tuple(map(str, attributes)), empty).format(*map(_escape, attributes.values()))
+
+
 def construct_message(name, attributes=None, children=None):
-    if attributes is None:
-        attributes = {}
-    impl = getDOMImplementation()
-    message = impl.createDocument(None, name, None)
-    root_element = message.documentElement
-    for key, val in list(attributes.items()):
-        root_element.setAttribute(str(key), str(val))
-    if children is not None:
-        for key, val in list(children.items()):
-            new_child = message.createElement(key)
-            if val is not None:
-                for attr_key, attr_val in list(val.items()):
-                    new_child.setAttribute(str(attr_key), str(attr_val))
-            root_element.appendChild(new_child)
-    return root_element.toxml()
+    """ Serializes an AXI message
+
+    Args:
+        name (str): message (root element) name
+        attributes (dict): attributes of the root element
+        children (dict): child element name mapped to its attributes (or None)
+
+    Returns:
+        The message as XML string, without the terminating NUL byte.
+    """
+    if not children:
+        return _element(name, attributes, True)
+    parts = [_element(name, attributes, False)]
+    for key, val in children.items():
+        parts.append(_element(key, val, True))
+    parts.append(f'</{name}>')
+    return ''.join(parts)
+
+
+def construct_frame(name, attributes=None, children=None):
+    """ Serializes an AXI message into the NUL-terminated bytes that go onto the wire
+
+    Takes the same arguments as :func:`construct_message`.
+    """
+    return construct_message(name, attributes, children).encode('utf8') + b'\0'
+
+
+class FrameBuffer:
+    """ Reassembles NUL-terminated AXI messages from a TCP byte stream
+
+    A single read may carry a fraction of a message or several messages at once, so received data is collected in
+    one reusable bytearray and only complete frames (without their terminating NUL byte) are handed out.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._scanned = 0  # bytes at the start of the buffer already known to contain no NUL
+
+    def feed(self, data):
+        """ Appends received data and returns all frames completed by it
+
+        Args:
+            data (bytes): chunk read from the socket
+
+        Returns:
+            A list of complete frames (bytes), in stream order.
+        """
+        buffer = self._buffer
+        buffer += data
+        frames = []
+        start = 0
+        end = buffer.find(0, self._scanned)
+        if end != -1:
+            with memoryview(buffer) as view:
+                while end != -1:
+                    frames.append(bytes(view[start:end]))
+                    start = end + 1
+                    end = buffer.find(0, start)
+            # dropping the consumed head of a bytearray only moves its start offset
+            del buffer[:start]
+        self._scanned = len(buffer)
+        return frames
+
+    def clear(self):
+        """ Drops any partially received frame, e.g. after the connection was reset
+        """
+        self._buffer.clear()
+        self._scanned = 0
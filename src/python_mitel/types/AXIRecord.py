@@ -0,0 +1,113 @@
+_MISSING = object()
+
+
+class AXIRecord:
+    """ Base class of the AXI record types (PPUser, PPDev, LastPPAction)
+
+    Subclasses declare the attributes the OMM usually sends in `_fields`, each of them is stored in a slot and reads as
+    None while unset. Anything else the OMM sends is kept in a dict that is only created when such an attribute shows
+    up. `_key` names the identifying attribute, which cannot be changed once set.
+
+    Attributes set after construction are tracked as pending changes (see :attr:`changes`) if they differ from the
+    current value. Records are meant to be used from one thread (or one asyncio loop) and do no locking.
+    """
+    __slots__ = ('_ommclient', '_changes', '_original', '_extra')
+    _fields = ()
+    _fieldset = frozenset()
+    _key = None
+
+    def __init__(self, ommclient, attributes=None):
+        object.__setattr__(self, "_ommclient", ommclient)
+        object.__setattr__(self, "_changes", None)
+        object.__setattr__(self, "_original", None)
+        object.__setattr__(self, "_extra", None)
+        if attributes is not None:
+            self._init_from_attributes(attributes)
+
+    def __getattr__(self, item):
+        # only called for unset slots and attributes that are not declared at all
+        if item in self._fieldset:
+            return None
+        extra = object.__getattribute__(self, "_extra")
+        if extra is not None and item in extra:
+            return extra[item]
+        raise AttributeError(f"{type(self).__name__} has no attribute {item}")
+
+    def __setattr__(self, key, value):
+        current = getattr(self, key, None)
+        if key == self._key and current is not None:
+            raise Exception(f"Cannot change {key} !")
+        if current == value:
+            return
+        if self._changes is None:
+            object.__setattr__(self, "_changes", {})
+            object.__setattr__(self, "_original", {})
+        original = self._original.get(key, _MISSING)
+        if original is _MISSING:
+            self._original[key] = current
+            self._changes[key] = value
+        elif original == value:
+            # set back to the value last read from the OMM, nothing to write anymore
+            del self._original[key]
+            del self._changes[key]
+        else:
+            self._changes[key] = value
+        self._store(key, value)
+
+    def _store(self, key, value):
+        if key in self._fieldset:
+            object.__setattr__(self, key, value)
+        else:
+            if self._extra is None:
+                object.__setattr__(self, "_extra", {})
+            self._extra[key] = value
+
+    def _init_from_attributes(self, attributes):
+        fieldset = self._fieldset
+        store = object.__setattr__
+        extra = None
+        for key, val in attributes.items():
+            if key in fieldset:
+                store(self, key, val)
+            else:
+                if extra is None:
+                    extra = self._extra if self._extra is not None else {}
+                extra[key] = val
+        if extra is not None:
+            store(self, "_extra", extra)
+
+    @property
+    def changes(self):
+        """ attributes that differ from the values last read from or acknowledged by the OMM """
+        return self._changes if self._changes is not None else {}
+
+    def clear_changes(self, acknowledged=None):
+        """ Forgets pending changes, e.g. after the OMM acknowledged them
+
+        Args:
+            acknowledged (dict): the changes that were written; attributes changed again since are kept pending.
+                All changes are dropped if omitted.
+        """
+        if self._changes is None:
+            return
+        if acknowledged is None:
+            self._changes.clear()
+            self._original.clear()
+            return
+        for key, value in acknowledged.items():
+            if self._changes.get(key, value) == value:
+                self._changes.pop(key, None)
+                self._original.pop(key, None)
+
+    def get_attributes(self):
+        """ Returns all attributes that are set, as a dict
+        """
+        attributes = {}
+        for key in self._fields:
+            try:
+                attributes[key] = object.__getattribute__(self, key)
+            except AttributeError:
+                pass
+        if self._extra is not None:
+            attributes.update(self._extra)
+        return attributes
@@ -1,7 +1,7 @@
-from threading import Lock
+from .AXIRecord import AXIRecord
 
 
-class PPDev:
+class PPDev(AXIRecord):
     """
     :type _ommclient: OMMClient
     :param _ommclient: OMM Client
@@ -15,60 +15,16 @@ class PPDev:
     :param ppnOld: last device id assigned
     :type ppnOld: int
     """
-    ac = None
-    uid = None
-    timeStampSubscription = None
-    ppn = None
-    ppnSec = None
-    capBluetooth = None
-    ppDefaultProfileLoaded = None
-    timeStampAdmin = None
-    encrypt = None
-    ommIdAck = None
-    subscribeToPARIOnly = None
-    timeStamp = None
-    ommId = None
-    modicType = None
-    subscriptionId = None
-    ppProfileCapability = None
-    relType = None
-    ethAddr = None
-    timeStampRelation = None
-    timeStampRoaming = None
-    capEnhLocating = None
-    capMessaging = None
-    dectIeFixedId = None
-    roaming = None
-    autoCreate = None
-    ipei = None
-    uak = None
-    hwType = None
-    s = None
-    capMessagingForInternalUse = None
-    locationData = None
-    _ommclient = None
-    _changes = None
-    _changelock = Lock()
-
-    def __init__(self, ommclient, attributes=None):
-        self.__dict__["_ommclient"] = ommclient
-        self.__dict__["_changes"] = {}
-        if attributes is not None:
-            self._init_from_attributes(attributes)
+    _fields = (
+        'ac', 'uid', 'timeStampSubscription', 'ppn', 'ppnSec', 'capBluetooth', 'ppDefaultProfileLoaded',
+        'timeStampAdmin', 'encrypt', 'ommIdAck', 'subscribeToPARIOnly', 'timeStamp', 'ommId', 'modicType',
+        'subscriptionId', 'ppProfileCapability', 'relType', 'ethAddr', 'timeStampRelation', 'timeStampRoaming',
+        'capEnhLocating', 'capMessaging', 'dectIeFixedId', 'roaming', 'autoCreate', 'ipei', 'uak', 'hwType', 's',
+        'capMessagingForInternalUse', 'locationData',
+    )
+    __slots__ = _fields
+    _fieldset = frozenset(_fields)
+    _key = "ppn"
 
     def __repr__(self):
         return self.ipei
-
-    def __getattr__(self, item):
-        return self.__dict__[item]
-
-    def __setattr__(self, key, value):
-        if key == "ppn" and "ppn" in self.__dict__:
-            raise Exception("Cannot change ppn !")
-        with self._changelock:
-            self._changes[key] = value
-            self.__dict__[key] = value
-
-    def _init_from_attributes(self, attributes):
-        for key, val in list(attributes.items()):
-            self.__dict__[key] = val
@@ -1,7 +1,7 @@
-from threading import Lock
+from .AXIRecord import AXIRecord
 
 
-class PPUser:
+class PPUser(AXIRecord):
     """
     :type _ommclient: OMMClient
     :param _ommclient: OMM Client
@@ -15,110 +15,25 @@ class PPUser:
     :param ppnOld: last device id assigned
     :type ppnOld: int
     """
-    msgRight = None
-    uid = None
-    pin = None
-    recvVcardRight = None
-    ppn = None
-    useSIPUserAuthentication = None
-    trackingActive = None
-    autoAnswer = None
-    BTsensitivity = None
-    num = None
-    sendVcardRight = None
-    warningTone = None
-    SWS = None
-    HBS = None
-    keepLocalPB = None
-    timeStampAdmin = None
-    holdRingBackTime = None
-    forwardState = None
-    sipAuthId = None
-    timeStamp = None
-    ppnOld = None
-    addId = None
-    HSS = None
-    permanent = None
-    forwardDest = None
-    allowVideoStream = None
-    sipRegisterCheck = None
-    ppProfileId = None
-    relType = None
-    SCS = None
-    serviceAuthName = None
-    HCS = None
-    hotDeskingSupport = None
-    CUS = None
-    callWaitingDisabled = None
-    calculatedSipPort = None
-    manDownNum = None
-    CDS = None
-    voiceboxNum = None
-    timeStampRelation = None
-    HRS = None
-    SRS = None
-    allowBargeIn = None
-    external = None
-    uidSec = None
-    HAS = None
-    conferenceServerURI = None
-    conferenceServerType = None
-    lang = None
-    useSIPUserName = None
-    sipPw = None
-    fixedSipPort = None
-    name = None
-    BTS = None
-    credentialPw = None
-    locRight = None
-    locatable = None
-    vip = None
-    configurationDataLoaded = None
-    sosNum = None
-    autoLogoutOnCharge = None
-    serviceAuthPassword = None
-    monitoringMode = None
-    microphoneMute = None
-    hierarchy1 = None
-    hierarchy2 = None
-    BTlocatable = None
-    serviceUserName = None
-    forwardTime = None
-    _ommclient = None
-    changes = {}
-    _changelock = Lock()
-
-    def __init__(self, ommclient, attributes=None):
-        self.__dict__["_ommclient"] = ommclient
-        self.__dict__["_changes"] = {}
-        if attributes is not None:
-            self._init_from_attributes(attributes)
-
-    def __getattr__(self, item):
-        return self.__dict__[item]
-
-    def __setattr__(self, key, value):
-        if key == "uid" and "uid" in self.__dict__:
-            raise Exception("Cannot change uid !")
-        with self._changelock:
-            self.changes[key] = value
-            self.__dict__[key] = value
-
-    def _init_from_attributes(self, attributes):
-        for key, val in list(attributes.items()):
-            self.__dict__[key] = val
-
-    def get_attributes(self):
-        attributes = {}
-        for key, val in list(self.__dict__.items()):
-            if "_" in key:
-                attributes[key] = val
-        return attributes
+    _fields = (
+        'msgRight', 'uid', 'pin', 'recvVcardRight', 'ppn', 'useSIPUserAuthentication', 'trackingActive', 'autoAnswer',
+        'BTsensitivity', 'num', 'sendVcardRight', 'warningTone', 'SWS', 'HBS', 'keepLocalPB', 'timeStampAdmin',
+        'holdRingBackTime', 'forwardState', 'sipAuthId', 'timeStamp', 'ppnOld', 'addId', 'HSS', 'permanent',
+        'forwardDest', 'allowVideoStream', 'sipRegisterCheck', 'ppProfileId', 'relType', 'SCS', 'serviceAuthName',
+        'HCS', 'hotDeskingSupport', 'CUS', 'callWaitingDisabled', 'calculatedSipPort', 'manDownNum', 'CDS',
+        'voiceboxNum', 'timeStampRelation', 'HRS', 'SRS', 'allowBargeIn', 'external', 'uidSec', 'HAS',
+        'conferenceServerURI', 'conferenceServerType', 'lang', 'useSIPUserName', 'sipPw', 'fixedSipPort', 'name', 'BTS',
+        'credentialPw', 'locRight', 'locatable', 'vip', 'configurationDataLoaded', 'sosNum', 'autoLogoutOnCharge',
+        'serviceAuthPassword', 'monitoringMode', 'microphoneMute', 'hierarchy1', 'hierarchy2', 'BTlocatable',
+        'serviceUserName', 'forwardTime',
+    )
+    __slots__ = _fields
+    _fieldset = frozenset(_fields)
+    _key = "uid"
 
     def commit(self):
         if not self.changes:
             return True
-        with self._changelock:
-            for change in self.changes:
-                print(change)
-            return True
+        for change in self.changes:
+            print(change)
+        return True
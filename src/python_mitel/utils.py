@@ -1,5 +1,12 @@
 import rsa
 import base64
+from functools import lru_cache
+
+
+@lru_cache(maxsize=8)
+def _public_key(modulus, exponent):
+    # the OMM hands out one key per session, parse it once instead of for every PIN
+    return rsa.PublicKey(int(modulus, 16), int(exponent, 16))
 
 
 def encrypt_pin(pin, modulus, exponent):
@@ -7,8 +14,7 @@ def encrypt_pin(pin, modulus, exponent):
     # "Chaining mode such as ECB makes no sense for RSA, unless you are doing it wrong."
     # Quote from https://stackoverflow.com/questions/2855326
     # Necessary for OMM to compare PIN of a user
-    pub_key = rsa.PublicKey(int(modulus, 16), int(exponent, 16))
-    crypted = rsa.encrypt(pin.encode('utf-8'), pub_key=pub_key)
+    crypted = rsa.encrypt(pin.encode('utf-8'), pub_key=_public_key(modulus, exponent))
     return base64.b64encode(crypted).decode('utf-8')
 
 
@@ -0,0 +1,31 @@
+import os
+import sys
+
+# the sources are run from src/ and import each other as top-level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import socket
+import subprocess
+
+import pytest
+
+TOOLS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tools')
+
+
+@pytest.fixture
+def fake_omm():
+    """ Starts tools/fake_omm.py with 20 users (2 of them without a handset) and 2 unbound handsets, yields its port
+    """
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    process = subprocess.Popen([sys.executable, os.path.join(TOOLS, 'fake_omm.py'), '--port', str(port),
+                                '--users', '20', '--unbound', '2'], stdout=subprocess.PIPE, text=True)
+    try:
+        # the fake prints one line once it accepts connections
+        process.stdout.readline()
+        yield port
+    finally:
+        process.terminate()
+        process.wait()
+        process.stdout.close()
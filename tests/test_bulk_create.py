@@ -0,0 +1,66 @@
+import asyncio
+
+from OMMMgr import OMMMgr
+from python_mitel.AsyncOMMClient import AsyncOMMClient
+from python_mitel.types.PPUser import PPUser
+
+SPECS = [{'name': f'Attendee {number}', 'number': str(number), 'desc1': 'GURU_MGR', 'desc2': str(800000 + number),
+          'sip_user': str(number), 'sip_password': 'ab12cd34ef'} for number in range(5000, 5010)]
+
+
+def test_created_users_merge_sent_fields_and_response(fake_omm):
+    async def run():
+        client = AsyncOMMClient('127.0.0.1', fake_omm)
+        await client.login('test', 'test', ommsync=True)
+        try:
+            created = await client.create_users(SPECS)
+            fetched = [await client.get_user(user.uid) for user in created]
+        finally:
+            await client.logout()
+        return created, fetched
+
+    created, fetched = asyncio.run(run())
+    assert all(isinstance(user, PPUser) for user in created)
+    # the OMM only answers with the uid, everything else comes from what was sent
+    assert len({user.uid for user in created}) == len(SPECS)
+    for spec, user, stored in zip(SPECS, created, fetched):
+        assert (user.name, user.num, user.hierarchy1, user.hierarchy2, user.sipAuthId) == \
+               (spec['name'], spec['number'], 'GURU_MGR', spec['desc2'], spec['sip_user'])
+        assert user.sipPw is None and user.pin is None
+        assert user.changes == {}
+        for field in ('uid', 'name', 'num', 'hierarchy1', 'hierarchy2', 'sipAuthId'):
+            assert getattr(user, field) == getattr(stored, field)
+
+
+def test_bulk_create_reports_each_user(fake_omm, monkeypatch):
+    monkeypatch.setenv('OMM_TEST_PW', 'test')
+    omm_mgr = OMMMgr({'omm': {'host': '127.0.0.1', 'port': fake_omm, 'username': 'test',
+                              'password_env': 'OMM_TEST_PW'}})
+    users = [{'name': spec['name'], 'number': spec['number'], 'token': spec['desc2'], 'sip_user': spec['sip_user'],
+              'sip_password': spec['sip_password']} for spec in SPECS]
+
+    async def run():
+        await omm_mgr.pool.login(user='test', password='test', ommsync=True)
+        session = omm_mgr.pool.primary
+        sendrequest = session._sendrequest
+
+        async def refuse_one(message, messagedata=None, children=None):
+            if message == 'CreatePPUser' and children['user']['num'] == '5003':
+                raise ConnectionError('lost')
+            return await sendrequest(message, messagedata, children)
+
+        session._sendrequest = refuse_one
+        try:
+            return await omm_mgr.create_users_bulk(users)
+        finally:
+            await omm_mgr.pool.logout()
+
+    report = asyncio.run(run())
+    assert list(report) == [user['number'] for user in users]
+    assert isinstance(report['5003'], ConnectionError)
+    for number, result in report.items():
+        if number != '5003':
+            assert isinstance(result, PPUser)
+            # managed users go straight into the directory, without a GetPPUser per user
+            assert omm_mgr.users[number] is result
+    assert '5003' not in omm_mgr.users
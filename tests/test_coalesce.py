@@ -0,0 +1,101 @@
+import logging
+
+import pytest
+
+from EventHandler import EventHandler
+
+
+def extension(event_id, number, ext_type='SIP'):
+    return {'id': event_id, 'type': 'UPDATE_EXTENSION', 'data': {'number': number, 'type': ext_type}}
+
+
+def delete(event_id, number):
+    return {'id': event_id, 'type': 'DELETE_EXTENSION', 'data': {'number': number}}
+
+
+def callgroup(event_id, number):
+    return {'id': event_id, 'type': 'UPDATE_CALLGROUP', 'data': {'number': number, 'extensions': []}}
+
+
+def rename(event_id, old_number, new_number):
+    return {'id': event_id, 'type': 'RENAME_EXTENSION',
+            'data': {'old_extension': old_number, 'new_extension': new_number}}
+
+
+def unsubscribe(event_id, number):
+    return {'id': event_id, 'type': 'UNSUBSCRIBE_DEVICE', 'data': {'extension': number}}
+
+
+# (batch, the events kept in order as (id, ids folded into it))
+CASES = {
+    'update folds into update': (
+        [extension(1, '1000'), extension(2, '1000')],
+        [(2, [1])]),
+    'folds chain up': (
+        [extension(1, '1000'), extension(2, '1000', 'DECT'), extension(3, '1000')],
+        [(3, [1, 2])]),
+    'update folds into delete': (
+        [extension(1, '1000'), delete(2, '1000')],
+        [(2, [1])]),
+    'delete is not folded into update': (
+        [delete(1, '1000'), extension(2, '1000')],
+        [(1, []), (2, [])]),
+    'delete is not folded into delete': (
+        [delete(1, '1000'), delete(2, '1000')],
+        [(1, []), (2, [])]),
+    'GROUP is not superseded by SIP': (
+        [extension(1, '1000', 'GROUP'), extension(2, '1000', 'SIP')],
+        [(1, []), (2, [])]),
+    'GROUP is not superseded by DECT': (
+        [extension(1, '1000', 'GROUP'), extension(2, '1000', 'DECT')],
+        [(1, []), (2, [])]),
+    'GROUP folds into GROUP': (
+        [extension(1, '1000', 'GROUP'), extension(2, '1000', 'GROUP')],
+        [(2, [1])]),
+    'GROUP folds into delete': (
+        [extension(1, '1000', 'GROUP'), delete(2, '1000')],
+        [(2, [1])]),
+    'SIP folds into GROUP': (
+        [extension(1, '1000', 'SIP'), extension(2, '1000', 'GROUP')],
+        [(2, [1])]),
+    'callgroup folds into callgroup': (
+        [callgroup(1, '1000'), callgroup(2, '1000')],
+        [(2, [1])]),
+    'extension and callgroup updates stay apart': (
+        [extension(1, '1000', 'GROUP'), callgroup(2, '1000'), extension(3, '1000', 'GROUP')],
+        [(1, []), (2, []), (3, [])]),
+    'only the same number folds': (
+        [extension(1, '1000'), extension(2, '2000')],
+        [(1, []), (2, [])]),
+    'other numbers keep their order around a fold': (
+        [extension(1, '1000'), extension(2, '2000'), extension(3, '1000'), delete(4, '2000'), extension(5, '3000')],
+        [(3, [1]), (4, [2]), (5, [])]),
+    'rename separates the old number': (
+        [extension(1, '1000'), rename(2, '1000', '2000'), extension(3, '1000')],
+        [(1, []), (2, []), (3, [])]),
+    'rename separates the new number': (
+        [extension(1, '2000'), rename(2, '1000', '2000'), extension(3, '2000')],
+        [(1, []), (2, []), (3, [])]),
+    'renames are never folded': (
+        [rename(1, '1000', '2000'), rename(2, '1000', '2000')],
+        [(1, []), (2, [])]),
+    'unsubscribe separates': (
+        [extension(1, '1000', 'DECT'), unsubscribe(2, '1000'), extension(3, '1000', 'DECT')],
+        [(1, []), (2, []), (3, [])]),
+}
+
+
+def make_event_handler():
+    # coalesce only needs its counter and logger, not the OMM, Asterisk and Guru3 connections
+    event_handler = EventHandler.__new__(EventHandler)
+    event_handler.logger = logging.getLogger('EventHandler')
+    event_handler.events_coalesced = 0
+    return event_handler
+
+
+@pytest.mark.parametrize('batch, expected', CASES.values(), ids=CASES.keys())
+def test_coalesce(batch, expected):
+    event_handler = make_event_handler()
+    result = event_handler.coalesce(batch)
+    assert [(event['id'], event.get('folded', [])) for event in result] == expected
+    assert event_handler.events_coalesced == len(batch) - len(expected)
@@ -0,0 +1,118 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+from OMMMgr import DirectoryCache
+from python_mitel.types.PPUser import PPUser
+
+
+class CountingSession:
+    """ Answers GetPPUser from a dict after a short delay and counts the requests """
+
+    def __init__(self):
+        self.users = {'10': {'uid': '10', 'name': 'User 10', 'num': '9010', 'hierarchy1': 'GURU_MGR'}}
+        self.get_user_calls = 0
+
+    async def get_user(self, uid):
+        self.get_user_calls += 1
+        await asyncio.sleep(0.01)
+        attributes = self.users.get(str(uid))
+        return None if attributes is None else PPUser(None, dict(attributes))
+
+
+class Handlers(list):
+    """ Takes the event handlers DirectoryCache registers on the primary session """
+
+    def __iadd__(self, handler):
+        self.append(handler)
+        return self
+
+
+def make_directory():
+    session = CountingSession()
+    primary = SimpleNamespace(on_PPUserCnf=Handlers(), on_PPDevCnf=Handlers())
+    pool = SimpleNamespace(primary=primary, session=lambda: session)
+    return DirectoryCache(pool, 'GURU_MGR', 1), session
+
+
+def user_event(directory, uid):
+    directory._on_user_event('PPUserCnf', {}, {'user': {'uid': uid}})
+
+
+def test_concurrent_refreshes_share_one_fetch():
+    directory, session = make_directory()
+
+    async def run():
+        first = asyncio.create_task(directory.refresh_user(10))
+        await asyncio.sleep(0)
+        # asks for the state as of before the first fetch was sent, so it can join it
+        return await asyncio.gather(first, directory.refresh_user(10, since=time.monotonic() - 1))
+
+    first, second = asyncio.run(run())
+    assert first is second
+    assert session.get_user_calls == 1
+    assert directory.users_by_uid['10'] is first
+
+
+def test_refresh_without_since_fetches_again():
+    directory, session = make_directory()
+
+    async def run():
+        await directory.refresh_user(10)
+        session.users['10']['name'] = 'Renamed'
+        return await directory.refresh_user(10)
+
+    assert asyncio.run(run()).name == 'Renamed'
+    assert session.get_user_calls == 2
+
+
+def test_events_during_a_write_are_left_to_the_writer():
+    directory, session = make_directory()
+
+    async def run():
+        with directory.writing(uids=[10]):
+            user_event(directory, '10')
+            await asyncio.sleep(0.02)
+        assert session.get_user_calls == 0
+        await directory.refresh_user(10)
+        # after the write, events are refreshed as usual
+        user_event(directory, '10')
+        await asyncio.gather(*directory._refreshes)
+
+    asyncio.run(run())
+    assert session.get_user_calls == 2
+
+
+def test_creation_joins_the_fetch_of_its_event():
+    directory, session = make_directory()
+
+    async def run():
+        sent = time.monotonic()
+        # the OMM announces the new user before it answers the create request
+        user_event(directory, '10')
+        await asyncio.sleep(0)
+        return await directory.refresh_user(10, since=sent)
+
+    assert asyncio.run(run()).name == 'User 10'
+    assert session.get_user_calls == 1
+
+
+def test_failed_fetch_is_not_shared():
+    directory, session = make_directory()
+    get_user = session.get_user
+
+    async def lost_connection(uid):
+        session.get_user = get_user
+        raise ConnectionError('connection lost')
+
+    session.get_user = lost_connection
+
+    async def run():
+        sent = time.monotonic()
+        try:
+            await directory.refresh_user(10)
+        except ConnectionError:
+            pass
+        return await directory.refresh_user(10, since=sent)
+
+    assert asyncio.run(run()).name == 'User 10'
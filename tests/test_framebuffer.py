@@ -0,0 +1,81 @@
+from python_mitel.messagehelper import FrameBuffer, parse_message
+
+
+def feed_all(buffer, chunks):
+    frames = []
+    for chunk in chunks:
+        frames.extend(buffer.feed(chunk))
+    return frames
+
+
+def test_single_frame():
+    assert FrameBuffer().feed(b'<PingResp/>\0') == [b'<PingResp/>']
+
+
+def test_frame_split_across_reads():
+    buffer = FrameBuffer()
+    assert buffer.feed(b'<GetPPUserResp seq="1"><user uid=') == []
+    assert buffer.feed(b'"1" num="100"/></GetPPU') == []
+    assert buffer.feed(b'serResp>\0') == [b'<GetPPUserResp seq="1"><user uid="1" num="100"/></GetPPUserResp>']
+
+
+def test_every_byte_in_its_own_read():
+    stream = b'<A x="1"/>\0<B y="2"/>\0'
+    buffer = FrameBuffer()
+    assert feed_all(buffer, [bytes([byte]) for byte in stream]) == [b'<A x="1"/>', b'<B y="2"/>']
+
+
+def test_several_frames_in_one_read():
+    assert FrameBuffer().feed(b'<A/>\0<B/>\0<C/>\0') == [b'<A/>', b'<B/>', b'<C/>']
+
+
+def test_coalesced_frames_with_a_partial_tail():
+    buffer = FrameBuffer()
+    assert buffer.feed(b'<A/>\0<B/>\0<C') == [b'<A/>', b'<B/>']
+    assert buffer.feed(b'/>\0') == [b'<C/>']
+
+
+def test_terminator_in_its_own_read():
+    buffer = FrameBuffer()
+    assert buffer.feed(b'<A/>') == []
+    assert buffer.feed(b'\0') == [b'<A/>']
+
+
+def test_multibyte_utf8_split_across_reads():
+    frame = '<user name="Jürgen Größe"/>'.encode('utf8')
+    split = frame.index('ü'.encode('utf8')) + 1  # between the two bytes of ü
+    buffer = FrameBuffer()
+    assert buffer.feed(frame[:split]) == []
+    frames = buffer.feed(frame[split:] + b'\0')
+    assert frames == [frame]
+    assert parse_message(frames[0])[1]['name'] == 'Jürgen Größe'
+
+
+def test_empty_frames():
+    buffer = FrameBuffer()
+    assert buffer.feed(b'\0') == [b'']
+    assert buffer.feed(b'\0\0<A/>\0\0') == [b'', b'', b'<A/>', b'']
+
+
+def test_empty_read():
+    buffer = FrameBuffer()
+    assert buffer.feed(b'<A') == []
+    assert buffer.feed(b'') == []
+    assert buffer.feed(b'/>\0') == [b'<A/>']
+
+
+def test_clear_drops_a_partial_frame():
+    buffer = FrameBuffer()
+    buffer.feed(b'<Truncat')
+    buffer.clear()
+    assert buffer.feed(b'<A/>\0') == [b'<A/>']
+
+
+def test_large_response_in_many_reads():
+    users = ''.join(f'<user uid="{uid}" num="{1000 + uid}" name="user {uid}"/>' for uid in range(20))
+    frame = f'<GetPPUserResp seq="7">{users}</GetPPUserResp>'.encode('utf8')
+    stream = frame + b'\0' + b'<PingResp/>\0'
+    chunks = [stream[offset:offset + 100] for offset in range(0, len(stream), 100)]
+    frames = feed_all(FrameBuffer(), chunks)
+    assert frames == [frame, b'<PingResp/>']
+    assert len(parse_message(frames[0])[2]['user']) == 20
@@ -0,0 +1,148 @@
+from types import SimpleNamespace
+
+import pytest
+
+from AsteriskMgr import CALL_ROUTER, CALL_ROUTER_TEMP, TempNumberPool
+from ReconcileMgr import ReconcileMgr
+from python_mitel.types.PPUser import PPUser
+
+EXTENSIONS = [
+    {'type': 'DECT', 'number': '1001', 'name': 'Dect One', 'token': '900001'},
+    {'type': 'SIP', 'number': '2001', 'name': 'Sip One', 'password': 'secret'},
+    {'type': 'GROUP', 'number': '3001', 'name': 'Group One'},
+]
+CALLGROUPS = [
+    {'number': '3001', 'extensions': [{'extension': '1001', 'active': True}, {'extension': '2001', 'active': True},
+                                      {'extension': '1002', 'active': False}]},
+]
+
+
+def make_reconcile_mgr(complete=True, **reconcile_config):
+    event_handler = SimpleNamespace(omm_mgr=None,
+                                    asterisk_mgr=SimpleNamespace(temp_numbers=TempNumberPool(prefix='010', length=5)))
+    reconcile_mgr = ReconcileMgr({'reconcile': reconcile_config, 'asterisk': {'password_length': 10}}, event_handler)
+    desired = reconcile_mgr.desired
+    if complete:
+        desired.observe({'type': 'SYNC_STARTED', 'data': {}})
+    for extension in EXTENSIONS:
+        desired.observe({'type': 'UPDATE_EXTENSION', 'data': extension})
+    for callgroup in CALLGROUPS:
+        desired.observe({'type': 'UPDATE_CALLGROUP', 'data': callgroup})
+    if complete:
+        desired.observe({'type': 'SYNC_ENDED', 'data': {}})
+    assert desired.complete is complete
+    return reconcile_mgr
+
+
+def omm_user(number, name, token):
+    return PPUser(None, {'uid': number, 'num': number, 'name': name, 'hierarchy1': 'GURU_MGR', 'hierarchy2': token})
+
+
+def in_sync():
+    """ The current state that matches the desired state exactly """
+    omm_users = {'1001': omm_user('1001', 'Dect One', '900001')}
+    endpoints = {'1001': ('Dect One', 'dectpw', CALL_ROUTER), '2001': ('Sip One', 'secret', CALL_ROUTER)}
+    callgroups = {'3001': 'Group One'}
+    members = {'3001': {'1001', '2001'}}
+    return omm_users, endpoints, callgroups, members
+
+
+def actions(update=(), delete=(), stale_callgroup=(), callgroup_members=()):
+    return {'update': set(update), 'delete': set(delete), 'stale_callgroup': set(stale_callgroup),
+            'callgroup_members': set(callgroup_members)}
+
+
+def test_in_sync_needs_nothing():
+    assert make_reconcile_mgr().diff(*in_sync()) == actions()
+
+
+@pytest.mark.parametrize('change, expected', [
+    # DECT: missing OMM user, missing endpoint, other name, other token
+    (lambda omm, ep, cg, mb: omm.pop('1001'), actions(update=['1001'])),
+    (lambda omm, ep, cg, mb: ep.pop('1001'), actions(update=['1001'])),
+    (lambda omm, ep, cg, mb: setattr(omm['1001'], 'name', 'Old Name'), actions(update=['1001'])),
+    (lambda omm, ep, cg, mb: setattr(omm['1001'], 'hierarchy2', '900999'), actions(update=['1001'])),
+    # SIP: missing endpoint, other password, other caller id, an OMM user under the same number
+    (lambda omm, ep, cg, mb: ep.pop('2001'), actions(update=['2001'])),
+    (lambda omm, ep, cg, mb: ep.update({'2001': ('Sip One', 'old', CALL_ROUTER)}), actions(update=['2001'])),
+    (lambda omm, ep, cg, mb: ep.update({'2001': ('Old', 'secret', CALL_ROUTER)}), actions(update=['2001'])),
+    (lambda omm, ep, cg, mb: omm.update({'2001': omm_user('2001', 'Sip One', '')}), actions(update=['2001'])),
+    # GROUP: missing callgroup, other name, an endpoint under the same number
+    (lambda omm, ep, cg, mb: cg.pop('3001'), actions(update=['3001'])),
+    (lambda omm, ep, cg, mb: cg.update({'3001': 'Old'}), actions(update=['3001'])),
+    (lambda omm, ep, cg, mb: ep.update({'3001': ('Group One', 'x', CALL_ROUTER)}), actions(update=['3001'])),
+])
+def test_outdated_extensions_are_updated(change, expected):
+    current = in_sync()
+    change(*current)
+    assert make_reconcile_mgr().diff(*current) == expected
+
+
+@pytest.mark.parametrize('current_members, stale', [
+    ({'1001', '2001'}, False),
+    # inactive members don't belong into the callgroup
+    ({'1001', '2001', '1002'}, True),
+    ({'1001'}, True),
+    (set(), True),
+])
+def test_callgroup_members(current_members, stale):
+    omm_users, endpoints, callgroups, members = in_sync()
+    members['3001'] = current_members
+    expected = actions(callgroup_members=['3001'] if stale else [])
+    assert make_reconcile_mgr().diff(omm_users, endpoints, callgroups, members) == expected
+
+
+def test_callgroup_left_under_another_extension_type_is_stale():
+    omm_users, endpoints, callgroups, members = in_sync()
+    callgroups['1001'] = 'Was A Group'
+    callgroups['2001'] = 'Was A Group'
+    assert make_reconcile_mgr().diff(omm_users, endpoints, callgroups, members) == \
+        actions(stale_callgroup=['1001', '2001'])
+
+
+def test_callgroup_members_of_unknown_numbers_are_left_alone():
+    reconcile_mgr = make_reconcile_mgr()
+    reconcile_mgr.desired.callgroups['3999'] = {'number': '3999', 'extensions': [{'extension': '1001', 'active': True}]}
+    assert reconcile_mgr.diff(*in_sync()) == actions()
+
+
+def unknown_entries():
+    omm_users, endpoints, callgroups, members = in_sync()
+    omm_users['1500'] = omm_user('1500', 'Gone', '900500')
+    endpoints['1600'] = ('Gone', 'pw', CALL_ROUTER)
+    endpoints['1601'] = ('Gone', 'pw', CALL_ROUTER_TEMP)
+    callgroups['3500'] = 'Gone'
+    return omm_users, endpoints, callgroups, members
+
+
+def test_incomplete_state_deletes_nothing():
+    reconcile_mgr = make_reconcile_mgr(complete=False, delete_callgroups=True)
+    assert reconcile_mgr.diff(*unknown_entries())['delete'] == set()
+
+
+def test_complete_state_deletes_own_entries_only():
+    assert make_reconcile_mgr().diff(*unknown_entries()) == actions(delete=['1500', '1600', '1601'])
+
+
+def test_unknown_callgroups_are_only_deleted_when_allowed():
+    assert make_reconcile_mgr(delete_callgroups=True).diff(*unknown_entries()) == \
+        actions(delete=['1500', '1600', '1601', '3500'])
+
+
+def test_foreign_endpoints_are_never_deleted():
+    omm_users, endpoints, callgroups, members = unknown_entries()
+    endpoints['4000'] = ('Reception', 'pw', 'default')
+    # a number with an endpoint in another context is left alone entirely, even if hexidian also has a user for it
+    endpoints['1500'] = ('Gone', 'pw', 'from-trunk')
+    assert make_reconcile_mgr().diff(omm_users, endpoints, callgroups, members) == actions(delete=['1600', '1601'])
+
+
+def test_ignored_prefixes():
+    reconcile_mgr = make_reconcile_mgr(ignore_prefixes=['15', '2'])
+    omm_users, endpoints, callgroups, members = unknown_entries()
+    # temporary numbers of unbound handsets are always ignored
+    omm_users['01012'] = omm_user('01012', 'Unbound Handset', None)
+    endpoints['01012'] = ('Unbound Handset', 'pw', CALL_ROUTER_TEMP)
+    # the outdated SIP extension 2001 is ignored as well
+    endpoints['2001'] = ('Sip One', 'old', CALL_ROUTER)
+    assert reconcile_mgr.diff(omm_users, endpoints, callgroups, members) == actions(delete=['1600', '1601'])
@@ -0,0 +1,139 @@
+import asyncio
+
+from python_mitel.AsyncOMMClient import AsyncOMMClient
+from python_mitel.messagehelper import construct_frame
+from python_mitel.types.PPUser import PPUser
+
+
+class RecordingClient(AsyncOMMClient):
+    """ Answers SetPPUser without a connection and keeps every frame it would have sent """
+
+    def __init__(self):
+        super().__init__('localhost')
+        self.frames = []
+        self.during_request = None
+        self.failing_uids = set()
+        self.delay = 0
+        self.outstanding = 0
+        self.max_outstanding = 0
+
+    def _get_sequence(self):
+        # a constant sequence number keeps the frame length independent of how many requests were sent
+        return 1
+
+    async def _sendrequest(self, message, messagedata=None, children=None):
+        self.frames.append(construct_frame(message, messagedata, children))
+        if self.during_request is not None:
+            self.during_request()
+        self.outstanding += 1
+        self.max_outstanding = max(self.max_outstanding, self.outstanding)
+        try:
+            # let the other requests go out before this one is answered, like on a pipelined connection
+            await asyncio.sleep(self.delay)
+        finally:
+            self.outstanding -= 1
+        if int(children['user']['uid']) in self.failing_uids:
+            raise ConnectionError('connection lost')
+        return message + 'Resp', {'seq': messagedata['seq']}, {'user': dict(children['user'])}
+
+
+def make_user(client, uid):
+    return PPUser(client, {'uid': uid, 'name': f'User {uid}', 'num': f'{9000 + uid}', 'hierarchy2': '',
+                           'sipAuthId': f'{9000 + uid}', 'sipPw': 'secret', 'relType': 'Fixed', 'ppn': uid})
+
+
+def test_update_payload_does_not_grow():
+    client = RecordingClient()
+    users = [make_user(client, uid) for uid in range(10, 15)]
+
+    async def run():
+        for i in range(5000):
+            user = users[i % len(users)]
+            user.name = f'Name {i % 2}-{user.uid}'
+            assert await client.update_user(user)
+            assert user.changes == {}
+
+    asyncio.run(run())
+    assert len(client.frames) == 5000
+    assert len({len(frame) for frame in client.frames}) == 1
+    assert client.frames[-1] == construct_frame('SetPPUser', {'seq': '1'},
+                                                {'user': {'name': 'Name 1-14', 'uid': 14}})
+
+
+def test_unchanged_user_sends_nothing():
+    client = RecordingClient()
+    user = make_user(client, 10)
+    assert asyncio.run(client.update_user(user))
+    assert client.frames == []
+
+
+def test_change_during_request_stays_pending():
+    client = RecordingClient()
+    user = make_user(client, 10)
+    user.name = 'First'
+    user.hierarchy2 = 'group'
+
+    def change_again():
+        client.during_request = None
+        user.name = 'Second'
+
+    client.during_request = change_again
+    assert asyncio.run(client.update_user(user))
+    assert user.changes == {'name': 'Second'}
+    assert asyncio.run(client.update_user(user))
+    assert user.changes == {}
+    assert client.frames[-1] == construct_frame('SetPPUser', {'seq': '1'}, {'user': {'name': 'Second', 'uid': 10}})
+
+
+def test_setting_back_to_original_clears_change():
+    user = make_user(None, 10)
+    user.name = 'Other'
+    user.name = 'Another'
+    assert user.changes == {'name': 'Another'}
+    user.name = 'User 10'
+    assert user.changes == {}
+    user.hierarchy2 = ''
+    assert user.changes == {}
+
+
+def test_acknowledged_value_becomes_the_original():
+    user = make_user(None, 10)
+    user.name = 'Other'
+    user.clear_changes({'name': 'Other'})
+    user.name = 'User 10'
+    assert user.changes == {'name': 'User 10'}
+
+
+def test_update_users_sends_each_users_changes_concurrently():
+    client = RecordingClient()
+    users = [make_user(client, uid) for uid in range(10, 15)]
+    users[0].name = 'Renamed'
+    users[1].hierarchy2 = '800011'
+    users[1].name = 'Also Renamed'
+    users[2].num = '9999'
+    users[3].name = 'Fails'
+    # users[4] has no changes
+    client.failing_uids.add(13)
+    client.delay = 0.01
+
+    results = asyncio.run(client.update_users(users))
+
+    assert client.max_outstanding == 4
+    assert set(results) == {10, 11, 12, 13}
+    assert results[10] is True and results[11] is True and results[12] is True
+    assert isinstance(results[13], ConnectionError)
+    assert sorted(client.frames) == sorted([
+        construct_frame('SetPPUser', {'seq': '1'}, {'user': {'name': 'Renamed', 'uid': 10}}),
+        construct_frame('SetPPUser', {'seq': '1'}, {'user': {'hierarchy2': '800011', 'name': 'Also Renamed',
+                                                             'uid': 11}}),
+        construct_frame('SetPPUser', {'seq': '1'}, {'user': {'num': '9999', 'uid': 12}}),
+        construct_frame('SetPPUser', {'seq': '1'}, {'user': {'name': 'Fails', 'uid': 13}}),
+    ])
+    assert [user.changes for user in users] == [{}, {}, {}, {'name': 'Fails'}, {}]
+
+    # the failed user is written by the next batch, the others cost nothing
+    client.failing_uids.clear()
+    client.frames.clear()
+    assert asyncio.run(client.update_users(users)) == {13: True}
+    assert client.frames == [construct_frame('SetPPUser', {'seq': '1'}, {'user': {'name': 'Fails', 'uid': 13}})]
+    assert users[3].changes == {}
@@ -0,0 +1,417 @@
+""" Benchmarks hexidian's OMM side against tools/fake_omm.py
+
+In the default `directory` mode, for every dataset size, a fresh fake OMM is started in its own process and three
+things are measured:
+- read_users: the initial load of all users and devices into the directory.
+- unbound sweep: binding every unbound handset to a new temporary user.
+- registration: moving each of those handsets from its temporary user to the user whose token it called.
+
+The Asterisk database is replaced by an in-memory stand-in, so only the OMM traffic and hexidian's own work
+are measured.
+
+    python tools/bench.py --sizes 1000 5000 20000 --unbound 200 --latency 0.002
+
+The `roundtrip` mode measures the time from sending a request to handing its response back to the caller, one
+request at a time, for the threaded OMMClient and for AsyncOMMClient. `--baseline` adds PollingOMMClient, OMMClient
+with the worker and dispatcher loops it had before they were made selector-driven, which slept 100 ms between
+checks. It is slow, so it only sends `--baseline-requests` requests:
+
+    python tools/bench.py --mode roundtrip --requests 2000 --latency 0 --baseline
+
+The `asterisk` mode runs one Guru3 event of each kind through EventHandler.process_event against a psycopg2
+stand-in and counts the round trips to the Asterisk database it causes: every execute, plus the BEGIN psycopg2 sends
+before the first statement of a transaction and the COMMIT or ROLLBACK that ends it. `--db-latency` is added to
+every round trip.
+
+    python tools/bench.py --mode asterisk --db-latency 0.001
+"""
+import argparse
+import asyncio
+import logging
+import os
+import queue
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+TOOLS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TOOLS, '..', 'src'))
+
+os.environ.setdefault('OMM_PW', 'bench')
+os.environ.setdefault('GURU_PW', 'bench')
+os.environ.setdefault('ASTERISK_PW', 'bench')
+
+import psycopg2  # noqa: E402
+
+import EventHandler as event_handler_module  # noqa: E402
+from AsteriskMgr import TempNumberPool  # noqa: E402
+from python_mitel.AsyncOMMClient import AsyncOMMClient  # noqa: E402
+from python_mitel.OMMClient import OMMClient  # noqa: E402
+from python_mitel.messagehelper import parse_message  # noqa: E402
+
+
+class PollingOMMClient(OMMClient):
+    """ OMMClient with the polling worker and dispatcher of the original client, as the baseline in roundtrip mode
+
+    The worker sends at most one queued request per pass and waits up to 100 ms for data; the dispatcher sleeps
+    100 ms before each look at the receive queue. Frames are still split by the FrameBuffer, so only the polling
+    differs from OMMClient.
+    """
+
+    def _work(self):
+        while not self._terminate:
+            try:
+                item = self._send_q.get(block=False)
+            except queue.Empty:
+                pass
+            else:
+                self._ssl_socket.sendall(item)
+                self._send_q.task_done()
+            self._ssl_socket.settimeout(0.1)
+            try:
+                data = self._ssl_socket.recv(65536)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            for frame in self._frames.feed(data):
+                self._recv_q.put(frame)
+
+    def _dispatch(self):
+        while not self._terminate:
+            time.sleep(0.1)
+            try:
+                item = self._recv_q.get(block=False)
+            except queue.Empty:
+                continue
+            if item is None:
+                break
+            name, attributes, children = parse_message(item)
+            message = name + attributes.get('seq', '')
+            with self._eventlock:
+                if message in self._events:
+                    self._events[message]['response'] = name, attributes, children
+                    self._events[message]['event'].set()
+
+
+class InMemoryAsterisk:
+    """ Just enough of AsteriskManager for the OMM side to run, keeping the users in a set """
+
+    def __init__(self, config):
+        self.config = config['asterisk']
+        self.users = set()
+        self.temp_numbers = TempNumberPool(prefix='010', length=self.config['temp_num_length'])
+
+    async def create_user(self, number, sip_password, name, temporary=False):
+        self.users.add(number)
+        self.temp_numbers.mark_used(number)
+
+    async def delete_user(self, number):
+        self.users.discard(number)
+        self.temp_numbers.release(number)
+
+    async def check_for_user(self, number):
+        return number in self.users
+
+    def stats(self):
+        return {}
+
+    def close(self):
+        pass
+
+
+class CountingCursor:
+    """ Answers the Asterisk manager's queries from `CountingConnection.answers` and counts each execute """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.description = None
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    @staticmethod
+    def mogrify(sql, params=None):
+        return (sql % tuple(f"'{param}'" for param in params or ())).encode()
+
+    def execute(self, sql, params=None):
+        if not self.connection.autocommit and not self.connection.in_transaction:
+            # psycopg2 opens a transaction with its own BEGIN before the first statement
+            self.connection.in_transaction = True
+            CountingConnection.round_trip()
+        CountingConnection.round_trip()
+        if isinstance(sql, bytes):
+            sql = sql.decode()
+        self.description = None
+        self.rows = []
+        if sql.lstrip().startswith('select'):
+            self.description = (('id',),)
+            if 'from callgroup_members where callgroup' in sql:
+                self.rows = [(member,) for member in CountingConnection.answers['members']]
+            elif CountingConnection.answers['exists']:
+                self.rows = [('exists',)]
+
+    def fetchall(self):
+        return self.rows
+
+
+class CountingConnection:
+    """ Stands in for a psycopg2 connection, see CountingCursor """
+    answers = {'exists': False, 'members': []}
+    latency = 0.0
+    round_trips = 0
+    _lock = threading.Lock()
+
+    server_version = 150000
+    closed = 0
+
+    class info:
+        transaction_status = 0
+
+    def __init__(self, *args, **kwargs):
+        self.autocommit = False
+        self.in_transaction = False
+
+    @classmethod
+    def round_trip(cls):
+        with cls._lock:
+            cls.round_trips += 1
+        time.sleep(cls.latency)
+
+    def cursor(self):
+        return CountingCursor(self)
+
+    def commit(self):
+        if self.in_transaction:
+            self.in_transaction = False
+            self.round_trip()
+
+    def rollback(self):
+        self.commit()
+
+    def close(self):
+        self.closed = 1
+
+
+# (name, whether Asterisk already has the user or callgroup, current callgroup members, event type, event data)
+ASTERISK_CASES = [
+    ('DECT create', False, [], 'UPDATE_EXTENSION', {'type': 'DECT', 'number': '20001', 'name': 'n', 'token': '1'}),
+    ('DECT update', True, [], 'UPDATE_EXTENSION', {'type': 'DECT', 'number': '10001', 'name': 'n', 'token': '1'}),
+    ('SIP create', False, [], 'UPDATE_EXTENSION', {'type': 'SIP', 'number': '20002', 'name': 'n', 'password': 'p'}),
+    ('SIP update', True, [], 'UPDATE_EXTENSION', {'type': 'SIP', 'number': '20002', 'name': 'n', 'password': 'p'}),
+    ('GROUP create', False, [], 'UPDATE_EXTENSION', {'type': 'GROUP', 'number': '20004', 'name': 'g'}),
+    ('other type', True, [], 'UPDATE_EXTENSION', {'type': 'PLAIN', 'number': '20005', 'name': 'x'}),
+    ('DELETE', True, [], 'DELETE_EXTENSION', {'number': '10002'}),
+    ('RENAME', True, [], 'RENAME_EXTENSION', {'old_extension': '10003', 'new_extension': '20003'}),
+    ('CALLGROUP +5 -2', True, ['a', 'b', 'c'], 'UPDATE_CALLGROUP',
+     {'number': '20004', 'extensions': [{'extension': extension, 'active': True} for extension in 'cdefgh']}),
+]
+
+
+def config_for(port, args):
+    return {
+        'event_handler': {'ignored_msgtypes': [], 'collect_ppns_interval': 3600},
+        'guru3': {'host': 'localhost', 'port': 1, 'password_env': 'GURU_PW', 'tls': False},
+        'omm': {'host': '127.0.0.1', 'port': port, 'username': 'bench', 'password_env': 'OMM_PW',
+                'scan_concurrency': args.scan_concurrency, 'pool_size': args.pool_size},
+        'asterisk': {'password_length': 10, 'temp_num_length': 5},
+        'registration': {'port': 0},
+        'snapshot': {'interval': 3600, 'max_age': 3600, 'concurrency': 16},
+        'reconcile': {'on_startup': False, 'interval': 0},
+    }
+
+
+def start_fake(port, users, args, unbound=None):
+    if unbound is None:
+        unbound = args.unbound
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(TOOLS, 'fake_omm.py'), '--port', str(port), '--users', str(users),
+         '--unbound', str(unbound), '--latency', str(args.latency)],
+        stdout=subprocess.PIPE, text=True)
+    # the fake prints one line once it accepts connections
+    process.stdout.readline()
+    return process
+
+
+async def settle(omm_mgr):
+    # let the directory refreshes triggered by OMM events finish, so they don't spill into the next measurement
+    while omm_mgr.directory._refreshes:
+        await asyncio.gather(*omm_mgr.directory._refreshes, return_exceptions=True)
+
+
+def report(name, count, seconds):
+    print(f'  {name:<14} {count:>7} in {seconds:7.3f} s  ({count / seconds:9.1f}/s)', flush=True)
+
+
+async def bench_size(port, users, args):
+    handler = event_handler_module.EventHandler(config_for(port, args))
+    omm_mgr = handler.omm_mgr
+    await omm_mgr.pool.login(user='bench', password='bench', ommsync=True)
+    try:
+        started = time.perf_counter()
+        await omm_mgr.read_users()
+        report('read_users', len(omm_mgr.directory.users_by_uid), time.perf_counter() - started)
+        omm_mgr.ready.set()
+
+        unbound = omm_mgr.directory.devices_with_reltype('Unbound')
+        started = time.perf_counter()
+        for device in unbound:
+            handler._bind_later(device)
+        while handler._binding_tasks:
+            await asyncio.gather(*handler._binding_tasks)
+        report('unbound sweep', len(unbound), time.perf_counter() - started)
+        await settle(omm_mgr)
+
+        # the users without a handset are the last ones of the dataset, see fake_omm.py
+        temp_numbers = [num for num, user in omm_mgr.directory.users_by_num.items() if num.startswith('010')]
+        tokens = [str(900000 + uid) for uid in range(users - len(temp_numbers) + 1, users + 1)]
+        started = time.perf_counter()
+        # Asterisk reports the called token with a four character prefix, which try_device_registration strips
+        results = await asyncio.gather(*(handler.try_device_registration(temp_number, '0000' + token)
+                                         for temp_number, token in zip(temp_numbers, tokens)))
+        report('registration', len(results), time.perf_counter() - started)
+        await settle(omm_mgr)
+        if not all(results):
+            print(f'  {results.count(False)} registrations failed', flush=True)
+        left = len(omm_mgr.directory.devices_with_reltype('Unbound'))
+        if left:
+            print(f'  {left} handsets are still unbound', flush=True)
+    finally:
+        await omm_mgr.pool.logout()
+
+
+async def bench_asterisk(port, args):
+    config = config_for(port, args)
+    config['asterisk'].update(host='localhost', port=5432, username='bench', password_env='ASTERISK_PW',
+                              db_workers=4)
+    handler = event_handler_module.EventHandler(config)
+    omm_mgr = handler.omm_mgr
+
+    async def mark_event_complete(event_id):
+        pass
+
+    handler.guru3_mgr.mark_event_complete = mark_event_complete
+    # binding unbound handsets in the background would add its writes to whichever event runs at the time
+    handler._bind_later = lambda device: None
+    await omm_mgr.pool.login(user='bench', password='bench', ommsync=True)
+    try:
+        await omm_mgr.read_users()
+        omm_mgr.ready.set()
+        total = 0
+        for name, exists, members, event_type, data in ASTERISK_CASES:
+            CountingConnection.answers = {'exists': exists, 'members': members}
+            before = CountingConnection.round_trips
+            started = time.perf_counter()
+            await handler.process_event({'id': 1, 'type': event_type, 'timestamp': int(time.time()), 'data': data})
+            round_trips = CountingConnection.round_trips - before
+            total += round_trips
+            print(f'  {name:<16} {round_trips:>3} round trips in {(time.perf_counter() - started) * 1000:7.1f} ms',
+                  flush=True)
+        print(f'  {"total":<16} {total:>3} round trips', flush=True)
+    finally:
+        await omm_mgr.pool.logout()
+
+
+def report_latencies(name, samples):
+    ordered = sorted(samples)
+    mean = sum(ordered) / len(ordered)
+    p50 = ordered[len(ordered) // 2]
+    p99 = ordered[min(int(len(ordered) * 0.99), len(ordered) - 1)]
+    print(f'  {name:<24} {len(ordered):>6} requests  mean {mean * 1000:7.3f} ms  p50 {p50 * 1000:7.3f} ms  '
+          f'p99 {p99 * 1000:7.3f} ms', flush=True)
+
+
+def bench_threaded_roundtrip(port, client_type, requests):
+    client = client_type('127.0.0.1', port)
+    client.login('bench', 'bench', ommsync=True)
+    try:
+        client_name = client_type.__name__
+        for name, request in ((f'{client_name} ping', client.ping),
+                              (f'{client_name} get_user', lambda: client.get_user(1))):
+            samples = []
+            for _ in range(requests):
+                started = time.perf_counter()
+                request()
+                samples.append(time.perf_counter() - started)
+            report_latencies(name, samples)
+    finally:
+        client.logout()
+
+
+async def bench_async_roundtrip(port, args):
+    client = AsyncOMMClient('127.0.0.1', port)
+    await client.login('bench', 'bench', ommsync=True)
+    try:
+        for name, request in (('AsyncOMMClient ping', client.ping),
+                              ('AsyncOMMClient get_user', lambda: client.get_user(1))):
+            samples = []
+            for _ in range(args.requests):
+                started = time.perf_counter()
+                await request()
+                samples.append(time.perf_counter() - started)
+            report_latencies(name, samples)
+    finally:
+        await client.logout()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks hexidian against a fake OMM.')
+    parser.add_argument('--mode', choices=['directory', 'roundtrip', 'asterisk'], default='directory')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 5000, 20000], help='users per dataset')
+    parser.add_argument('--unbound', type=int, default=100, help='unbound handsets per dataset')
+    parser.add_argument('--latency', type=float, default=0.002, help='simulated OMM response time in seconds')
+    parser.add_argument('--port', type=int, default=12623)
+    parser.add_argument('--pool-size', type=int, default=2)
+    parser.add_argument('--scan-concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=2000, help='requests per client in roundtrip mode')
+    parser.add_argument('--baseline', action='store_true',
+                        help='also measure the polling OMMClient it replaced, in roundtrip mode')
+    parser.add_argument('--baseline-requests', type=int, default=50, help='requests per baseline client')
+    parser.add_argument('--db-latency', type=float, default=0.001,
+                        help='simulated Asterisk database round trip in seconds, in asterisk mode')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    if args.mode == 'roundtrip':
+        print(f'round trips, {args.latency * 1000:g} ms latency:', flush=True)
+        fake = start_fake(args.port, 10, args, unbound=0)
+        try:
+            if args.baseline:
+                bench_threaded_roundtrip(args.port, PollingOMMClient, args.baseline_requests)
+            bench_threaded_roundtrip(args.port, OMMClient, args.requests)
+            asyncio.run(bench_async_roundtrip(args.port, args))
+        finally:
+            fake.terminate()
+            fake.wait()
+        return
+    if args.mode == 'asterisk':
+        print(f'Asterisk round trips per event, {args.db_latency * 1000:g} ms each:', flush=True)
+        psycopg2.connect = CountingConnection
+        CountingConnection.latency = args.db_latency
+        fake = start_fake(args.port, 100, args, unbound=0)
+        try:
+            asyncio.run(bench_asterisk(args.port, args))
+        finally:
+            fake.terminate()
+            fake.wait()
+        return
+
+    event_handler_module.AsteriskManager = InMemoryAsterisk
+    for users in args.sizes:
+        print(f'{users} users, {args.unbound} unbound handsets, {args.latency * 1000:g} ms latency:', flush=True)
+        fake = start_fake(args.port, users, args)
+        try:
+            asyncio.run(bench_size(args.port, users, args))
+        finally:
+            fake.terminate()
+            fake.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+""" Measures the memory the user directory needs, slotted PPUser records against the old dict-backed layout
+
+`--users` GetPPUser records are parsed from AXI pages like the ones the OMM sends, so every attribute value is its own
+string as in production. They are then turned into records twice: into PPUser and into a copy of the PPUser class
+before it was slotted, which kept every attribute in the instance __dict__. tracemalloc reports the memory held by the
+records alone, next to the time to build them and to read one attribute of each.
+
+    python tools/bench_memory.py --users 10000
+"""
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+TOOLS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TOOLS, '..', 'src'))
+
+from bench_parser import page, user_record  # noqa: E402
+from python_mitel.messagehelper import parse_message  # noqa: E402
+from python_mitel.types.PPUser import PPUser  # noqa: E402
+
+
+class DictPPUser:
+    """ The storage of PPUser before it was slotted: declared attributes default to None on the class, the values
+    the OMM sent live in the instance __dict__ """
+
+    def __init__(self, ommclient, attributes=None):
+        self.__dict__["_ommclient"] = ommclient
+        self.__dict__["_changes"] = {}
+        if attributes is not None:
+            self._init_from_attributes(attributes)
+
+    def __getattr__(self, item):
+        if item in PPUser._fieldset:
+            return None
+        raise AttributeError(item)
+
+    def _init_from_attributes(self, attributes):
+        for key, val in list(attributes.items()):
+            self.__dict__[key] = val
+
+
+def parsed_records(users, records_per_page=20):
+    records = []
+    for first in range(1, users + 1, records_per_page):
+        uids = range(first, min(first + records_per_page, users + 1))
+        _, _, children = parse_message(page('GetPPUserResp', 'user', [user_record(uid) for uid in uids]))
+        user = children['user']
+        records.extend(user if isinstance(user, list) else [user])
+    return records
+
+
+def measure(record_type, records):
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    users = [record_type(None, attributes) for attributes in records]
+    built = time.perf_counter() - started
+    held, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    started = time.perf_counter()
+    for user in users:
+        user.name
+        user.hierarchy2
+        user.ppProfileId
+    read = time.perf_counter() - started
+    return held, built, read
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures the memory of the user directory records.')
+    parser.add_argument('--users', type=int, default=10000)
+    args = parser.parse_args()
+
+    records = parsed_records(args.users)
+    print(f'{len(records)} users, {len(records[0])} attributes each:', flush=True)
+    results = {}
+    for name, record_type in (('dict-backed', DictPPUser), ('PPUser', PPUser)):
+        held, built, read = measure(record_type, records)
+        results[name] = held
+        print(f'  {name:<12} {held / 2 ** 20:7.2f} MiB  built in {built * 1000:7.1f} ms  '
+              f'3 reads each in {read * 1000:6.1f} ms', flush=True)
+    print(f'  PPUser holds {results["PPUser"] / results["dict-backed"]:.0%} of the dict-backed memory', flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+""" Compares the expat based parse_message with the minidom parser it replaced
+
+Both parsers run over synthetic GetPPUserResp and GetPPDevResp pages of `--records` records each, shaped like what
+the OMM sends while hexidian pages through the directory. For each payload, the time per message and the memory
+allocated while parsing one message (tracemalloc peak) are reported. Frames arrive as bytes; the old code decoded
+them before parsing, so the decoding is part of its measurement.
+
+    python tools/bench_parser.py --records 20 --iterations 5000
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+from xml.dom.minidom import parseString
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from python_mitel.messagehelper import construct_message, parse_message  # noqa: E402
+
+
+def minidom_parse_message(messagedata):
+    """ The parser parse_message replaced, kept as the reference """
+    xml_data = parseString(messagedata.rstrip('\0'))
+    root = xml_data.documentElement
+    name = root.tagName
+    attributes = {}
+    children = {}
+    for i in range(0, root.attributes.length):
+        item = root.attributes.item(i)
+        attributes[item.name] = item.value
+
+    child = root.firstChild
+    child_num = 0
+    while child is not None and child_num < 5000:
+        child_num += 1
+
+        new_child = {}
+        for i in range(0, child.attributes.length):
+            item = child.attributes.item(i)
+            new_child[item.name] = item.value
+
+        childname = child.tagName
+        if childname in children:
+            if not isinstance(children[childname], list):
+                children[childname] = [children[childname]]
+            children[childname].append(new_child)
+        else:
+            children[childname] = new_child
+
+        child = child.nextSibling
+
+    return name, attributes, children
+
+
+def user_record(uid):
+    return {'uid': uid, 'timeStamp': 1700000000 + uid, 'relType': 'Dynamic', 'ppn': uid, 'name': f'Attendee {uid}',
+            'num': 10000 + uid, 'hierarchy1': 'GURU_MGR', 'hierarchy2': 900000 + uid, 'addId': '', 'pin': '',
+            'sipAuthId': 10000 + uid, 'sipPw': 'ab12cd34ef56', 'sosNum': '', 'voiceboxNum': '', 'manDownNum': '',
+            'forwardState': 'Off', 'forwardTime': 0, 'forwardDest': '', 'lang': 'de', 'holdRingBackTime': 0,
+            'autoAnswer': 'false', 'microphoneMute': 'false', 'warningTone': 'false', 'allowBargeIn': 'false',
+            'callWaitingDisabled': 'false', 'external': 'false', 'trackingActive': 'false', 'locatable': 'false',
+            'BTlocatable': 'false', 'BTsensitivity': 'Standard', 'locRight': 'false', 'msgRight': 'false',
+            'sendVcardRight': 'false', 'recvVcardRight': 'false', 'keepLocalPB': 'false', 'vip': 'false',
+            'sipRegisterCheck': 'false', 'allowVideoStream': 'false', 'conferenceServerType': 'Internal',
+            'conferenceServerURI': '', 'monitoringMode': 'Off', 'CUS': 'Unknown', 'HAS': 'Unknown', 'HSS': 'Unknown',
+            'HRS': 'Unknown', 'HCS': 'Unknown', 'SRS': 'Unknown', 'SCS': 'Unknown', 'CDS': 'Unknown',
+            'HBS': 'Unknown', 'BTS': 'Unknown', 'SWS': 'Unknown', 'credentialPw': '', 'configurationDataLoaded': 'true',
+            'ppnOld': 0, 'timeStampAdmin': 1700000000 + uid, 'timeStampRelation': 1700000000 + uid}
+
+
+def device_record(ppn):
+    return {'ppn': ppn, 'timeStamp': 1700000000 + ppn, 'relType': 'Dynamic', 'uid': ppn,
+            'ipei': f'{10000 + ppn:05d}{ppn:07d}', 'ac': '', 's': 3, 'uidOld': 0, 'relTypeOld': 'Unbound',
+            'autoCreate': 'false', 'encrypt': 'true', 'capMessaging': 'true', 'capEnhLocating': 'true',
+            'capBluetooth': 'true', 'ethAddr': f'00:30:42:{ppn % 256:02x}:{ppn // 256 % 256:02x}:01',
+            'hwType': '622d', 'capLocating': 'true', 'capMsgBlock': 'false', 'capBTscan': 'true',
+            'capDuplexVoice': 'true', 'usbInterface': 'false', 'addId': '', 'subscribeToPARIOnly': 'false',
+            'trackingActive': 'false', 'locatable': 'false', 'BTlocatable': 'false', 'BTsensitivity': 'Standard',
+            'swVersion': '7.2.9', 'swBuild': 'AA20', 'hwVersion': 'B', 'sensorSw': '', 'sosNum': '',
+            'manDownNum': '', 'keyLockActive': 'false', 'conformityDeclared': 'true'}
+
+
+def page(name, tag, records):
+    head = construct_message(name, {'seq': 17})[:-2] + '>'
+    message = head + ''.join(construct_message(tag, record) for record in records) + f'</{name}>'
+    return message.encode('utf8') + b'\0'
+
+
+def run_old(frame):
+    return minidom_parse_message(frame.decode('utf8'))
+
+
+def run_new(frame):
+    return parse_message(frame)
+
+
+def measure(parse, frame, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        parse(frame)
+    seconds = (time.perf_counter() - started) / iterations
+    tracemalloc.start()
+    parse(frame)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares the expat and minidom AXI parsers.')
+    parser.add_argument('--records', type=int, default=20, help='records per response, like a directory page')
+    parser.add_argument('--iterations', type=int, default=5000)
+    args = parser.parse_args()
+
+    payloads = {
+        'GetPPUserResp': page('GetPPUserResp', 'user', [user_record(uid) for uid in range(1, args.records + 1)]),
+        'GetPPDevResp': page('GetPPDevResp', 'pp', [device_record(ppn) for ppn in range(1, args.records + 1)]),
+    }
+    for name, frame in payloads.items():
+        if run_old(frame) != run_new(frame):
+            sys.exit(f'{name}: the parsers disagree')
+        print(f'{name}, {args.records} records, {len(frame)} bytes:', flush=True)
+        old_seconds, old_peak = measure(run_old, frame, args.iterations)
+        new_seconds, new_peak = measure(run_new, frame, args.iterations)
+        print(f'  minidom {old_seconds * 1e6:8.1f} us  {old_peak / 1024:8.1f} KiB allocated', flush=True)
+        print(f'  expat   {new_seconds * 1e6:8.1f} us  {new_peak / 1024:8.1f} KiB allocated  '
+              f'({old_seconds / new_seconds:.1f}x faster, {old_peak / new_peak:.1f}x less memory)', flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,298 @@
+""" Stand-in for a Mitel OMM, speaking enough AXI to run hexidian against it
+
+The fake serves NUL-framed XML over TLS and keeps a synthetic dataset in memory:
+- `--users` users (uid 1..n, number 10000+uid, token 900000+uid, hierarchy1 GURU_MGR).
+- One Dynamic device per user (ppn = uid), except for the last `--unbound` users. Those are extensions still
+  waiting for their handset.
+- `--unbound` devices that are subscribed but not bound to a user.
+
+Every request is answered after `--latency` seconds. Responses are not serialized per connection, so requests
+can be pipelined like on a real OMM. Changes are pushed as EventPPUserCnf/EventPPDevCnf to connections that
+subscribed to them. `--new-pp-interval` makes a new unbound handset subscribe every few seconds.
+
+Without `--cert`/`--key`, a throwaway self-signed certificate is created with openssl.
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import ssl
+import subprocess
+import sys
+import tempfile
+
+import rsa
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from python_mitel.messagehelper import FrameBuffer, construct_message, parse_message  # noqa: E402
+
+
+def _records(children, tag):
+    records = children.get(tag) if children else None
+    if records is None:
+        return []
+    return records if isinstance(records, list) else [records]
+
+
+class FakeOMM:
+    def __init__(self, users=1000, unbound=0, latency=0.0):
+        self.latency = latency
+        self.users: dict[int, dict] = {}
+        self.devices: dict[int, dict] = {}
+        self.subscription_mode = 'Off'
+        self._timestamps = itertools.count(1)
+        self._connections = {}
+        self.requests = 0
+        self._public_key, _ = rsa.newkeys(512)
+
+        for uid in range(1, users + 1):
+            self.users[uid] = {'uid': str(uid), 'num': str(10000 + uid), 'name': f'user {uid}',
+                               'hierarchy1': 'GURU_MGR', 'hierarchy2': str(900000 + uid), 'sipAuthId': str(10000 + uid),
+                               'ppn': '0', 'relType': 'Unbound', 'timeStamp': '1', 'timeStampAdmin': '1'}
+        for uid in range(1, users - unbound + 1):
+            self.devices[uid] = self._new_device(uid)
+            self._bind(uid, uid, 'Dynamic')
+        self._next_uid = itertools.count(users + 1)
+        self._next_ppn = itertools.count(users + 1)
+        # highest id ever handed out, where paging stops
+        self.highest = {'uid': users, 'ppn': users - unbound}
+        for _ in range(unbound):
+            self.add_unbound_device()
+
+    def _new_device(self, ppn):
+        return {'ppn': str(ppn), 'uid': '0', 'relType': 'Unbound', 'ipei': f'{ppn:013d}',
+                'subscribeToPARIOnly': 'false', 'timeStamp': '1', 'timeStampAdmin': '1'}
+
+    def _touch(self, record):
+        record['timeStamp'] = str(next(self._timestamps))
+
+    def _bind(self, uid, ppn, rel_type):
+        user, device = self.users.get(uid), self.devices.get(ppn)
+        if device is not None:
+            device['uid'] = str(uid if user is not None else 0)
+            device['relType'] = rel_type
+            self._touch(device)
+        if user is not None:
+            user['ppn'] = str(ppn if device is not None else 0)
+            user['relType'] = rel_type
+            self._touch(user)
+
+    def add_unbound_device(self):
+        ppn = next(self._next_ppn)
+        self.devices[ppn] = self._new_device(ppn)
+        self.highest['ppn'] = ppn
+        self._push('PPDevCnf', {'pp': {'ppn': str(ppn)}})
+        return ppn
+
+    # -- connection handling
+
+    async def handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        frames = FrameBuffer()
+        self._connections[writer] = set()
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                for frame in frames.feed(data):
+                    self.requests += 1
+                    response = self.respond(writer, *parse_message(frame))
+                    loop.call_later(self.latency, self._send, writer, response)
+        except OSError:
+            pass
+        finally:
+            self._connections.pop(writer, None)
+            writer.close()
+
+    @staticmethod
+    def _send(writer, message):
+        if not writer.is_closing():
+            writer.write(message.encode('utf8') + b'\0')
+
+    def _push(self, event, children):
+        message = construct_message(f'Event{event}', {}, children)
+        for writer, subscriptions in self._connections.items():
+            if event in subscriptions:
+                # events follow the pending responses, like the change they report
+                asyncio.get_running_loop().call_later(self.latency, self._send, writer, message)
+
+    # -- requests
+
+    def respond(self, writer, name, attributes, children):
+        handler = getattr(self, f'_do_{name}', None)
+        seq = {'seq': attributes['seq']} if 'seq' in attributes else {}
+        if handler is None:
+            return construct_message(f'{name}Resp', seq)
+        return handler(writer, name, attributes, children, seq)
+
+    @staticmethod
+    def _page(name, seq, tag, records):
+        if not records:
+            return construct_message(f'{name}Resp', seq)
+        # the empty root element, opened up to take the records
+        head = construct_message(f'{name}Resp', seq)[:-2] + '>'
+        return head + ''.join(construct_message(tag, record) for record in records) + f'</{name}Resp>'
+
+    def _do_Open(self, writer, name, attributes, children, seq):
+        return construct_message('OpenResp', {'protocolVersion': '45', 'omm': 'fake'},
+                                 {'publicKey': {'modulus': f'{self._public_key.n:x}',
+                                                'exponent': f'{self._public_key.e:x}'}})
+
+    def _do_GetVersions(self, writer, name, attributes, children, seq):
+        return construct_message('GetVersionsResp', {'Open': '45', **seq})
+
+    def _do_Subscribe(self, writer, name, attributes, children, seq):
+        for entry in _records(children, 'e'):
+            if entry.get('cmd') == 'On':
+                self._connections[writer].add(entry['eventType'])
+            else:
+                self._connections[writer].discard(entry['eventType'])
+        return construct_message('SubscribeResp', seq)
+
+    def _get_records(self, records, key, name, tag, attributes, seq):
+        start = int(attributes.get(key, 0))
+        if 'maxRecords' not in attributes:
+            record = records.get(start)
+            return self._page(name, seq, tag, [record] if record else [])
+        wanted = int(attributes['maxRecords'])
+        page = []
+        # ids are dense in the synthetic dataset, walk them instead of sorting all keys
+        highest = self.highest[key]
+        current = max(start, 1)
+        while len(page) < wanted and current <= highest:
+            record = records.get(current)
+            if record is not None:
+                page.append(record)
+            current += 1
+        return self._page(name, seq, tag, page)
+
+    def _do_GetPPUser(self, writer, name, attributes, children, seq):
+        return self._get_records(self.users, 'uid', name, 'user', attributes, seq)
+
+    def _do_GetPPDev(self, writer, name, attributes, children, seq):
+        return self._get_records(self.devices, 'ppn', name, 'pp', attributes, seq)
+
+    def _do_GetLastPPDevAction(self, writer, name, attributes, children, seq):
+        ppn = int(attributes['ppn'])
+        if ppn not in self.devices:
+            return construct_message(f'{name}Resp', seq)
+        return construct_message(f'{name}Resp', seq, {'pp': {'ppn': str(ppn), 'trType': 'LocReg',
+                                                             'rfpId': str(ppn % 64), 'relTime': str(ppn % 600)}})
+
+    def _do_CreatePPUser(self, writer, name, attributes, children, seq):
+        sent = dict(_records(children, 'user')[0])
+        sent.pop('pin', None)
+        sent.pop('sipPw', None)
+        uid = next(self._next_uid)
+        self.highest['uid'] = uid
+        user = {'ppn': '0', 'relType': 'Unbound', 'timeStampAdmin': '1', **sent, 'uid': str(uid)}
+        self._touch(user)
+        self.users[uid] = user
+        self._push('PPUserCnf', {'user': {'uid': str(uid)}})
+        return construct_message(f'{name}Resp', seq, {'user': {'uid': str(uid)}})
+
+    def _do_SetPPUser(self, writer, name, attributes, children, seq):
+        changes = dict(_records(children, 'user')[0])
+        uid = int(changes.pop('uid'))
+        user = self.users.get(uid)
+        if user is None:
+            return construct_message(f'{name}Resp', {**seq, 'errCode': 'KeyNotFound'})
+        changes.pop('pin', None)
+        changes.pop('sipPw', None)
+        user.update(changes)
+        self._touch(user)
+        self._push('PPUserCnf', {'user': {'uid': str(uid)}})
+        return construct_message(f'{name}Resp', seq, {'user': {'uid': str(uid)}})
+
+    def _do_SetPP(self, writer, name, attributes, children, seq):
+        pp = _records(children, 'pp')[0]
+        user = (_records(children, 'user') or [{}])[0]
+        ppn = int(pp['ppn'])
+        if ppn not in self.devices:
+            return construct_message(f'{name}Resp', {**seq, 'errCode': 'KeyNotFound'})
+        if pp['relType'] == 'Unbound':
+            uid = int(user.get('uid', self.devices[ppn]['uid']))
+            self._bind(0, ppn, 'Unbound')
+            if uid in self.users:
+                self.users[uid].update(ppn='0', relType='Unbound')
+                self._touch(self.users[uid])
+        else:
+            uid = int(pp['uid'])
+            self._bind(uid, ppn, pp['relType'])
+        self._push('PPDevCnf', {'pp': {'ppn': str(ppn)}})
+        if uid in self.users:
+            self._push('PPUserCnf', {'user': {'uid': str(uid)}})
+        return construct_message(f'{name}Resp', seq, {'pp': {'ppn': str(ppn), 'uid': str(uid)}})
+
+    def _do_DeletePPUser(self, writer, name, attributes, children, seq):
+        uid = int(attributes['uid'])
+        user = self.users.pop(uid, None)
+        if user is not None and int(user['ppn']) in self.devices:
+            self._bind(0, int(user['ppn']), 'Unbound')
+            self._push('PPDevCnf', {'pp': {'ppn': user['ppn']}})
+        self._push('PPUserCnf', {'user': {'uid': str(uid)}})
+        return construct_message(f'{name}Resp', seq)
+
+    def _do_DeletePPDev(self, writer, name, attributes, children, seq):
+        ppn = int(attributes['ppn'])
+        device = self.devices.pop(ppn, None)
+        if device is not None and int(device['uid']) in self.users:
+            user = self.users[int(device['uid'])]
+            user.update(ppn='0', relType='Unbound')
+            self._touch(user)
+            self._push('PPUserCnf', {'user': {'uid': device['uid']}})
+        self._push('PPDevCnf', {'pp': {'ppn': str(ppn)}})
+        return construct_message(f'{name}Resp', seq)
+
+    def _do_SetDECTSubscriptionMode(self, writer, name, attributes, children, seq):
+        self.subscription_mode = attributes.get('mode', self.subscription_mode)
+        self._push('DECTSubscriptionMode', {'mode': {'mode': self.subscription_mode}})
+        return construct_message(f'{name}Resp', seq)
+
+
+def self_signed_context(directory):
+    cert, key = os.path.join(directory, 'cert.pem'), os.path.join(directory, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-keyout', key, '-out', cert,
+                    '-days', '1', '-subj', '/CN=localhost'], check=True, capture_output=True)
+    return cert, key
+
+
+async def serve(args):
+    omm = FakeOMM(users=args.users, unbound=args.unbound, latency=args.latency)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    with tempfile.TemporaryDirectory() as directory:
+        cert, key = (args.cert, args.key) if args.cert else self_signed_context(directory)
+        context.load_cert_chain(cert, key)
+    server = await asyncio.start_server(omm.handle, args.host, args.port, ssl=context)
+    print(f'fake OMM listening on {args.host}:{args.port} with {len(omm.users)} users and '
+          f'{len(omm.devices)} devices', flush=True)
+    async with server:
+        while True:
+            if args.new_pp_interval:
+                await asyncio.sleep(args.new_pp_interval)
+                omm.add_unbound_device()
+            else:
+                await asyncio.sleep(3600)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake OMM (AXI over TLS) for load and latency testing of hexidian.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=12622)
+    parser.add_argument('--users', type=int, default=1000, help='number of users in the dataset')
+    parser.add_argument('--unbound', type=int, default=0, help='number of subscribed, but unbound devices')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds before each response is sent')
+    parser.add_argument('--new-pp-interval', type=float, default=0,
+                        help='seconds between new unbound handsets subscribing (0: never)')
+    parser.add_argument('--cert', help='TLS certificate (PEM), a self-signed one is created if omitted')
+    parser.add_argument('--key', help='TLS private key (PEM)')
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()